@@ -0,0 +1,197 @@
+"""Двоичный формат алгоритма ``.pofs``.
+
+Все числа -- little-endian::
+
+    заголовок (40 байт):
+        magic      4s   b'POFS'
+        version    H    FORMAT_VERSION
+        reserved   H    0
+        loop_times I
+        before     II   смещение от начала файла, число шагов
+        loop       II
+        after      II
+        crc32      I    по всему, что идёт после заголовка
+    секции: шаги по 8 байт, упакованные как в CommandStore
+
+Шаги секции ложатся в CommandStore одним копированием из отображённого в
+память файла, без разбора строк. JSON-файлы прежнего формата
+конвертируются в обе стороны без потерь::
+
+    python algorithm_file.py program.json program.pofs
+    python algorithm_file.py program.pofs program.json
+"""
+
+import json
+import mmap
+import struct
+import zlib
+
+from command_store import CommandStore
+from protocol import Command, CommandType
+from program_dsl import ProgramError, is_program_file, compile_program_file
+from optimizer import MAX_LOOP_TIMES
+
+
+MAGIC = b'POFS'
+FORMAT_VERSION = 1
+SECTIONS = ('before', 'loop', 'after')
+
+_HEADER = struct.Struct('<4sHHI6II')
+_STEP_SIZE = 8
+
+
+class AlgorithmFileError(ValueError):
+    pass
+
+
+def write_algorithm(filename, before, loop, after, loop_times):
+    """Сохраняет алгоритм; секции -- списки Command или CommandStore."""
+    if not 0 <= loop_times <= MAX_LOOP_TIMES:
+        raise AlgorithmFileError(f'loop_times out of range: {loop_times}')
+    sections = [section if isinstance(section, CommandStore) else CommandStore(section)
+                for section in (before, loop, after)]
+    payload = [section.tobytes() for section in sections]
+
+    table = []
+    offset = _HEADER.size
+    for section, data in zip(sections, payload):
+        table += [offset, len(section)]
+        offset += len(data)
+    crc = 0
+    for data in payload:
+        crc = zlib.crc32(data, crc)
+
+    with open(filename, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, 0, loop_times, *table, crc))
+        for data in payload:
+            f.write(data)
+
+
+def iter_sections(filename, verify=True):
+    """Читает файл по секциям.
+
+    Выдаёт ('loop_times', число), затем ('before', CommandStore),
+    ('loop', ...) и ('after', ...). Контрольная сумма считается по мере
+    чтения, и несовпадение обнаруживается до выдачи последней секции.
+    """
+    with open(filename, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise AlgorithmFileError(f'{filename}: empty file') from None
+        with mm:
+            if len(mm) < _HEADER.size:
+                raise AlgorithmFileError(f'{filename}: truncated header')
+            magic, version, _, loop_times, *table, crc = _HEADER.unpack_from(mm)
+            if magic != MAGIC:
+                raise AlgorithmFileError(f'{filename}: not a POFS algorithm')
+            if version != FORMAT_VERSION:
+                raise AlgorithmFileError(f'{filename}: unsupported version {version}')
+            yield 'loop_times', loop_times
+
+            actual_crc = 0
+            for i, name in enumerate(SECTIONS):
+                offset, count = table[2 * i], table[2 * i + 1]
+                end = offset + count * _STEP_SIZE
+                if offset < _HEADER.size or end > len(mm):
+                    raise AlgorithmFileError(f'{filename}: section {name} out of bounds')
+                data = mm[offset:end]
+                actual_crc = zlib.crc32(data, actual_crc)
+                if i == len(SECTIONS) - 1 and actual_crc != crc:
+                    raise AlgorithmFileError(f'{filename}: checksum mismatch')
+
+                store = CommandStore.frombytes(data)
+                if verify:
+                    try:
+                        store.validate()
+                    except ValueError as e:
+                        raise AlgorithmFileError(f'{filename}: section {name}: {e}') from None
+                yield name, store
+
+
+def read_algorithm(filename):
+    """Возвращает (before, loop, after, loop_times) из CommandStore."""
+    sections = dict(iter_sections(filename))
+    return sections['before'], sections['loop'], sections['after'], sections['loop_times']
+
+
+def is_algorithm_file(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+_STEP_TYPES = (CommandType.SET_FLAP, CommandType.SET_FILTER, CommandType.WAIT)
+
+
+def read_json_algorithm(filename):
+    """Возвращает (before, loop, after, loop_times) из JSON прежнего формата."""
+    with open(filename, 'r') as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise AlgorithmFileError(f'{filename}: {e}') from None
+    try:
+        sections = [[Command.from_str(cmd) for cmd in data[name]] for name in SECTIONS]
+        loop_times = abs(int(data['loop_times']))
+    except (KeyError, TypeError):
+        raise AlgorithmFileError(f'{filename}: not an algorithm') from None
+    except ValueError as e:
+        raise AlgorithmFileError(f'{filename}: {e}') from None
+    if loop_times > MAX_LOOP_TIMES:
+        raise AlgorithmFileError(f'{filename}: loop_times out of range: {loop_times}')
+    for name, section in zip(SECTIONS, sections):
+        for cmd in section:
+            if cmd.type not in _STEP_TYPES:
+                raise AlgorithmFileError(f'{filename}: section {name}: not an algorithm step: {cmd}')
+    return (*sections, loop_times)
+
+
+def write_json_algorithm(filename, before, loop, after, loop_times):
+    algorithm = {
+        'before': [str(cmd) for cmd in before],
+        'loop': [str(cmd) for cmd in loop],
+        'after': [str(cmd) for cmd in after],
+        'loop_times': loop_times
+    }
+    with open(filename, 'w') as f:
+        f.write(json.dumps(algorithm, indent=4))
+
+
+def load_algorithm(filename):
+    """Алгоритм из .pofs, JSON или программы с повторами (.prog):
+    (before, loop, after, loop_times) списками Command.
+    """
+    if is_program_file(filename):
+        try:
+            return compile_program_file(filename, optimize=False)[:4]
+        except ProgramError as e:
+            raise AlgorithmFileError(f'{filename}: {e}') from None
+    if is_algorithm_file(filename):
+        before, loop, after, loop_times = read_algorithm(filename)
+        return before.commands(), loop.commands(), after.commands(), loop_times
+    return read_json_algorithm(filename)
+
+
+def json_to_pofs(json_filename, pofs_filename):
+    write_algorithm(pofs_filename, *read_json_algorithm(json_filename))
+
+
+def pofs_to_json(pofs_filename, json_filename):
+    write_json_algorithm(json_filename, *read_algorithm(pofs_filename))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert POFS algorithms between JSON and .pofs')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+
+    if is_algorithm_file(args.source):
+        pofs_to_json(args.source, args.target)
+    else:
+        json_to_pofs(args.source, args.target)
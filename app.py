@@ -1,193 +1,323 @@
 import json
-from collections import deque
+import logging
+import time
 
-from view_controller import MainWindow, ServoCalibrationDialog, AboutDialog
-from serial_port import SerialPort
+from PyQt5.QtCore import QTimer
+
+from view_controller import MainWindow, ServoCalibrationDialog, MetricsDialog, AboutDialog
+from serial_port import PortMonitor, device_key, is_unique_key, SUPPORTED_BAUD_RATES, DEFAULT_BAUD_RATE, PORT_POLL_INTERVAL
+from serial_worker import SessionWorker
+from optimizer import optimize_algorithm
+from metrics import METRICS_FILENAME
+from algorithm_file import write_algorithm, load_algorithm as load_algorithm_file, AlgorithmFileError
+from timeline import SERVO_SETTLE_TIME
+from session import DEFAULT_UPLOAD_WINDOW
+from settings import Settings
 from protocol import *
 
 
+log = logging.getLogger(__name__)
+
+
 class App:
     def __init__(self):
         self.mainwindow = MainWindow(self)
-        self.servo_calibration_dialog = ServoCalibrationDialog(self)
-        self.about_dialog = AboutDialog(self)
-        self.serial = SerialPort(self)
-        self._command_queue = deque()
-        self._response_queue = deque()
-        self.__device_is_executing = False
-        self._expectations = None
-        self.__last_algorithm_cmd = None
+        # Второстепенные окна строятся при первом показе, а не при запуске.
+        self.servo_calibration_dialog = None
+        self.metrics_dialog = None
+        self.about_dialog = None
+        self.settings = Settings()
+        self.port_name = None
+        self.device_key = None
+        self.codec = DEFAULT_CODEC
+        # (device_key, порт, скорость, нужно ли вернуть алгоритм), пока ждём
+        # возвращения выдернутого устройства.
+        self.__lost = None
+        self.__algorithm = None
+        # Что известно о порте и устройстве по сигналам воркера.
+        self.__connected = False
+        self.__executing = False
+        self.__opening = False
 
+        # Порт и сессия живут в своём потоке; здесь только сигналы от них.
+        self.worker = SessionWorker(
+            high_water=self.settings.get('write_high_water'),
+            settle_time=self.settings.get('servo_settle_time', SERVO_SETTLE_TIME),
+            metrics_file=self.settings.get('metrics_file', METRICS_FILENAME),
+            upload_window=self.settings.get('upload_window', DEFAULT_UPLOAD_WINDOW),
+        )
+        self.worker.message.connect(self.on_message)
+        self.worker.executing.connect(self.on_executing)
+        self.worker.calibration_read.connect(self.on_calibration)
+        self.worker.calibration_known.connect(self.remember_calibration)
+        self.worker.dialog_finished.connect(self.on_dialog_finished)
+        self.worker.emergency_stopped.connect(self.on_emergency_stopped)
+        self.worker.port_opened.connect(self.on_port_opened)
+        self.worker.port_lost.connect(self.on_port_lost)
+        self.worker.summary.connect(self.on_summary)
+        self.worker.start()
+
+        self.mainwindow.set_available_baud_rates(SUPPORTED_BAUD_RATES, DEFAULT_BAUD_RATE)
         self.mainwindow.show()
-    
+
+        self.port_monitor = PortMonitor(self.settings.get('port_poll_interval', PORT_POLL_INTERVAL))
+        self.port_monitor.ports_changed.connect(self.on_ports_changed)
+        self.port_monitor.start()
+
+    def shutdown(self):
+        self.port_monitor.stop()
+        self.worker.stop()
+
+    def on_message(self, msg, timeout=2000):
+        self.mainwindow.show_msg(msg, timeout)
+
+    def on_executing(self, executing):
+        self.__executing = executing
+        self.mainwindow.show_executing(executing)
+
+    def on_emergency_stopped(self, latency):
+        self.mainwindow.show_msg(f'Остановлено за {latency * 1000:.0f} мс', 5000)
+
+    def on_calibration(self, calibration):
+        self.get_servo_calibration_dialog().set_table_contents(calibration)
+
+    def on_dialog_finished(self, ok):
+        if self.metrics_dialog is not None and self.metrics_dialog.isVisible():
+            self.worker.request_summary()
+
     @property
     def device_is_executing(self):
-        return self.__device_is_executing
-    
-    @device_is_executing.setter
-    def device_is_executing(self, executing):
-        self.__device_is_executing = executing
-        self.mainwindow.show_executing(executing)
+        return self.__executing
 
     def show_about(self):
+        if self.about_dialog is None:
+            self.about_dialog = AboutDialog(self)
         self.about_dialog.show()
 
     def show_servo_calibration(self):
-        self.servo_calibration_dialog.show()
+        self.get_servo_calibration_dialog().show()
+
+    def get_servo_calibration_dialog(self):
+        if self.servo_calibration_dialog is None:
+            self.servo_calibration_dialog = ServoCalibrationDialog(self)
+        return self.servo_calibration_dialog
+
+    def show_metrics(self):
+        if self.metrics_dialog is None:
+            self.metrics_dialog = MetricsDialog(self)
+        self.worker.request_summary()
+        self.metrics_dialog.show()
+
+    def on_summary(self, text):
+        if self.metrics_dialog is not None:
+            self.metrics_dialog.set_summary(text)
+
+    def clear_metrics(self):
+        self.worker.clear_metrics()
 
     def update_available_ports(self):
         self.mainwindow.set_available_ports_list(
-            SerialPort.get_available_ports())
+            [info.name for info in self.port_monitor.ports])
+
+    def on_ports_changed(self, ports):
+        self.update_available_ports()
+        if self.connection_established():
+            info = next((info for info in ports if info.name == self.port_name), None)
+            if info is None:
+                # Порт исчез, а ошибки от QSerialPort не было.
+                self.worker.drop_port()
+            else:
+                self.device_key = device_key(info)
+        if self.__lost is not None:
+            self.reconnect()
+
+    def on_port_lost(self, baud_rate, program_loaded):
+        self.__connected = False
+        self.__executing = False
+        self.__lost = (self.device_key, self.port_name, baud_rate, program_loaded)
+        log.warning('Port lost, waiting for the device to come back')
+        self.mainwindow.show_msg('Устройство отключилось, жду, когда вернётся', 10000)
+
+    @property
+    def reconnecting(self):
+        return self.__lost is not None
+
+    def reconnect(self):
+        """Открывает вернувшееся устройство, на каком бы порту оно ни оказалось."""
+        key, port_name, baud_rate, _ = self.__lost
+        info = self.port_monitor.find(key, port_name)
+        if info is None:
+            if len(self.port_monitor.matches(key)) > 1:
+                # Алгоритм не должен уехать на чужой стенд.
+                self.mainwindow.show_msg('Похожих устройств несколько, выберите порт сами', 10000)
+            return
+        if not self.__opening:
+            self.open_port(info.name, baud_rate)
+
+    def __retry_reconnect(self):
+        if self.__lost is not None:
+            self.reconnect()
+
+    def port_selected(self, port_name):
+        # Подбор скорости -- только если пользователь сам выбрал 'Авто'.
+        baud_rate = self.settings.get('baud_rates', {}).get(port_name, DEFAULT_BAUD_RATE)
+        self.mainwindow.set_selected_baud_rate(baud_rate)
 
     def serial_connect(self):
         port_name = self.mainwindow.get_selected_port_name()
         if not port_name:
             self.mainwindow.show_msg("Ну порт же надо выбрать сначала...")
             return
+        if self.__opening:
+            return
 
-        if self.serial.open(port_name):
-            self.mainwindow.show_msg("Соединение установлено")
-        else:
+        self.__lost = None
+        baud_rate = self.mainwindow.get_selected_baud_rate()
+        self.open_port(port_name, baud_rate, probe=baud_rate is None)
+
+    def open_port(self, port_name, baud_rate, probe=False):
+        """Просит воркер открыть порт; чем кончилось -- в on_port_opened."""
+        self.__opening = True
+        self.codec = CODECS.get(self.settings.get('codec'), DEFAULT_CODEC)
+        info = next((info for info in self.port_monitor.ports if info.name == port_name), None)
+        key = device_key(info) if info is not None else port_name
+        # Калибровку из кэша воркер ещё сверит с устройством.
+        calibration = self.settings.get('calibrations', {}).get(key) if is_unique_key(key) else None
+        self.worker.open_port(port_name, baud_rate, probe, self.codec, calibration,
+                              self.settings.get('capture_file'))
+
+    def on_port_opened(self, status):
+        self.__opening = False
+        port_name = status.port_name
+        if not status.ok:
             self.mainwindow.show_msg(
                 "Ой, порт {} не открывается!".format(port_name))
+            if self.__lost is not None:
+                # Порт уже виден, но ещё не готов (например, не выданы права).
+                QTimer.singleShot(self.port_monitor.interval, self.__retry_reconnect)
+            return
+
+        self.__connected = True
+        self.port_name = port_name
+        info = next((info for info in self.port_monitor.ports if info.name == port_name), None)
+        self.device_key = device_key(info) if info is not None else port_name
+        baud_rate = status.baud_rate
+        baud_rates = self.settings.get('baud_rates', {})
+        baud_rates[port_name] = baud_rate
+        self.settings.set('baud_rates', baud_rates)
+
+        throughput = status.bytes_per_second
+        if throughput is None:
+            throughput = baud_rate / 10  # 8N1: 10 бит на байт
+            msg = f"Соединение установлено: {baud_rate} бод, до {throughput:.0f} Б/с"
+        else:
+            msg = f"Соединение установлено: {baud_rate} бод, {throughput:.0f} Б/с"
+        log.info('Connected to %s at %d baud, %.0f B/s', port_name, baud_rate, throughput)
+        self.mainwindow.show_msg(msg, 5000)
+        self.mainwindow.show_connected(True)
+
+        if self.__lost is not None:
+            restore = self.__lost[3]
+            self.__lost = None
+            if restore and self.__algorithm is not None:
+                self.mainwindow.show_msg('Связь восстановлена, загружаю алгоритм заново', 5000)
+                self.worker.send_algorithm(*self.__algorithm)
 
     def serial_disconnect(self):
-        self.serial.close()
+        self.__lost = None
+        self.__connected = False
+        self.__executing = False
+        self.worker.close_port()
         self.mainwindow.show_msg("Соединение закрыто")
 
+    def remember_calibration(self, calibration):
+        """Сохраняет известную калибровку устройства на этом порту в настройки.
+
+        Если сессия калибровку забыла (прошивка оборвалась), забываем и мы,
+        чтобы после переподключения не сравнивать с неверной. Устройства без
+        серийного номера не запоминаем: их не отличить от соседних.
+        """
+        key = self.device_key
+        calibrations = self.settings.get('calibrations', {})
+        if not is_unique_key(key) or calibrations.get(key) == calibration:
+            return
+        if calibration is None:
+            del calibrations[key]
+        else:
+            calibrations[key] = calibration
+        self.settings.set('calibrations', calibrations)
+
     def connection_established(self):
-        return self.serial.is_open()
+        return self.__connected
 
     def send_command(self, cmd):
         if not self.connection_established():
             self.mainwindow.show_msg('Порт открой сперва')
             return
-        
-        if not self.device_is_executing or cmd.type == CommandType.EMERGENCY:
-            self._expectations = self.generate_expected_response(cmd)
-            if cmd.type == CommandType.EXECUTE_PROGRAM:
-                if self.__last_algorithm_cmd is None:
-                    self.mainwindow.show_msg('Перед выполнением алгоритм надо загрузить', 3000)
-                    self._expectations.clear()
-                    return
-                self._expectations[0] = Response(ResponseType.EXEC_FINISH, self.__last_algorithm_cmd)
-                self.device_is_executing = True
-            self.serial.write(str(cmd))
-            print(f'Sending: {repr(str(cmd))}')
-        else:
-            self.mainwindow.show_msg('В данный момент выполняется какой-то алгоритм', 3000)
+        self.worker.send_command(cmd)
 
     def send_reset(self):
-        if self.device_is_executing:
-            self.send_command(Command(CommandType.EMERGENCY))
-            self.device_is_executing = False
-        else:
-            self.send_command(Command(CommandType.RESET))
+        started = time.perf_counter()
+        if not self.connection_established():
+            self.mainwindow.show_msg('Порт открой сперва')
+            return
+        self.worker.send_reset(started)
     
     def send_calibration(self, raw_calibration):
         if not self.connection_established():
             self.mainwindow.show_msg('Порт открой сперва')
             return
-        
-        if self.device_is_executing:
-            self.mainwindow.show_msg('В данный момент выполняется какой-то алгоритм', 3000)
-            return
-
-        self._command_queue.clear()
-        self._response_queue.clear()
 
         calibration = self.process_calibration(raw_calibration)
         if calibration is None:
             return
-        
-        for i in range(len(calibration)):
-            command = Command(CommandType.CALIBRATE,
-                CalibrationData(
-                    motorID=MotorID(str(i)),
-                    openedAngle=calibration[i][0],
-                    closedAngle=calibration[i][1]
-                )
-            )
-            self._command_queue.append(command)
-            self._response_queue.append(self.generate_expected_response(command))
-
-        lastcmd = Command(CommandType.SAVE_CALIBRATION)
-        self._command_queue.append(lastcmd)
-        self._response_queue.append(self.generate_expected_response(lastcmd))
-
-        firstcmd = self._command_queue.popleft()
-        self._expectations = self._response_queue.popleft()
-
-        self.serial.write(str(firstcmd))
-        print(f'Sending: {repr(str(firstcmd))}')
+        self.worker.send_calibration(calibration)
 
     def send_algorithm(self, before, loop, after, loop_times):
         if not self.connection_established():
             self.mainwindow.show_msg('Порт открой сперва')
             return
-        
-        if self.device_is_executing:
-            self.mainwindow.show_msg('В данный момент выполняется какой-то алгоритм', 3000)
-            return
-        
-        self._command_queue.clear()
-        self._response_queue.clear()
-
-        commands = [
-            Command(CommandType.LOADING_MODE),
-            *before,
-            *loop,
-            *after,
-            Command(CommandType.SAVE_PROGRAM,
-                LoopData(
-                    beginMark = len(before) + 1,
-                    endMark = len(before) + len(loop),
-                    numRepetitions = loop_times if len(loop) != 0 else 0
-                )
-            )
-        ]
-        self.__last_algorithm_cmd = commands[-2]
-
-        for command in commands:
-            self._command_queue.append(command)
-            self._response_queue.append(self.generate_expected_response(command, realtime=False))
-        
-        firstcmd = self._command_queue.popleft()
-        self._expectations = self._response_queue.popleft()
-
-        self.serial.write(str(firstcmd))
-        print(f'Sending: {repr(str(firstcmd))}')
+
+        if self.settings.get('optimize_algorithm', True):
+            settle_time = self.settings.get('servo_settle_time', SERVO_SETTLE_TIME)
+            optimized = optimize_algorithm(before, loop, after, loop_times, self.codec, settle_time)
+            if any(optimized[:3]):
+                before, loop, after, loop_times, report = optimized
+                log.info('Optimized algorithm: %s', report)
+                if report.steps_saved:
+                    self.mainwindow.show_msg(f'Алгоритм сокращён: {report}', 3000)
+        self.__algorithm = (before, loop, after, loop_times)
+        self.worker.send_algorithm(before, loop, after, loop_times)
 
     def save_algorithm(self, algorithm, filename):
-        string = json.dumps(algorithm, indent=4)
+        """Секции algorithm -- последовательности Command; формат по расширению."""
+        if filename.endswith('.pofs'):
+            write_algorithm(filename, algorithm['before'], algorithm['loop'], algorithm['after'],
+                            algorithm['loop_times'])
+            return
+
+        data = {
+            'before': [str(cmd) for cmd in algorithm['before']],
+            'loop': [str(cmd) for cmd in algorithm['loop']],
+            'after': [str(cmd) for cmd in algorithm['after']],
+            'loop_times': algorithm['loop_times']
+        }
+        string = json.dumps(data, indent=4)
         with open(filename, 'w') as f:
             f.write(string)
 
     def load_algorithm(self, filename):
-        with open(filename, 'r') as f:
-            data = json.load(f)
         try:
-            before = [Command.from_str(cmd) for cmd in data['before']]
-            loop = [Command.from_str(cmd) for cmd in data['loop']]
-            after = [Command.from_str(cmd) for cmd in data['after']]
-            loop_times = abs(int(data['loop_times']))
-        except (KeyError, TypeError):
-            self.mainwindow.show_msg('Плохой файл', 3000)
-        except ValueError as e:
+            before, loop, after, loop_times = load_algorithm_file(filename)
+        except (OSError, AlgorithmFileError) as e:
             self.mainwindow.show_msg(str(e), 3000)
-        else:
-            if self.sequence_valid(before) and self.sequence_valid(loop) and self.sequence_valid(after):
-                algorithm = {
-                    'before': before,
-                    'loop': loop,
-                    'after': after,
-                    'loop_times': loop_times
-                }
-                return algorithm
-            else:
-                self.mainwindow.show_msg(
-                    'Считанные команды всраты по сути своей.', 3000)
-        return None
+            return None
+        return {
+            'before': before,
+            'loop': loop,
+            'after': after,
+            'loop_times': loop_times
+        }
     
     def process_calibration(self, raw_calibration):
         if all(self.angles_row_valid(row) for row in raw_calibration):
@@ -213,65 +343,5 @@ class App:
             self.mainwindow.show_msg('Данные некорректны')
             return None
 
-    def sequence_valid(self, sequence):
-        return all(cmd.type in (CommandType.SET_FLAP, CommandType.SET_FILTER, CommandType.WAIT)
-                   for cmd in sequence)
-    
     def angles_row_valid(self, row):
         return all(str(a).isnumeric() and 0 <= int(a) <= 180 for a in row)
-    
-    def generate_expected_response(self, command, realtime=True):
-        expectations = []
-        if realtime and command.type != CommandType.PRINT_CALIBRATION:
-            expectations.append(Response(ResponseType.EXEC_FINISH, command))
-        expectations.append(Response(ResponseType.PARSING_OK, None))
-        return expectations
-        
-    
-    def process_packet(self):
-        status, response = self.serial.read()
-
-        if status == SerialPort.ErrorStatus.NO_PACKET:
-            self.mainwindow.show_msg('Перенос строки просрали')
-            return
-        if status == SerialPort.ErrorStatus.DECODING_ERROR:
-            self.mainwindow.show_msg('Контроллер что-то бормочет')
-            return
-        
-        try:
-            print(f'Received: {str(repr(response))}')
-            response = parse_response(response)
-        except ValueError as e:
-            self.mainwindow.show_msg(f'Ошибка парсинга {repr(str(e))}', 1500)
-            return
-            
-        if response.type == ResponseType.PARSING_OK or response.type == ResponseType.EXEC_FINISH:
-            if len(self._expectations) == 0:
-                self.mainwindow.show_msg('Рассинхронизация: нежданный ответ')
-                return
-            
-            expected = self._expectations.pop()
-            if response != expected:
-                self.mainwindow.show_msg(f'Рассинхронизация: {response} -- {expected}')
-
-            if len(self._expectations) == 0:
-                if self._response_queue:
-                    self._expectations = self._response_queue.popleft()
-                    if self._command_queue:
-                        next_cmd = self._command_queue.popleft()
-                        self.serial.write(str(next_cmd))
-                        print(f'Sending: {repr(str(next_cmd))}')
-                    else:
-                        self.mainwindow.show_msg('Рассинхронизация: нечем продолжить диалог')
-                else:
-                    self.device_is_executing = False
-
-        elif response.type == ResponseType.PARSING_ERR:
-            self.mainwindow.show_msg('Контроллер подавился')
-            self.device_is_executing = False
-        elif response.type == ResponseType.DISPATCH_ERR:
-            self.mainwindow.show_msg('Контроллер растерялся')
-            self.device_is_executing = False
-        elif response.type == ResponseType.CALIB_DATA:
-            calibration = [[c.openedAngle, c.closedAngle] for c in response.data]
-            self.servo_calibration_dialog.set_table_contents(calibration)
@@ -0,0 +1,228 @@
+"""Работа с POFS через asyncio, без Qt.
+
+Транспорт читает и пишет файловый дескриптор последовательного порта (или
+псевдотерминала) через цикл событий, а AsyncSession превращает диалог
+ProtocolSession в корутины::
+
+    transport = open_serial('/dev/ttyUSB0', 9600)
+    session = AsyncSession(transport)
+    await session.upload(before, loop, after, loop_times)
+    await session.send(Command(CommandType.EXECUTE_PROGRAM))
+"""
+
+import asyncio
+import os
+import termios
+import tty
+
+from protocol import Command, CommandType, Response, ResponseType, DEFAULT_CODEC, split_frames
+from session import ProtocolSession, SessionListener
+
+
+class SerialTransport:
+    """Неблокирующий дескриптор порта, подключённый к циклу asyncio."""
+
+    def __init__(self, fd, codec=DEFAULT_CODEC, loop=None, baud_rate=9600):
+        self.fd = fd
+        self.codec = codec
+        self.baud_rate = baud_rate
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.on_frames = None
+        self.on_close = None
+        # TrafficRecorder, если переписку надо записывать.
+        self.recorder = None
+        self.__rx = bytearray()
+        self.__tx = bytearray()
+        self.loop.add_reader(self.fd, self.__on_readable)
+
+    def is_open(self):
+        return self.fd is not None
+
+    def write(self, data):
+        if self.fd is None:
+            # Порт закрыт: писать некуда, а сессия узнала об этом из on_close.
+            return
+        if self.recorder is not None:
+            self.recorder.record_tx(data)
+        if self.__tx:
+            self.__tx += data
+            return
+        try:
+            written = os.write(self.fd, data)
+        except BlockingIOError:
+            written = 0
+        if written < len(data):
+            self.__tx += data[written:]
+            self.loop.add_writer(self.fd, self.__on_writable)
+
+    def write_many(self, frames):
+        self.write(b''.join(frames))
+
+    def __on_writable(self):
+        try:
+            written = os.write(self.fd, self.__tx)
+        except BlockingIOError:
+            return
+        del self.__tx[:written]
+        if not self.__tx:
+            self.loop.remove_writer(self.fd)
+
+    def __on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # Устройство пропало (например, закрылась другая сторона pty).
+            data = b''
+        if not data:
+            self.close()
+            return
+        if self.recorder is not None:
+            self.recorder.record_rx(data)
+        self.__rx += data
+        frames = split_frames(self.__rx, self.codec)
+        if frames and self.on_frames is not None:
+            self.on_frames(frames)
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        if self.on_close is not None:
+            self.on_close()
+
+
+def open_serial(path, baud_rate=9600, codec=DEFAULT_CODEC, loop=None):
+    """Открывает tty в сыром режиме 8N1 на заданной скорости."""
+    speed = getattr(termios, f'B{baud_rate}', None)
+    if speed is None:
+        raise ValueError(f'unsupported baud rate: {baud_rate}')
+
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        tty.setraw(fd)
+        attrs = termios.tcgetattr(fd)
+        attrs[2] |= termios.CLOCAL | termios.CREAD
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except termios.error:
+        # Не все pty позволяют менять скорость -- им это и не нужно.
+        pass
+    except BaseException:
+        os.close(fd)
+        raise
+    return SerialTransport(fd, codec, loop, baud_rate)
+
+
+class AsyncSession(SessionListener):
+    """Корутинная обёртка над ProtocolSession.
+
+    Каждый метод запускает диалог и ждёт его завершения; результат --
+    True, если все ответы совпали с ожиданиями. Сообщения сессии копятся
+    в ``messages``.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.__timer = None
+        self.session = ProtocolSession(transport.write, transport.codec, listener=self, arm_timer=self.__arm_timer,
+                                       write_many=transport.write_many)
+        self.session.baud_rate = transport.baud_rate
+        transport.on_frames = self.session.feed_many
+        transport.on_close = self.__on_closed
+        self.messages = []
+        self.calibration = None
+        self.__dialog = None
+        self.__calibration = None
+
+    @property
+    def upload_window(self):
+        return self.session.upload_window
+
+    @upload_window.setter
+    def upload_window(self, window):
+        self.session.upload_window = window
+
+    def __arm_timer(self, delay):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if delay is not None:
+            self.__timer = self.transport.loop.call_later(delay, self.session.on_timeout)
+
+    def on_message(self, msg, timeout=2000):
+        self.messages.append(msg)
+
+    def on_calibration(self, calibration):
+        self.calibration = calibration
+        if self.__calibration is not None and not self.__calibration.done():
+            self.__calibration.set_result(calibration)
+
+    def on_dialog_finished(self, ok):
+        if self.__dialog is not None and not self.__dialog.done():
+            self.__dialog.set_result(ok)
+
+    def __on_closed(self):
+        self.messages.append('Соединение потеряно')
+        self.__arm_timer(None)
+        self.session.connection_lost()
+        self.on_dialog_finished(False)
+        if self.__calibration is not None and not self.__calibration.done():
+            self.__calibration.set_result(None)
+
+    async def _run(self, start):
+        # Новый диалог (например, аварийный стоп) отменяет ожидание старого.
+        self.on_dialog_finished(False)
+        if not self.transport.is_open():
+            return False
+        dialog = self.__dialog = self.transport.loop.create_future()
+        if not start():
+            return False
+        try:
+            return await dialog
+        finally:
+            if self.__dialog is dialog:
+                self.__dialog = None
+
+    async def send(self, cmd):
+        return await self._run(lambda: self.session.send_command(cmd))
+
+    async def reset(self):
+        return await self._run(self.session.send_reset)
+
+    async def emergency(self):
+        """Аварийный стоп: отменяет текущий диалог, даже если его ждёт другая корутина."""
+        return await self._run(self.session.send_emergency)
+
+    async def upload(self, before, loop, after, loop_times):
+        return await self._run(lambda: self.session.send_algorithm(before, loop, after, loop_times))
+
+    async def execute(self):
+        return await self.send(Command(CommandType.EXECUTE_PROGRAM))
+
+    async def calibrate(self, calibration):
+        return await self._run(lambda: self.session.send_calibration(calibration))
+
+    async def read_calibration(self):
+        """Возвращает калибровку устройства или None."""
+        cmd = Command(CommandType.PRINT_CALIBRATION)
+        self.__calibration = self.transport.loop.create_future()
+        try:
+            if not await self.send(cmd):
+                return None
+            # CALIB_DATA приходит после PARSING_OK, и диалог его уже не ждёт.
+            timeout = self.session.response_timeout(cmd, Response(ResponseType.CALIB_DATA, None))
+            try:
+                return await asyncio.wait_for(self.__calibration, timeout)
+            except asyncio.TimeoutError:
+                self.messages.append('Устройство не прислало калибровку')
+                return None
+        finally:
+            self.__calibration = None
+
+    def close(self):
+        self.transport.close()
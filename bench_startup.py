@@ -0,0 +1,83 @@
+"""Замер холодного старта: время до первой отрисовки главного окна.
+
+Каждый прогон -- отдельный процесс ``main.py --startup-benchmark``,
+который завершается сам, как только главное окно отрисовалось. Время
+считается от запуска процесса, так что в него входят и импорт PyQt, и
+разбор форм, и App.__init__::
+
+    python bench_startup.py                 # 5 прогонов, медиана
+    python bench_startup.py --loadui        # формы через loadUi, для сравнения
+    python bench_startup.py --max-ms 1500   # код возврата 1, если медиана больше
+
+Без дисплея используется платформа Qt offscreen.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from PyQt5.QtCore import QObject, QEvent, QTimer
+
+
+MARKER = 'first window:'
+
+
+class FirstPaint(QObject):
+    """Печатает, сколько прошло с started, при первой отрисовке widget, и выходит."""
+
+    def __init__(self, widget, started, quit):
+        super().__init__(widget)
+        self.started = started
+        self.quit = quit
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint:
+            obj.removeEventFilter(self)
+            print(f'{MARKER} {(time.perf_counter() - self.started) * 1000:.1f} ms in process', flush=True)
+            QTimer.singleShot(0, self.quit)
+        return False
+
+
+def run_once(env):
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, 'main.py', '--startup-benchmark'], env=env,
+                            stdout=subprocess.PIPE, text=True)
+    elapsed = None
+    for line in proc.stdout:
+        if line.startswith(MARKER) and elapsed is None:
+            elapsed = time.perf_counter() - started
+            in_process = line[len(MARKER):].strip()
+    proc.wait()
+    if elapsed is None:
+        raise RuntimeError(f'main.py exited with {proc.returncode} before showing a window')
+    return elapsed, in_process
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure time to the first window')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--loadui', action='store_true', help='ignore compiled forms')
+    parser.add_argument('--max-ms', type=float, default=None, help='fail if the median is slower')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.loadui:
+        env['POFS_LOADUI'] = '1'
+    if not env.get('DISPLAY') and not env.get('WAYLAND_DISPLAY'):
+        env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    times = []
+    for i in range(args.runs):
+        elapsed, in_process = run_once(env)
+        times.append(elapsed * 1000)
+        print(f'run {i + 1}: {times[-1]:.1f} ms ({in_process})')
+    median = statistics.median(times)
+    print(f'time to first window: median {median:.1f} ms, min {min(times):.1f} ms, max {max(times):.1f} ms')
+    if args.max_ms is not None and median > args.max_ms:
+        print(f'slower than {args.max_ms:.0f} ms')
+        sys.exit(1)
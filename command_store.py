@@ -0,0 +1,108 @@
+"""Компактное хранилище шагов алгоритма.
+
+Шаг (SET_FLAP, SET_FILTER или WAIT) упакован в одно 64-битное число:
+два младших бита -- вид команды, остальное -- аргумент (значение
+заслонки/фильтра или миллисекунды ожидания). Десятки тысяч шагов
+занимают сотни килобайт, а не десятки мегабайт объектов Command, и
+добавление в конец -- O(1).
+"""
+
+import sys
+from array import array
+
+from protocol import Command, CommandType, FlapStatus, FilterState
+
+
+_FLAP = 0
+_FILTER = 1
+_WAIT = 2
+
+# Допустимые коды шагов заслонки и фильтра.
+_VALID_CODES = frozenset(
+    [int(e.value) << 2 | _FLAP for e in FlapStatus] + [int(e.value) << 2 | _FILTER for e in FilterState])
+
+_KINDS = {
+    CommandType.SET_FLAP: _FLAP,
+    CommandType.SET_FILTER: _FILTER,
+    CommandType.WAIT: _WAIT,
+}
+
+
+def pack(cmd):
+    kind = _KINDS.get(cmd.type)
+    if kind is None:
+        raise ValueError(f'not an algorithm step: {cmd!r}')
+    if kind == _WAIT:
+        return cmd.arg << 2 | kind
+    return int(cmd.arg.value) << 2 | kind
+
+
+def unpack(code):
+    kind = code & 3
+    value = code >> 2
+    if kind == _FLAP:
+        return Command(CommandType.SET_FLAP, FlapStatus(str(value)))
+    if kind == _FILTER:
+        return Command(CommandType.SET_FILTER, FilterState(str(value)))
+    if kind == _WAIT:
+        return Command(CommandType.WAIT, value)
+    raise ValueError(f'bad step code: {code:#x}')
+
+
+class CommandStore:
+    """Последовательность шагов с доступом по индексу, как у списка."""
+
+    def __init__(self, commands=()):
+        self._codes = array('Q', map(pack, commands))
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [unpack(code) for code in self._codes[index]]
+        return unpack(self._codes[index])
+
+    def __iter__(self):
+        return map(unpack, self._codes)
+
+    def append(self, cmd):
+        self._codes.append(pack(cmd))
+
+    def extend(self, commands):
+        self._codes.extend(map(pack, commands))
+
+    def insert(self, index, commands):
+        """Вставляет commands перед index одним сдвигом хвоста."""
+        self._codes[index:index] = array('Q', map(pack, commands))
+
+    def remove(self, index, count=1):
+        del self._codes[index:index + count]
+
+    def clear(self):
+        self._codes = array('Q')
+
+    def commands(self):
+        return [unpack(code) for code in self._codes]
+
+    def tobytes(self):
+        """Шаги подряд, по 8 байт little-endian."""
+        if sys.byteorder == 'little':
+            return self._codes.tobytes()
+        codes = array('Q', self._codes)
+        codes.byteswap()
+        return codes.tobytes()
+
+    @classmethod
+    def frombytes(cls, data):
+        store = cls()
+        store._codes.frombytes(data)
+        if sys.byteorder != 'little':
+            store._codes.byteswap()
+        return store
+
+    def validate(self):
+        """ValueError, если среди шагов есть неразбираемый."""
+        for code in self._codes:
+            if code & 3 != _WAIT and code not in _VALID_CODES:
+                raise ValueError(f'bad step code: {code:#x}')
@@ -0,0 +1,124 @@
+"""Одновременная работа с несколькими POFS.
+
+У каждого устройства своя AsyncSession на своём порту, а диалоги идут
+параллельно в одном цикле asyncio, так что общее время близко ко времени
+самого медленного устройства::
+
+    fleet = Fleet()
+    failed = fleet.open(['/dev/ttyUSB0', '/dev/ttyUSB1'])
+    await fleet.broadcast_algorithm(before, loop, after, loop_times)
+    print(fleet.summary())
+"""
+
+import asyncio
+import time
+from collections import namedtuple
+
+from async_session import AsyncSession, open_serial
+from protocol import DEFAULT_CODEC
+from metrics import SessionMetrics, write_metrics, METRICS_FILENAME
+
+
+DeviceResult = namedtuple('DeviceResult', 'port_name ok elapsed messages')
+
+
+class FleetDevice:
+    """Одно устройство стойки: свой порт и своё состояние диалога."""
+
+    def __init__(self, port_name, session):
+        self.port_name = port_name
+        self.session = session
+        self.session.session.metrics = SessionMetrics(port_name)
+        self.result = None
+
+    async def run(self, dialog):
+        self.result = None
+        started = time.perf_counter()
+        first_message = len(self.session.messages)
+        ok = await dialog(self)
+        self.result = DeviceResult(self.port_name, ok, time.perf_counter() - started,
+                                   tuple(self.session.messages[first_message:]))
+        return self.result
+
+    def close(self):
+        self.session.close()
+
+
+class Fleet:
+    """Стойка устройств, которым рассылается одно и то же."""
+
+    def __init__(self):
+        self.devices = []
+        # DeviceResult по каждому устройству последней рассылки; остаются
+        # и после close().
+        self.results = []
+        self.wall_time = None
+
+    def open(self, port_names, baud_rate=9600, codec=DEFAULT_CODEC):
+        """Открывает порты и возвращает список тех, что не открылись."""
+        failed = []
+        for port_name in port_names:
+            try:
+                transport = open_serial(port_name, baud_rate, codec)
+            except (OSError, ValueError):
+                failed.append(port_name)
+                continue
+            self.devices.append(FleetDevice(port_name, AsyncSession(transport)))
+        return failed
+
+    def close(self):
+        for device in self.devices:
+            device.close()
+        self.devices.clear()
+
+    @property
+    def upload_window(self):
+        return self.devices[0].session.upload_window if self.devices else 1
+
+    @upload_window.setter
+    def upload_window(self, window):
+        for device in self.devices:
+            device.session.upload_window = window
+
+    async def run(self, dialog):
+        """Выполняет dialog(device) на всех устройствах разом.
+
+        dialog -- корутинная функция, возвращающая True, если всё прошло.
+        Возвращает DeviceResult по каждому устройству.
+        """
+        started = time.perf_counter()
+        self.results = []
+        self.wall_time = None
+        self.results = await asyncio.gather(*(device.run(dialog) for device in self.devices))
+        self.wall_time = time.perf_counter() - started
+        return self.results
+
+    async def broadcast_command(self, cmd):
+        return await self.run(lambda device: device.session.send(cmd))
+
+    async def broadcast_algorithm(self, before, loop, after, loop_times):
+        return await self.run(lambda device: device.session.upload(before, loop, after, loop_times))
+
+    async def emergency_stop(self):
+        """Аварийный стоп всей стойки; прерывает диалоги, которые идут сейчас."""
+        return await self.run(lambda device: device.session.emergency())
+
+    async def broadcast_calibration(self, calibration):
+        return await self.run(lambda device: device.session.calibrate(calibration))
+
+    def write_metrics(self, filename=METRICS_FILENAME):
+        """Метрики всех устройств стойки в одном файле, с портом в метках."""
+        write_metrics([d.session.session.metrics for d in self.devices], filename)
+
+    @property
+    def ok(self):
+        return bool(self.results) and all(r.ok for r in self.results)
+
+    def summary(self):
+        results = self.results
+        ok = sum(1 for r in results if r.ok)
+        lines = [f'{ok}/{len(results)} OK, wall time {self.wall_time or 0:.3f} s']
+        for r in results:
+            status = 'OK' if r.ok else 'FAIL'
+            lines.append(f'  {r.port_name}: {status} {r.elapsed:.3f} s {"; ".join(r.messages)}')
+        return '\n'.join(lines)
@@ -0,0 +1,96 @@
+"""Формы из assets/*.ui.
+
+``uic.loadUi`` разбирает XML формы при каждом запуске. Чтобы этого не
+делать, при сборке формы можно скомпилировать в модули ``ui_<имя>.py``::
+
+    python forms.py
+
+Ускоряет ли это старт и насколько, не замерено; сравнить можно
+``bench_startup.py`` и ``bench_startup.py --loadui``.
+
+``load_form`` берёт скомпилированный модуль, если он есть и не старше
+своего .ui, иначе (в рабочей копии, после правки формы) -- ``loadUi``.
+Переменная окружения POFS_LOADUI=1 принудительно включает ``loadUi``.
+"""
+
+import importlib
+import io
+import os
+import xml.etree.ElementTree as ET
+
+from PyQt5 import uic
+
+
+ASSETS_DIR = 'assets'
+FORMS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Элементы .ui, в которых лежат пути к картинкам.
+_IMAGE_TAGS = frozenset((
+    'pixmap', 'normaloff', 'normalon', 'disabledoff', 'disabledon',
+    'activeoff', 'activeon', 'selectedoff', 'selectedon',
+))
+
+
+def _ui_filename(name):
+    return os.path.join(ASSETS_DIR, f'{name}.ui')
+
+
+def _module_filename(name):
+    return os.path.join(FORMS_DIR, f'ui_{name}.py')
+
+
+def _compiled_form(name):
+    if os.environ.get('POFS_LOADUI'):
+        return None
+    try:
+        if os.path.getmtime(_module_filename(name)) < os.path.getmtime(_ui_filename(name)):
+            return None
+    except OSError:
+        return None
+    try:
+        module = importlib.import_module(f'ui_{name}')
+    except ImportError:
+        return None
+    for attr, value in vars(module).items():
+        if attr.startswith('Ui_'):
+            return value
+    return None
+
+
+def load_form(name, widget):
+    """Строит форму assets/<name>.ui на widget, как это делает loadUi."""
+    form = _compiled_form(name)
+    if form is None:
+        uic.loadUi(_ui_filename(name), widget)
+        return
+    ui = form()
+    ui.setupUi(widget)
+    # loadUi вешает дочерние виджеты атрибутами на сам widget, setupUi -- на ui.
+    for attr, value in vars(ui).items():
+        setattr(widget, attr, value)
+
+
+def compile_form(name):
+    # loadUi ищет картинки рядом с .ui, а скомпилированный модуль -- от
+    # текущего каталога, как и весь остальной код (assets/...).
+    tree = ET.parse(_ui_filename(name))
+    for elem in tree.iter():
+        if elem.tag in _IMAGE_TAGS:
+            if elem.text and elem.text.strip():
+                elem.text = os.path.join(ASSETS_DIR, elem.text.strip()).replace(os.sep, '/')
+            if elem.tail and elem.tail.strip():
+                elem.tail = os.path.join(ASSETS_DIR, elem.tail.strip()).replace(os.sep, '/')
+    source = io.StringIO(ET.tostring(tree.getroot(), encoding='unicode'))
+    with open(_module_filename(name), 'w', encoding='utf-8') as f:
+        uic.compileUi(source, f)
+
+
+def form_names():
+    return sorted(os.path.splitext(filename)[0] for filename in os.listdir(ASSETS_DIR)
+                  if filename.endswith('.ui'))
+
+
+if __name__ == '__main__':
+    for name in form_names():
+        compile_form(name)
+        print(f'{_ui_filename(name)} -> {_module_filename(name)}')
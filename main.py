@@ -4,7 +4,15 @@
 # This software is a part of POFS project.
 #
 
+import logging
 import sys
+import time
+
+started = time.perf_counter()
+
+logging.basicConfig(level=logging.WARNING, format='%(message)s')
+logging.getLogger('session').setLevel(logging.DEBUG)
+logging.getLogger('app').setLevel(logging.INFO)
 
 from PyQt5.QtWidgets import QApplication
 
@@ -12,5 +20,9 @@ from app import App
 
 qApp = QApplication([])
 app = App()
+qApp.aboutToQuit.connect(app.shutdown)
+if '--startup-benchmark' in sys.argv:
+    from bench_startup import FirstPaint
+    FirstPaint(app.mainwindow, started, qApp.quit)
 
 sys.exit(qApp.exec_())
\ No newline at end of file
@@ -0,0 +1,232 @@
+"""Метрики протокольной сессии.
+
+``SessionMetrics`` копит счётчики и гистограммы, пока сессия работает, и
+ничего не делает сверх сложения и одного bisect на ответ. Снимок
+выгружается в текстовом формате Prometheus (``render``/``write_metrics``),
+так что файл можно отдать node_exporter'у или просто прочитать глазами,
+а ``summary`` собирает короткую сводку для окна приложения.
+"""
+
+import logging
+import os
+import time
+from bisect import bisect_left
+
+from protocol import CommandType
+
+
+log = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, с.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UPLOAD_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+METRICS_FILENAME = os.path.join(os.path.expanduser('~'), '.pofs_app.prom')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя -- +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Оценка квантиля сверху -- граница корзины, куда он попал."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            yield bound, seen
+
+
+class SessionMetrics:
+    """Наблюдения за одной ProtocolSession; ``port`` идёт в метки."""
+
+    def __init__(self, port=''):
+        self.port = port
+        self.started = time.time()
+        self.round_trip = {}  # CommandType -> Histogram
+        self.upload = Histogram(UPLOAD_BUCKETS)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.retries = {}  # CommandType -> int
+        self.timeouts = 0
+        self.desyncs = 0
+        self.parse_errors = 0  # кадр не разобрали мы
+        self.device_parse_errors = 0  # PARSING_ERR от контроллера
+        self.dispatch_errors = 0
+        self.uploaded_bytes = 0
+        self.__first_io = None
+        self.__last_io = None
+
+    def __touch(self):
+        now = time.monotonic()
+        if self.__first_io is None:
+            self.__first_io = now
+        self.__last_io = now
+
+    def frame_sent(self, nbytes):
+        self.bytes_sent += nbytes
+        self.frames_sent += 1
+        self.__touch()
+
+    def frame_received(self, nbytes):
+        self.bytes_received += nbytes
+        self.frames_received += 1
+        self.__touch()
+
+    def command_acknowledged(self, cmdtype, seconds):
+        histogram = self.round_trip.get(cmdtype)
+        if histogram is None:
+            histogram = self.round_trip[cmdtype] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def retried(self, cmdtype):
+        self.retries[cmdtype] = self.retries.get(cmdtype, 0) + 1
+
+    def upload_finished(self, seconds, nbytes):
+        self.upload.observe(seconds)
+        self.uploaded_bytes += nbytes
+
+    @property
+    def active_time(self):
+        if self.__first_io is None:
+            return 0.0
+        return self.__last_io - self.__first_io
+
+    def throughput(self):
+        """(отправлено, принято) Б/с за время между первым и последним кадром."""
+        elapsed = self.active_time
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return self.bytes_sent / elapsed, self.bytes_received / elapsed
+
+    def upload_rate(self):
+        """Средняя скорость загрузки алгоритмов, Б/с."""
+        return self.uploaded_bytes / self.upload.sum if self.upload.sum else 0.0
+
+    def summary(self):
+        sent, received = self.throughput()
+        lines = [
+            f'Порт: {self.port or "-"}',
+            f'Отправлено: {self.bytes_sent} Б в {self.frames_sent} кадрах, {sent:.0f} Б/с',
+            f'Принято: {self.bytes_received} Б в {self.frames_received} кадрах, {received:.0f} Б/с',
+        ]
+        if self.upload.count:
+            lines.append(f'Загрузок: {self.upload.count}, в среднем {self.upload.mean:.2f} с, '
+                         f'{self.upload_rate():.0f} Б/с')
+        lines.append(f'Повторов: {sum(self.retries.values())}, таймаутов: {self.timeouts}, '
+                     f'рассинхронизаций: {self.desyncs}')
+        lines.append(f'Ошибок разбора: наших {self.parse_errors}, контроллера {self.device_parse_errors}, '
+                     f'ошибок диспетчера: {self.dispatch_errors}')
+        if self.round_trip:
+            lines.append('Время ответа (среднее / p95, мс):')
+            for cmdtype in CommandType:
+                histogram = self.round_trip.get(cmdtype)
+                if histogram is not None:
+                    lines.append(f'  {cmdtype.name}: {histogram.mean * 1000:.1f} / '
+                                 f'{histogram.quantile(0.95) * 1000:.0f} ({histogram.count})')
+        return '\n'.join(lines)
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+
+def _le(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render(sessions):
+    """Текст в формате Prometheus для списка SessionMetrics."""
+    lines = []
+
+    def header(name, kind, help_):
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    def counter(name, help_, attr):
+        header(name, 'counter', help_)
+        for m in sessions:
+            lines.append(f'{name}{_labels(port=m.port)} {getattr(m, attr)}')
+
+    def histogram(name, h, **labels):
+        for bound, count in h.cumulative():
+            lines.append(f'{name}_bucket{_labels(**labels, le=_le(bound))} {count}')
+        lines.append(f'{name}_sum{_labels(**labels)} {h.sum}')
+        lines.append(f'{name}_count{_labels(**labels)} {h.count}')
+
+    header('pofs_round_trip_seconds', 'histogram', 'Time from sending a command to its acknowledgement.')
+    for m in sessions:
+        for cmdtype, h in m.round_trip.items():
+            histogram('pofs_round_trip_seconds', h, port=m.port, command=cmdtype.name)
+
+    header('pofs_upload_seconds', 'histogram', 'Algorithm upload duration.')
+    for m in sessions:
+        histogram('pofs_upload_seconds', m.upload, port=m.port)
+
+    counter('pofs_sent_bytes_total', 'Bytes written to the port.', 'bytes_sent')
+    counter('pofs_received_bytes_total', 'Bytes read from the port.', 'bytes_received')
+    counter('pofs_sent_frames_total', 'Frames written to the port.', 'frames_sent')
+    counter('pofs_received_frames_total', 'Frames read from the port.', 'frames_received')
+    counter('pofs_uploaded_bytes_total', 'Bytes of uploaded algorithms.', 'uploaded_bytes')
+
+    header('pofs_retries_total', 'counter', 'Commands retransmitted after a timeout.')
+    for m in sessions:
+        for cmdtype, count in m.retries.items():
+            lines.append(f'pofs_retries_total{_labels(port=m.port, command=cmdtype.name)} {count}')
+
+    counter('pofs_timeouts_total', 'Dialogs abandoned because the device did not answer.', 'timeouts')
+    counter('pofs_desyncs_total', 'Replies that did not match the expected ones.', 'desyncs')
+    counter('pofs_parse_errors_total', 'Frames from the device the host could not decode.', 'parse_errors')
+    counter('pofs_device_parse_errors_total', 'PARSING_ERR replies from the device.', 'device_parse_errors')
+    counter('pofs_dispatch_errors_total', 'DISPATCH_ERR replies from the device.', 'dispatch_errors')
+
+    header('pofs_throughput_bytes_per_second', 'gauge', 'Average throughput between the first and last frame.')
+    for m in sessions:
+        sent, received = m.throughput()
+        lines.append(f'pofs_throughput_bytes_per_second{_labels(port=m.port, direction="tx")} {sent:.1f}')
+        lines.append(f'pofs_throughput_bytes_per_second{_labels(port=m.port, direction="rx")} {received:.1f}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(sessions, filename=METRICS_FILENAME):
+    """Атомарно перезаписывает файл метрик: читатель не увидит его недописанным."""
+    write_rendered(render(sessions), filename)
+
+
+def write_rendered(text, filename=METRICS_FILENAME):
+    """Как write_metrics, но для готового текста render().
+
+    Пишет только текст, не трогая SessionMetrics, так что звать можно из
+    любого потока.
+    """
+    tmp = filename + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, filename)
+    except OSError as e:
+        log.warning('Metrics not saved: %s', e)
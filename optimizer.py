@@ -0,0 +1,186 @@
+"""Оптимизация записанного алгоритма перед загрузкой.
+
+Проходы не меняют физического поведения установки:
+
+* идущие подряд WAIT склеиваются, нулевые WAIT выбрасываются;
+* SET_FLAP/SET_FILTER в уже установленное состояние заменяется на WAIT
+  длиной в settle_time -- столько прошивка на него и тратит. Состояние
+  отслеживается через границы секций и повторы цикла;
+* если settle_time нулевой, такой SET просто выбрасывается, как и SET,
+  перебитый такой же командой раньше, чем прошло хоть какое-то время;
+* цикл из одного WAIT превращается в один длинный WAIT.
+"""
+
+from collections import namedtuple
+
+from protocol import Command, CommandType, LoopData, DEFAULT_CODEC
+from timeline import SERVO_SETTLE_TIME
+
+
+# WAIT в прошивке -- 32-битное беззнаковое число миллисекунд.
+MAX_WAIT = 0xFFFFFFFF
+# Число повторов цикла (LoopData) -- тоже 32 бита, и в прошивке, и в .pofs.
+MAX_LOOP_TIMES = 0xFFFFFFFF
+
+# Состояние установки: (заслонка, фильтр); None -- неизвестно.
+UNKNOWN_STATE = (None, None)
+
+
+class OptimizationReport(namedtuple('OptimizationReport',
+                                    'steps_before steps_after executed_before executed_after bytes_before bytes_after')):
+    @property
+    def steps_saved(self):
+        return self.steps_before - self.steps_after
+
+    @property
+    def executed_saved(self):
+        return self.executed_before - self.executed_after
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_before - self.bytes_after
+
+    def __str__(self):
+        return (f'шагов {self.steps_before} -> {self.steps_after}, '
+                f'байт {self.bytes_before} -> {self.bytes_after}')
+
+
+def _state_component(cmd):
+    return 0 if cmd.type == CommandType.SET_FLAP else 1
+
+
+def _transfer(commands, state):
+    """Состояние после выполнения commands из state."""
+    state = list(state)
+    for cmd in commands:
+        if cmd.type == CommandType.SET_FLAP or cmd.type == CommandType.SET_FILTER:
+            state[_state_component(cmd)] = cmd.arg
+    return tuple(state)
+
+
+def _meet(a, b):
+    return tuple(x if x == y else None for x, y in zip(a, b))
+
+
+def _drop_overridden(commands):
+    result = []
+    last_set = [None, None]  # индексы в result с момента последнего WAIT
+    for cmd in commands:
+        if cmd.type == CommandType.WAIT:
+            if cmd.arg:
+                last_set = [None, None]
+            result.append(cmd)
+            continue
+        if cmd.type == CommandType.SET_FLAP or cmd.type == CommandType.SET_FILTER:
+            component = _state_component(cmd)
+            if last_set[component] is not None:
+                result[last_set[component]] = None
+            last_set[component] = len(result)
+        result.append(cmd)
+    return [cmd for cmd in result if cmd is not None]
+
+
+def _drop_redundant(commands, state, settle_ms):
+    result = []
+    state = list(state)
+    for cmd in commands:
+        if cmd.type == CommandType.SET_FLAP or cmd.type == CommandType.SET_FILTER:
+            component = _state_component(cmd)
+            if state[component] == cmd.arg:
+                if settle_ms:
+                    result.append(Command(CommandType.WAIT, settle_ms))
+                continue
+            state[component] = cmd.arg
+        result.append(cmd)
+    return result
+
+
+def _merge_waits(commands):
+    result = []
+    for cmd in commands:
+        if cmd.type == CommandType.WAIT:
+            if cmd.arg == 0:
+                continue
+            if result and result[-1].type == CommandType.WAIT and result[-1].arg + cmd.arg <= MAX_WAIT:
+                result[-1] = Command(CommandType.WAIT, result[-1].arg + cmd.arg)
+                continue
+        result.append(cmd)
+    return result
+
+
+def _optimize_section(commands, state, settle_ms):
+    if not settle_ms:
+        # Перебитый SET, пока серва едет, успевает её сдвинуть -- выбрасывать
+        # его можно, только если ехать ей некогда.
+        commands = _drop_overridden(commands)
+    commands = _drop_redundant(commands, state, settle_ms)
+    return _merge_waits(commands)
+
+
+def upload_size(before, loop, after, loop_times, codec=DEFAULT_CODEC):
+    """Сколько байт уйдёт в порт при загрузке алгоритма."""
+    commands = [
+        Command(CommandType.LOADING_MODE),
+        *before, *loop, *after,
+        Command(CommandType.SAVE_PROGRAM, LoopData(len(before) + 1, len(before) + len(loop), loop_times)),
+    ]
+    return sum(len(codec.encode_command(cmd)) for cmd in commands)
+
+
+def optimize_algorithm(before, loop, after, loop_times, codec=DEFAULT_CODEC, settle_time=SERVO_SETTLE_TIME):
+    """Возвращает (before, loop, after, loop_times, OptimizationReport).
+
+    settle_time -- сколько, с, прошивка выполняет SET_FLAP/SET_FILTER; длительность
+    программы и моменты смены состояния при оптимизации не меняются.
+    """
+    settle_ms = round(settle_time * 1000)
+    original = (list(before), list(loop), list(after))
+    steps_before = len(before) + len(loop) + len(after)
+    executed_before = len(before) + len(loop) * loop_times + len(after)
+    bytes_before = upload_size(before, loop, after, loop_times if loop else 0, codec)
+
+    # Что стоит на установке к началу программы, неизвестно.
+    before = _optimize_section(before, UNKNOWN_STATE, settle_ms)
+    before_state = _transfer(before, UNKNOWN_STATE)
+
+    # Во второй и следующие проходы цикл начинается с состояния после
+    # самого себя, так что вход в цикл -- общее у двух вариантов.
+    loop_entry = before_state
+    if loop_times > 1:
+        for _ in range(2):
+            loop_entry = _meet(before_state, _transfer(loop, loop_entry))
+    loop = _optimize_section(loop, loop_entry, settle_ms)
+    loop_exit = _transfer(loop, loop_entry)
+
+    if (len(loop) == 1 and loop[0].type == CommandType.WAIT and loop_times > 0
+            and loop[0].arg * loop_times <= MAX_WAIT):
+        before = _merge_waits(before + [Command(CommandType.WAIT, loop[0].arg * loop_times)])
+        loop = []
+        after_entry = before_state
+    elif loop and loop_times > 0:
+        after_entry = loop_exit
+    else:
+        # Цикл не выполняется ни разу (или его нет).
+        after_entry = _meet(before_state, loop_exit) if loop else before_state
+    after = _optimize_section(after, after_entry, settle_ms)
+
+    if not loop and before and after:
+        # Без цикла before и after сливаются на стыке.
+        joined = _merge_waits(before + after)
+        before, after = joined, []
+
+    bytes_after = upload_size(before, loop, after, loop_times if loop else 0, codec)
+    if bytes_after > bytes_before:
+        # WAIT вместо короткого SET бывает длиннее на проводе: тогда оставляем как было.
+        before, loop, after = original
+        bytes_after = bytes_before
+
+    report = OptimizationReport(
+        steps_before=steps_before,
+        steps_after=len(before) + len(loop) + len(after),
+        executed_before=executed_before,
+        executed_after=len(before) + len(loop) * loop_times + len(after),
+        bytes_before=bytes_before,
+        bytes_after=bytes_after,
+    )
+    return before, loop, after, loop_times, report
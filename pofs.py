@@ -0,0 +1,210 @@
+"""Работа с POFS из командной строки, без GUI.
+
+Для стендов и CI: ни Qt, ни QApplication не нужны, порт обслуживает
+asyncio (async_session), алгоритм читается тем же кодом, что и в
+приложении (algorithm_file)::
+
+    python -m pofs run algo.json --port /dev/ttyUSB0 --execute
+    python -m pofs run exposure.prog --port /dev/ttyUSB0
+    python -m pofs reset --port /dev/ttyUSB0
+    python -m pofs read-calibration --port /dev/ttyUSB0
+    python -m pofs calibrate calibration.json --port /dev/ttyUSB0
+    python -m pofs run algo.json --port /dev/ttyUSB0 --port /dev/ttyUSB1
+
+С несколькими --port команда выполняется на всех устройствах разом
+(fleet), строки вывода начинаются с имени порта, а в конце печатается
+сводка; успех -- только если успешно везде.
+
+Код возврата: 0 -- всё прошло, 1 -- устройство ответило не то или не
+ответило, 2 -- плохие аргументы или файл, 3 -- порт не открылся.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from protocol import CODECS, DEFAULT_CODEC, MotorID
+from algorithm_file import load_algorithm, AlgorithmFileError
+from program_dsl import ProgramError, is_program_file, compile_program_file
+from async_session import AsyncSession, open_serial
+from session import DEFAULT_UPLOAD_WINDOW
+from fleet import Fleet
+from optimizer import optimize_algorithm
+from recorder import TrafficRecorder
+from timeline import format_duration
+
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_PORT = 3
+
+
+async def _run(args, session, out):
+    if is_program_file(args.algorithm):
+        try:
+            compiled = compile_program_file(args.algorithm, session.transport.codec, not args.no_optimize,
+                                            session.session.settle_time)
+        except ProgramError as e:
+            raise AlgorithmFileError(f'{args.algorithm}: {e}') from None
+        out(f'compiled: {compiled}')
+        before, loop, after, loop_times = compiled[:4]
+    else:
+        before, loop, after, loop_times = load_algorithm(args.algorithm)
+    # Программу компилятор уже прогнал через оптимизатор.
+    if not args.no_optimize and not is_program_file(args.algorithm):
+        optimized = optimize_algorithm(before, loop, after, loop_times, session.transport.codec,
+                                       session.session.settle_time)
+        if any(optimized[:3]):
+            before, loop, after, loop_times, report = optimized
+            if report.steps_saved:
+                out(f'optimized: {report}')
+
+    started = time.perf_counter()
+    ok = await session.upload(before, loop, after, loop_times)
+    out(f'upload: {"OK" if ok else "FAIL"} in {time.perf_counter() - started:.3f} s')
+    if not ok or not args.execute:
+        return ok
+
+    duration = format_duration(session.session.program_duration)
+    out(f'executing, expected {duration}')
+    started = time.perf_counter()
+    ok = await session.execute()
+    out(f'execute: {"OK" if ok else "FAIL"} in {time.perf_counter() - started:.3f} s')
+    return ok
+
+
+async def _reset(args, session, out):
+    ok = await session.reset()
+    out(f'reset: {"OK" if ok else "FAIL"}')
+    return ok
+
+
+async def _read_calibration(args, session, out):
+    calibration = await session.read_calibration()
+    if calibration is None:
+        out('read-calibration: FAIL')
+        return False
+    out(json.dumps(calibration))
+    return True
+
+
+def _calibration_valid(data):
+    # Как App.load_servo_calibration: по паре углов 0..180 на каждый мотор.
+    return (type(data) == list and len(data) == len(MotorID)
+            and all(type(row) == list and len(row) == 2
+                    and all(type(a) == int and 0 <= a <= 180 for a in row) for row in data))
+
+
+async def _calibrate(args, session, out):
+    try:
+        with open(args.calibration, 'r') as f:
+            calibration = json.load(f)
+    except (OSError, ValueError) as e:
+        raise AlgorithmFileError(f'{args.calibration}: {e}') from None
+    if not _calibration_valid(calibration):
+        raise AlgorithmFileError(f'{args.calibration}: expected {len(MotorID)} pairs of angles 0..180')
+    ok = await session.calibrate(calibration)
+    out(f'calibrate: {"OK" if ok else "FAIL"}')
+    return ok
+
+
+def _prefixed(port_name):
+    return lambda text: print(f'{port_name}: {text}')
+
+
+async def _main_fleet(args):
+    if args.capture:
+        print('--capture needs a single --port', file=sys.stderr)
+        return EXIT_USAGE
+    fleet = Fleet()
+    failed = fleet.open(args.port, args.baud, CODECS[args.codec])
+    if failed:
+        fleet.close()
+        for port_name in failed:
+            print(f'{port_name}: cannot open', file=sys.stderr)
+        return EXIT_PORT
+
+    fleet.upload_window = args.window
+    try:
+        await fleet.run(lambda device: args.handler(args, device.session, _prefixed(device.port_name)))
+    except (OSError, AlgorithmFileError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_USAGE
+    finally:
+        fleet.close()
+    print(fleet.summary())
+    return EXIT_OK if fleet.ok else EXIT_FAILED
+
+
+async def _main(args):
+    if len(args.port) > 1:
+        return await _main_fleet(args)
+    port_name = args.port[0]
+    codec = CODECS[args.codec]
+    try:
+        transport = open_serial(port_name, args.baud, codec)
+    except (OSError, ValueError) as e:
+        print(f'{port_name}: {e}', file=sys.stderr)
+        return EXIT_PORT
+
+    session = AsyncSession(transport)
+    session.upload_window = args.window
+    try:
+        if args.capture:
+            transport.recorder = TrafficRecorder(args.capture, codec)
+        ok = await args.handler(args, session, print)
+    except (OSError, AlgorithmFileError) as e:
+        print(e, file=sys.stderr)
+        return EXIT_USAGE
+    finally:
+        for msg in session.messages:
+            print(f'  {msg}')
+        session.close()
+        if transport.recorder is not None:
+            transport.recorder.close()
+    return EXIT_OK if ok else EXIT_FAILED
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pofs', description='Drive a POFS device without the GUI')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--port', required=True, action='append',
+                        help='serial port, e.g. /dev/ttyUSB0; repeat it to drive several devices at once')
+    common.add_argument('--baud', type=int, default=9600)
+    common.add_argument('--codec', choices=sorted(CODECS), default=DEFAULT_CODEC.name)
+    common.add_argument('--window', type=int, default=DEFAULT_UPLOAD_WINDOW,
+                        help='upload window, frames in flight; above 1 only if the controller buffers that many')
+    common.add_argument('--capture', help='append the traffic to this capture file')
+    common.add_argument('-v', '--verbose', action='store_true', help='print every frame')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', parents=[common], help='upload an algorithm (.json, .pofs or .prog)')
+    run.add_argument('algorithm')
+    run.add_argument('--execute', action='store_true', help='run it and wait until it finishes')
+    run.add_argument('--no-optimize', action='store_true', help='upload the steps as they are')
+    run.set_defaults(handler=_run)
+
+    reset = commands.add_parser('reset', parents=[common], help='reset the device')
+    reset.set_defaults(handler=_reset)
+
+    read_calibration = commands.add_parser('read-calibration', parents=[common],
+                                           help='print the calibration as JSON')
+    read_calibration.set_defaults(handler=_read_calibration)
+
+    calibrate = commands.add_parser('calibrate', parents=[common], help='program a calibration JSON')
+    calibrate.add_argument('calibration')
+    calibrate.set_defaults(handler=_calibrate)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    if args.verbose:
+        logging.getLogger('session').setLevel(logging.DEBUG)
+    return asyncio.run(_main(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
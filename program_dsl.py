@@ -0,0 +1,255 @@
+"""Язык программ с вложенными повторами.
+
+Прошивка знает один цикл (LoopData в SAVE_PROGRAM), а протоколы экспозиции
+состоят из вложенных повторений. Программа пишется так::
+
+    # комментарий
+    filter 1
+    repeat 3 {
+        flap open
+        wait 1.5s
+        flap close
+        repeat 100 {
+            wait 250ms
+        }
+    }
+    filter none
+
+Шаги: ``flap open|close``, ``filter none|1|2|3|4``, ``wait N`` с
+единицами ``ms`` (по умолчанию), ``s`` или ``m``. ``repeat N { ... }``
+можно вкладывать как угодно; ``{`` -- в конце строки repeat, ``}`` -- на
+отдельной строке.
+
+Компилятор оставляет на устройстве циклом тот repeat, который сильнее
+всего сокращает загрузку, а всё остальное разворачивает в before и
+after. Циклом может стать только repeat, который выполняется один раз,
+то есть не вложенный в другой repeat с N > 1. Размеры считаются без
+разворачивания, так что перебор всех кандидатов дешёв::
+
+    python program_dsl.py exposure.prog                 # отчёт о размере
+    python program_dsl.py exposure.prog -o exposure.pofs
+"""
+
+import re
+from collections import namedtuple
+
+from protocol import Command, CommandType, FlapStatus, FilterState, DEFAULT_CODEC
+from optimizer import optimize_algorithm, upload_size, MAX_WAIT, MAX_LOOP_TIMES
+from timeline import SERVO_SETTLE_TIME
+
+
+PROGRAM_SUFFIX = '.prog'
+
+# Больше шагов контроллер всё равно не вместит, а разворачивать дольше.
+MAX_PROGRAM_STEPS = 1_000_000
+
+_FLAPS = {'open': FlapStatus.OPENED, 'close': FlapStatus.CLOSED}
+_FILTERS = {'none': FilterState.NONE, '1': FilterState.FS1, '2': FilterState.FS2,
+            '3': FilterState.FS3, '4': FilterState.FS4}
+_WAIT_UNITS = {'ms': 1, 's': 1000, 'm': 60_000}
+_WAIT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(ms|s|m)?')
+_REPEAT_RE = re.compile(r'repeat\s+(\d+)\s*\{')
+
+
+# Блок repeat; line -- строка, на которой он открыт.
+Repeat = namedtuple('Repeat', 'times body line')
+
+
+class ProgramError(ValueError):
+    def __init__(self, message, line=None):
+        super().__init__(f'line {line}: {message}' if line is not None else message)
+        self.line = line
+
+
+class CompiledProgram(namedtuple('CompiledProgram',
+                                 'before loop after loop_times loop_line upload_size unrolled_size')):
+    """Результат компиляции; loop_line -- строка repeat, ставшего циклом, или None."""
+
+    def __str__(self):
+        loop = f'цикл со строки {self.loop_line} x{self.loop_times}' if self.loop_line else 'без цикла'
+        return (f'{len(self.before)}+{len(self.loop)}+{len(self.after)} шагов, {loop}, '
+                f'загрузка {self.upload_size} байт (развёрнутая целиком -- {self.unrolled_size})')
+
+
+def _parse_step(words, line):
+    keyword = words[0]
+    if keyword == 'flap' and len(words) == 2 and words[1] in _FLAPS:
+        return Command(CommandType.SET_FLAP, _FLAPS[words[1]])
+    if keyword == 'filter' and len(words) == 2 and words[1] in _FILTERS:
+        return Command(CommandType.SET_FILTER, _FILTERS[words[1]])
+    if keyword == 'wait':
+        match = _WAIT_RE.fullmatch(' '.join(words[1:]))
+        if match is None:
+            raise ProgramError(f'bad duration: {" ".join(words[1:])!r}', line)
+        ms = round(float(match.group(1)) * _WAIT_UNITS[match.group(2) or 'ms'])
+        if ms > MAX_WAIT:
+            raise ProgramError(f'wait longer than {MAX_WAIT} ms', line)
+        return Command(CommandType.WAIT, ms)
+    raise ProgramError(f'unknown step: {" ".join(words)!r}', line)
+
+
+def parse_program(text):
+    """Разбирает текст в список шагов (Command) и блоков Repeat."""
+    root = []
+    stack = [(root, None)]
+    for line, source in enumerate(text.splitlines(), 1):
+        source = source.split('#', 1)[0].strip().lower()
+        if not source:
+            continue
+        if source == '}':
+            if len(stack) == 1:
+                raise ProgramError('unmatched }', line)
+            body, opened = stack.pop()
+            stack[-1][0].append(Repeat(opened[0], body, opened[1]))
+            continue
+        if source.startswith('repeat'):
+            match = _REPEAT_RE.fullmatch(source)
+            if match is None:
+                raise ProgramError('expected "repeat N {"', line)
+            times = int(match.group(1))
+            if times > MAX_LOOP_TIMES:
+                raise ProgramError(f'repeat more than {MAX_LOOP_TIMES} times', line)
+            stack.append(([], (times, line)))
+            continue
+        stack[-1][0].append(_parse_step(source.split(), line))
+    if len(stack) > 1:
+        raise ProgramError('repeat is not closed', stack[-1][1][1])
+    return root
+
+
+class _Sizes:
+    """Шаги и байты блоков в развёрнутом виде, без разворачивания."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.blocks = {}  # id(body) -> (шагов, байт)
+        self.steps = {}  # Command -> байт
+
+    def of(self, block):
+        key = id(block)
+        sizes = self.blocks.get(key)
+        if sizes is None:
+            steps = nbytes = 0
+            for item in block:
+                if isinstance(item, Repeat):
+                    body_steps, body_bytes = self.of(item.body)
+                    steps += item.times * body_steps
+                    nbytes += item.times * body_bytes
+                else:
+                    size = self.steps.get(item)
+                    if size is None:
+                        size = self.steps[item] = len(self.codec.encode_command(item))
+                    steps += 1
+                    nbytes += size
+            sizes = self.blocks[key] = (steps, nbytes)
+        return sizes
+
+
+def _loop_candidates(block, path=()):
+    """Блоки repeat, выполняющиеся ровно один раз, с путём от корня."""
+    for item in block:
+        if isinstance(item, Repeat) and item.times > 0:
+            yield item, path
+            if item.times == 1:
+                yield from _loop_candidates(item.body, path + (item,))
+
+
+def _unroll(block, out):
+    for item in block:
+        if isinstance(item, Repeat):
+            body = []
+            _unroll(item.body, body)
+            out.extend(body * item.times)
+        else:
+            out.append(item)
+    return out
+
+
+def _split(block, target, path, sections, phase=0):
+    """Разворачивает block в sections[0] до target, его тело -- в [1], остальное -- в [2]."""
+    for item in block:
+        if item is target:
+            _unroll(item.body, sections[1])
+            phase = 2
+        elif isinstance(item, Repeat) and any(item is p for p in path):
+            phase = _split(item.body, target, path, sections, phase)
+        elif isinstance(item, Repeat):
+            _unroll([item], sections[phase])
+        else:
+            sections[phase].append(item)
+    return phase
+
+
+def compile_program(text, codec=DEFAULT_CODEC, optimize=True, settle_time=SERVO_SETTLE_TIME):
+    """Компилирует программу в CompiledProgram.
+
+    Цикл выбирается по размеру загрузки до оптимизации; ``optimize``
+    затем прогоняет результат через optimize_algorithm с settle_time.
+    """
+    program = parse_program(text)
+    sizes = _Sizes(codec)
+    total_steps, total_bytes = sizes.of(program)
+
+    best = None
+    best_bytes, best_steps = total_bytes, total_steps
+    for repeat, path in _loop_candidates(program):
+        if repeat.times < 2:
+            continue
+        body_steps, body_bytes = sizes.of(repeat.body)
+        if not body_steps:
+            continue
+        nbytes = total_bytes - (repeat.times - 1) * body_bytes
+        if nbytes < best_bytes:
+            best = repeat, path
+            best_bytes = nbytes
+            best_steps = total_steps - (repeat.times - 1) * body_steps
+    if best_steps > MAX_PROGRAM_STEPS:
+        raise ProgramError(f'{best_steps} steps even with the best loop, more than {MAX_PROGRAM_STEPS}')
+
+    if best is None:
+        before, loop, after, loop_times, loop_line = _unroll(program, []), [], [], 0, None
+    else:
+        repeat, path = best
+        before, loop, after = sections = [], [], []
+        _split(program, repeat, path, sections)
+        loop_times, loop_line = repeat.times, repeat.line
+    if optimize:
+        before, loop, after, loop_times, _ = optimize_algorithm(before, loop, after, loop_times, codec, settle_time)
+    nbytes = upload_size(before, loop, after, loop_times if loop else 0, codec)
+    flat = upload_size([], [], [], 0, codec) + total_bytes
+    return CompiledProgram(before, loop, after, loop_times if loop else 0, loop_line if loop else None,
+                           nbytes, flat)
+
+
+def is_program_file(filename):
+    return filename.endswith(PROGRAM_SUFFIX)
+
+
+def compile_program_file(filename, codec=DEFAULT_CODEC, optimize=True, settle_time=SERVO_SETTLE_TIME):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return compile_program(f.read(), codec, optimize, settle_time)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from protocol import CODECS
+
+    parser = argparse.ArgumentParser(description='Compile a POFS program with nested repeats')
+    parser.add_argument('program')
+    parser.add_argument('-o', '--output', help='write the result as .pofs or .json')
+    parser.add_argument('--codec', choices=sorted(CODECS), default=DEFAULT_CODEC.name)
+    parser.add_argument('--no-optimize', action='store_true')
+    args = parser.parse_args()
+
+    try:
+        compiled = compile_program_file(args.program, CODECS[args.codec], not args.no_optimize)
+    except (OSError, ProgramError) as e:
+        raise SystemExit(f'{args.program}: {e}')
+    print(compiled)
+    if args.output:
+        from algorithm_file import write_algorithm, write_json_algorithm
+        if args.output.endswith('.json'):
+            write_json_algorithm(args.output, *compiled[:4])
+        else:
+            write_algorithm(args.output, *compiled[:4])
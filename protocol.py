@@ -1,5 +1,6 @@
 from enum import Enum
 from collections import namedtuple
+from functools import lru_cache
 
 
 class CommandType(Enum):
@@ -37,6 +38,13 @@ class MotorID(Enum):
     S4 = '4'
 
 
+# Таблицы разбора: значение на проводе -> элемент перечисления.
+_COMMAND_TYPES = {e.value: e for e in CommandType}
+_FLAP_STATUSES = {e.value: e for e in FlapStatus}
+_FILTER_STATES = {e.value: e for e in FilterState}
+_MOTOR_IDS = {e.value: e for e in MotorID}
+
+
 LoopData = namedtuple('LoopData', 'beginMark endMark numRepetitions')
 
 
@@ -71,11 +79,45 @@ class CommandValueError(ValueError):
 
 
 class Command:
-    def __init__(self, cmdtype: CommandType, arg=None):
-        self.type = cmdtype
-        self.arg = arg
-    
+    """Команда контроллеру -- неизменяемое значение.
+
+    Команды с конечным набором аргументов (заслонка, фильтр, команды без
+    аргумента) существуют в единственном экземпляре: ``Command(...)``
+    возвращает уже созданный объект. Строковое представление и кадры для
+    каждого кодека считаются один раз и запоминаются в самой команде.
+    """
+
+    __slots__ = ('type', 'arg', '_hash', '_str', '_wire')
+
+    def __new__(cls, cmdtype: CommandType, arg=None):
+        try:
+            cached = _FLYWEIGHTS.get((cmdtype, arg))
+        except TypeError:  # нехешируемый аргумент
+            cached = None
+        if cached is not None:
+            return cached
+        self = object.__new__(cls)
+        _set = object.__setattr__
+        _set(self, 'type', cmdtype)
+        _set(self, 'arg', arg)
+        _set(self, '_hash', None)
+        _set(self, '_str', None)
+        _set(self, '_wire', None)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'Command is immutable: {name}')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'Command is immutable: {name}')
+
+    def __reduce__(self):
+        return Command, (self.type, self.arg)
+
     def __str__(self):
+        string = self._str
+        if string is not None:
+            return string
         string = str(self.type.value)
         if self.type == CommandType.SET_FLAP or self.type == CommandType.SET_FILTER:
             string += f',{str(self.arg.value)}'
@@ -90,16 +132,36 @@ class Command:
         else:
             assert self.arg is None
         string += '\n'
+        object.__setattr__(self, '_str', string)
         return string
     
     def __repr__(self):
         return str(self)
     
     def __eq__(self, other):
-        if self.type == other.type and self.arg == other.arg:
+        if self is other:
             return True
-        else:
-            return False
+        if not isinstance(other, Command):
+            return NotImplemented
+        return self.type == other.type and self.arg == other.arg
+
+    def __hash__(self):
+        h = self._hash
+        if h is None:
+            h = hash((self.type, self.arg))
+            object.__setattr__(self, '_hash', h)
+        return h
+
+    def encode(self, codec):
+        """Кадр этой команды в кодеке codec; считается один раз."""
+        wire = self._wire
+        if wire is None:
+            wire = {}
+            object.__setattr__(self, '_wire', wire)
+        data = wire.get(codec.name)
+        if data is None:
+            data = wire[codec.name] = codec._encode_command(self)
+        return data
     
     @classmethod
     def from_str(cls, string):
@@ -108,50 +170,45 @@ class Command:
         string = string[:-1]
         parts = string.split(',')
 
-        if parts[0] not in (e.value for e in CommandType):
+        cmdtype = _COMMAND_TYPES.get(parts[0])
+        if cmdtype is None:
             raise CommandTypeBadError(parts[0])
-        
-        cmdtype = CommandType(parts[0])
         cmdarg = None
 
-        if cmdtype == CommandType.SAVE_PROGRAM:
+        if cmdtype is CommandType.SAVE_PROGRAM:
             if len(parts) != 4:
                 raise CommandFormatError(string)
             for part in parts[1:]:
                 if not part.isnumeric():
                     raise CommandFormatError(f'{string}: {part}')
-            args = list(map(int, parts[1:]))
-            args = list(map(abs, args))
-            loop_data = LoopData(beginMark=args[0], endMark=args[1], numRepetitions=args[2])
-            if loop_data.beginMark > loop_data.endMark:
+            loop_data = LoopData(abs(int(parts[1])), abs(int(parts[2])), abs(int(parts[3])))
+            # Пустой цикл App кодирует как beginMark == endMark + 1.
+            if loop_data.beginMark > loop_data.endMark + 1:
                 raise CommandValueError(str(loop_data))
             cmdarg = loop_data
-        elif cmdtype == CommandType.CALIBRATE:
+        elif cmdtype is CommandType.CALIBRATE:
             if len(parts) != 4:
                 raise CommandFormatError(string)
             for part in parts[1:]:
                 if not part.isnumeric():
                     raise CommandFormatError(f'{string}: {part}')
-            if parts[1] not in (e.value for e in MotorID):
+            motor_id = _MOTOR_IDS.get(parts[1])
+            if motor_id is None:
                 raise CommandValueError(f'{string}: {parts[1]}')
-            motor_id = MotorID(parts[1])
             opened_angle = abs(int(parts[2]))
             closed_angle = abs(int(parts[3]))
             if opened_angle > 180 or closed_angle > 180:
                 raise CommandValueError(f'angles: {opened_angle}, {closed_angle}')
-            calib_data = CalibrationData(motorID=motor_id, openedAngle=opened_angle, closedAngle=closed_angle)
-            cmdarg = calib_data
-        elif cmdtype == CommandType.SET_FLAP:
-            cmdarg = parts[1]
-            if cmdarg not in (e.value for e in FlapStatus):
-                raise CommandValueError(f'{string}: {cmdarg}')
-            cmdarg = FlapStatus(cmdarg)
-        elif cmdtype == CommandType.SET_FILTER:
-            cmdarg = parts[1]
-            if cmdarg not in (e.value for e in FilterState):
-                raise CommandValueError(f'{string}: {cmdarg}')
-            cmdarg = FilterState(cmdarg)
-        elif cmdtype == CommandType.WAIT:
+            cmdarg = CalibrationData(motorID=motor_id, openedAngle=opened_angle, closedAngle=closed_angle)
+        elif cmdtype is CommandType.SET_FLAP:
+            cmdarg = _FLAP_STATUSES.get(parts[1])
+            if cmdarg is None:
+                raise CommandValueError(f'{string}: {parts[1]}')
+        elif cmdtype is CommandType.SET_FILTER:
+            cmdarg = _FILTER_STATES.get(parts[1])
+            if cmdarg is None:
+                raise CommandValueError(f'{string}: {parts[1]}')
+        elif cmdtype is CommandType.WAIT:
             if not parts[1].isnumeric():
                 raise CommandFormatError(parts[1])
             cmdarg = abs(int(parts[1]))
@@ -162,6 +219,21 @@ class Command:
         return cls(cmdtype, cmdarg)
 
 
+# Единственные экземпляры команд с конечным набором аргументов.
+_FLYWEIGHTS = {}
+_FLYWEIGHTS.update(
+    ((cmdtype, arg), Command(cmdtype, arg))
+    for cmdtype, args in (
+        (CommandType.SET_FLAP, FlapStatus),
+        (CommandType.SET_FILTER, FilterState),
+        *((t, (None,)) for t in CommandType
+          if t not in (CommandType.SET_FLAP, CommandType.SET_FILTER, CommandType.WAIT,
+                       CommandType.SAVE_PROGRAM, CommandType.CALIBRATE)),
+    )
+    for arg in args
+)
+
+
 class ResponseType(Enum):
     PARSING_OK = '0'
     PARSING_ERR = '1'
@@ -185,28 +257,46 @@ class ResponseValueError(ValueError):
 Response = namedtuple('Response', 'type data')
 
 
+_RESPONSE_TYPES = {e.value: e for e in ResponseType}
+
+# Сколько различных строк ответа помнит parse_response.
+RESPONSE_CACHE_SIZE = 256
+
+
 def parse_response(string):
+    """Разбирает строку ответа контроллера.
+
+    Частые ответы (подтверждения, эхо выполненных команд) берутся из
+    LRU-кеша, так что на одну и ту же строку возвращается один и тот же
+    объект. Ответы с калибровкой содержат список и не кешируются.
+    """
+    if string[:1] == ResponseType.CALIB_DATA.value:
+        return _parse_response(string)
+    return _parse_response_cached(string)
+
+
+def _parse_response(string):
     if string[-1] != '\n':
         raise ResponseFormatError(string)
     string = string[:-1]
-    parts = string.split(',')
+    head, sep, tail = string.partition(',')
 
-    if parts[0] not in (e.value for e in ResponseType):
+    type_ = _RESPONSE_TYPES.get(head)
+    if type_ is None:
         raise ResponseTypeBadError(string)
-    
-    type_ = ResponseType(parts[0])
     data = None
 
-    if type_ == ResponseType.EXEC_FINISH:
-        if len(parts) < 2:
-            raise ResponseFormatError(str(parts))
+    if type_ is ResponseType.EXEC_FINISH:
+        if not sep:
+            raise ResponseFormatError(str([string]))
         try:
-            command = Command.from_str(','.join(parts[1:]) + '\n')
+            command = Command.from_str(tail + '\n')
         except (CommandTypeBadError, CommandFormatError, CommandValueError) as e:
             raise ResponseValueError(f'{string}: {str(e)}')
         else:
             data = command
-    elif type_ == ResponseType.CALIB_DATA:
+    elif type_ is ResponseType.CALIB_DATA:
+        parts = string.split(',')
         if len(parts) != 6:
             raise ResponseFormatError(str(parts))
         data = []
@@ -216,19 +306,308 @@ def parse_response(string):
             subparts = part.split(' ')
             if len(subparts) != 2:
                 raise ResponseFormatError(part)
-            if not all(subpart.isnumeric() for subpart in subparts):
+            if not (subparts[0].isnumeric() and subparts[1].isnumeric()):
                 raise ResponseValueError(part)
-            motor_id = MotorID(str(i - 1))
             opened_angle = abs(int(subparts[0]))
             closed_angle = abs(int(subparts[1]))
             if opened_angle > 180 or closed_angle > 180:
                 raise ResponseValueError(f'angles: {opened_angle}, {closed_angle}')
-            calib_data = CalibrationData(motorID=motor_id, openedAngle=opened_angle, closedAngle=closed_angle)
+            calib_data = CalibrationData(motorID=_MOTOR_IDS[str(i - 1)], openedAngle=opened_angle, closedAngle=closed_angle)
             data.append(calib_data)
     
     return Response(type=type_, data=data)
 
 
+_parse_response_cached = lru_cache(maxsize=RESPONSE_CACHE_SIZE)(_parse_response)
+
+def _format_response(response):
+    string = response.type.value
+    if response.type == ResponseType.EXEC_FINISH:
+        string += ',' + str(response.data)[:-1]
+    elif response.type == ResponseType.CALIB_DATA:
+        string += ''.join(f',{c.openedAngle} {c.closedAngle}' for c in response.data)
+    return string + '\n'
+
+
+class AsciiCodec:
+    """Исходный текстовый протокол: одна команда -- одна строка через запятую."""
+
+    name = 'ascii'
+    # Пустая строка: выталкивает из строкового буфера устройства остатки
+    # недописанной или испорченной команды.
+    LINE_FLUSH = b'\n'
+
+    @staticmethod
+    def find_frame(data, start=0):
+        """Длина целого кадра, начинающегося в data[start], или 0, если он не дошёл."""
+        end = data.find(b'\n', start)
+        return end + 1 - start if end != -1 else 0
+
+    @classmethod
+    def encode_command(cls, command):
+        return command.encode(cls)
+
+    @staticmethod
+    def _encode_command(command):
+        return str(command).encode('ascii')
+
+    @staticmethod
+    def decode_command(frame):
+        return Command.from_str(str(frame, 'ascii'))
+
+    @staticmethod
+    def encode_response(response):
+        return _format_response(response).encode('ascii')
+
+    @staticmethod
+    def decode_response(frame):
+        return parse_response(str(frame, 'ascii'))
+
+
+def split_frames(buffer, codec):
+    """Вынимает из bytearray все целые кадры разом.
+
+    Буфер сдвигается один раз на всю пачку, а не после каждого кадра;
+    хвост недошедшего кадра остаётся в нём. Байты, с которых кадр начаться
+    не может (find_frame вернул отрицательное), выбрасываются по одному,
+    пока не найдётся начало следующего кадра.
+    """
+    frames = []
+    pos = 0
+    while True:
+        frame_length = codec.find_frame(buffer, pos)
+        if not frame_length:
+            break
+        if frame_length < 0:
+            pos += 1
+            continue
+        frames.append(bytes(buffer[pos:pos + frame_length]))
+        pos += frame_length
+    if pos:
+        del buffer[:pos]
+    return frames
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) if crc & 0x80 else (crc << 1)
+        table.append(crc & 0xFF)
+    return bytes(table)
+
+
+_CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, crc=0):
+    """CRC-8 (полином 0x07)."""
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def encode_varint(value, out):
+    """Дописывает в out беззнаковое LEB128-представление value."""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(data, pos=0):
+    values = []
+    value = shift = 0
+    for byte in data[pos:]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise CommandFormatError(f'truncated varint: {bytes(data)!r}')
+    return values
+
+
+def _command_from_ints(cmdtype, args):
+    """Собирает Command из числовых аргументов с теми же проверками, что и from_str."""
+    arity = _BINARY_ARITY.get(cmdtype, 0)
+    if len(args) != arity:
+        raise CommandFormatError(f'{cmdtype}: {args}')
+
+    if cmdtype == CommandType.SAVE_PROGRAM:
+        loop_data = LoopData(*args)
+        if loop_data.beginMark > loop_data.endMark + 1:
+            raise CommandValueError(str(loop_data))
+        return Command(cmdtype, loop_data)
+    if cmdtype == CommandType.CALIBRATE:
+        motor_id, opened_angle, closed_angle = args
+        if str(motor_id) not in _MOTOR_IDS:
+            raise CommandValueError(f'{cmdtype}: {motor_id}')
+        if opened_angle > 180 or closed_angle > 180:
+            raise CommandValueError(f'angles: {opened_angle}, {closed_angle}')
+        return Command(cmdtype, CalibrationData(_MOTOR_IDS[str(motor_id)], opened_angle, closed_angle))
+    if cmdtype == CommandType.SET_FLAP:
+        if str(args[0]) not in _FLAP_STATUSES:
+            raise CommandValueError(f'{cmdtype}: {args[0]}')
+        return Command(cmdtype, _FLAP_STATUSES[str(args[0])])
+    if cmdtype == CommandType.SET_FILTER:
+        if str(args[0]) not in _FILTER_STATES:
+            raise CommandValueError(f'{cmdtype}: {args[0]}')
+        return Command(cmdtype, _FILTER_STATES[str(args[0])])
+    if cmdtype == CommandType.WAIT:
+        return Command(cmdtype, args[0])
+    return Command(cmdtype)
+
+
+_BINARY_ARITY = {
+    CommandType.SET_FLAP: 1,
+    CommandType.SET_FILTER: 1,
+    CommandType.WAIT: 1,
+    CommandType.SAVE_PROGRAM: 3,
+    CommandType.CALIBRATE: 3,
+}
+
+
+class BinaryCodec:
+    """Компактный двоичный протокол.
+
+    Кадр: ``[длина][код][varint-аргументы...][CRC-8]``, где длина считает
+    байты кода и аргументов, а CRC-8 берётся по длине и им же. Код -- это
+    ASCII-символ команды или ответа из текстового протокола.
+
+    Маркера начала кадра нет, поэтому после испорченного байта длины поток
+    восстанавливается по CRC: кадр с неверной суммой или невозможной длиной
+    -- это мусорный байт, и поиск начинается со следующего.
+    """
+
+    name = 'binary'
+    # Разделителя строк нет, и любой байт здесь устройство приняло бы за длину.
+    LINE_FLUSH = b''
+    # Самый длинный кадр -- CALIB_DATA: код и десять углов по два байта.
+    MAX_PAYLOAD = 32
+
+    @classmethod
+    def find_frame(cls, data, start=0):
+        """Длина кадра в data[start]; 0, если он не дошёл; -1, если это мусор."""
+        if len(data) <= start:
+            return 0
+        length = data[start]
+        if not 1 <= length <= cls.MAX_PAYLOAD:
+            return -1
+        end = start + length + 1
+        if len(data) <= end:
+            return 0
+        if crc8(memoryview(data)[start:end]) != data[end]:
+            return -1
+        return length + 2
+
+    @staticmethod
+    def _frame(payload):
+        frame = bytearray((len(payload),))
+        frame += payload
+        frame.append(crc8(frame))
+        return bytes(frame)
+
+    @staticmethod
+    def _payload(frame, error):
+        if len(frame) < 3 or len(frame) != frame[0] + 2:
+            raise error(repr(bytes(frame)))
+        if crc8(frame[:-1]) != frame[-1]:
+            raise ChecksumError(repr(bytes(frame)))
+        return frame[1:-1]
+
+    @staticmethod
+    def _command_payload(command, out):
+        out.append(ord(command.type.value))
+        arg = command.arg
+        if command.type == CommandType.SET_FLAP or command.type == CommandType.SET_FILTER:
+            encode_varint(int(arg.value), out)
+        elif command.type == CommandType.WAIT:
+            encode_varint(arg, out)
+        elif command.type == CommandType.SAVE_PROGRAM:
+            for value in arg:
+                encode_varint(value, out)
+        elif command.type == CommandType.CALIBRATE:
+            encode_varint(int(arg.motorID.value), out)
+            encode_varint(arg.openedAngle, out)
+            encode_varint(arg.closedAngle, out)
+        return out
+
+    @staticmethod
+    def _parse_command_payload(payload):
+        cmdtype = _COMMAND_TYPES.get(chr(payload[0]))
+        if cmdtype is None:
+            raise CommandTypeBadError(chr(payload[0]))
+        return _command_from_ints(cmdtype, decode_varints(payload, 1))
+
+    @classmethod
+    def encode_command(cls, command):
+        return command.encode(cls)
+
+    @classmethod
+    def _encode_command(cls, command):
+        return cls._frame(cls._command_payload(command, bytearray()))
+
+    @classmethod
+    def decode_command(cls, frame):
+        return cls._parse_command_payload(cls._payload(frame, CommandFormatError))
+
+    @classmethod
+    def encode_response(cls, response):
+        payload = bytearray((ord(response.type.value),))
+        if response.type == ResponseType.EXEC_FINISH:
+            cls._command_payload(response.data, payload)
+        elif response.type == ResponseType.CALIB_DATA:
+            for calib_data in response.data:
+                encode_varint(calib_data.openedAngle, payload)
+                encode_varint(calib_data.closedAngle, payload)
+        return cls._frame(payload)
+
+    @classmethod
+    def decode_response(cls, frame):
+        payload = cls._payload(frame, ResponseFormatError)
+        type_ = _RESPONSE_TYPES.get(chr(payload[0]))
+        if type_ is None:
+            raise ResponseTypeBadError(chr(payload[0]))
+        data = None
+
+        if type_ == ResponseType.EXEC_FINISH:
+            if len(payload) < 2:
+                raise ResponseFormatError(repr(bytes(frame)))
+            try:
+                data = cls._parse_command_payload(payload[1:])
+            except (CommandTypeBadError, CommandFormatError, CommandValueError) as e:
+                raise ResponseValueError(f'{bytes(frame)!r}: {str(e)}')
+        elif type_ == ResponseType.CALIB_DATA:
+            try:
+                angles = decode_varints(payload, 1)
+            except CommandFormatError as e:
+                raise ResponseFormatError(str(e))
+            if len(angles) != 2 * len(MotorID):
+                raise ResponseFormatError(repr(bytes(frame)))
+            if any(angle > 180 for angle in angles):
+                raise ResponseValueError(f'angles: {angles}')
+            data = [CalibrationData(motorID=_MOTOR_IDS[str(i)], openedAngle=angles[2 * i], closedAngle=angles[2 * i + 1])
+                    for i in range(len(MotorID))]
+        elif len(payload) != 1:
+            raise ResponseFormatError(repr(bytes(frame)))
+
+        return Response(type=type_, data=data)
+
+
+ASCII_CODEC = AsciiCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS = {codec.name: codec for codec in (ASCII_CODEC, BINARY_CODEC)}
+DEFAULT_CODEC = ASCII_CODEC
+
+
 if __name__ == '__main__':
     import json
 
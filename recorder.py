@@ -0,0 +1,406 @@
+"""Запись трафика порта и его воспроизведение.
+
+Файл записи дописывается только в конец::
+
+    MAGIC
+    запись*: тип (1 байт), varint dt, varint длина, байты
+
+Тип ``S`` открывает сеанс: dt -- время начала по часам стены, мс, а
+байты -- имя кодека. У ``>`` (ушло в порт) и ``<`` (пришло из порта) dt --
+микросекунды от предыдущей записи по монотонным часам. Так что запись в
+сотни килобайт остаётся компактной, а порядок и интервалы -- точными.
+
+Воспроизведение::
+
+    python recorder.py capture.pofscap           # прогнать через ProtocolSession
+    python recorder.py capture.pofscap --dump    # показать переписку
+"""
+
+import os
+import time
+from collections import namedtuple
+
+from protocol import *
+
+
+MAGIC = b'POFSCAP\x01'
+
+SESSION = b'S'[0]
+TX = b'>'[0]
+RX = b'<'[0]
+
+# time -- секунды от начала сеанса.
+TrafficEvent = namedtuple('TrafficEvent', 'session time direction data')
+
+
+class CaptureFormatError(ValueError):
+    pass
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise CaptureFormatError('truncated varint')
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+class TrafficRecorder:
+    """Пишет байты порта с отметками времени; каждый open -- новый сеанс."""
+
+    def __init__(self, filename, codec=DEFAULT_CODEC):
+        self.filename = filename
+        new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self.file = open(filename, 'ab')
+        if new:
+            self.file.write(MAGIC)
+        self.__last = time.monotonic()
+        self.__buffer = bytearray()
+        self.__append(SESSION, int(time.time() * 1000), codec.name.encode('ascii'))
+
+    def __append(self, kind, dt, data):
+        out = self.__buffer
+        out.append(kind)
+        encode_varint(dt, out)
+        encode_varint(len(data), out)
+        out += data
+
+    def __record(self, kind, data):
+        if not data:
+            return
+        now = time.monotonic()
+        self.__append(kind, int((now - self.__last) * 1_000_000), data)
+        self.__last = now
+        # Пишем сразу: запись нужна как раз тогда, когда приложение падает.
+        self.file.write(self.__buffer)
+        self.file.flush()
+        self.__buffer.clear()
+
+    def record_tx(self, data):
+        self.__record(TX, data)
+
+    def record_rx(self, data):
+        self.__record(RX, data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write(self.__buffer)
+        self.__buffer.clear()
+        self.file.close()
+
+
+def read_capture(filename):
+    """Возвращает (список TrafficEvent, {номер сеанса: кодек})."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise CaptureFormatError(f'{filename}: not a traffic capture')
+
+    events = []
+    codecs = {}
+    session = -1
+    elapsed = 0
+    pos = len(MAGIC)
+    while pos < len(data):
+        kind = data[pos]
+        dt, pos = _read_varint(data, pos + 1)
+        length, pos = _read_varint(data, pos)
+        payload = data[pos:pos + length]
+        if len(payload) < length:
+            # Недописанный хвост после аварийного завершения.
+            break
+        pos += length
+        if kind == SESSION:
+            session += 1
+            elapsed = 0
+            codecs[session] = CODECS.get(payload.decode('ascii', 'replace'), DEFAULT_CODEC)
+        elif kind == TX or kind == RX:
+            if session < 0:
+                raise CaptureFormatError('traffic before session start')
+            elapsed += dt
+            events.append(TrafficEvent(session, elapsed / 1_000_000, kind, payload))
+        else:
+            raise CaptureFormatError(f'unknown record type {kind!r}')
+    return events, codecs
+
+
+def replay(events, process_packets, codec=DEFAULT_CODEC, speed=None, on_write=None, sleep=time.sleep):
+    """Подаёт принятые байты в process_packets кадрами, как это делает SerialPort.
+
+    ``speed=None`` -- без пауз, иначе интервалы записи делятся на speed.
+    Отправленные хостом байты передаются в on_write, если он задан.
+    """
+    rx = bytearray()
+    started = time.monotonic()
+    for event in events:
+        if speed is not None:
+            delay = event.time / speed - (time.monotonic() - started)
+            if delay > 0:
+                sleep(delay)
+        if event.direction == TX:
+            if on_write is not None:
+                on_write(event.data)
+            continue
+        rx += event.data
+        frames = split_frames(rx, codec)
+        if frames:
+            process_packets(frames)
+
+
+# Повтор команды хостом по таймауту.
+RETRY = b'R'[0]
+
+
+def script(events, codec=DEFAULT_CODEC):
+    """Режет переписку на кадры хоста и куски от устройства.
+
+    Возвращает список (направление, байты, Command или None). Кадр,
+    совпавший с предыдущим отправленным, когда устройство не успело
+    прислать на тот оба ответа, -- это повтор по таймауту (RETRY). Внутри
+    загрузки так не считается: там окно шлёт одинаковые шаги подряд.
+    """
+    result = []
+    tx = bytearray()
+    rx = bytearray()
+    last = None
+    replies = 0
+    loading = False
+    for event in events:
+        if event.direction == RX:
+            result.append((RX, event.data, None))
+            rx += event.data
+            replies += len(split_frames(rx, codec))
+            continue
+        tx += event.data
+        for frame in split_frames(tx, codec):
+            try:
+                command = codec.decode_command(frame)
+            except ValueError:
+                command = None
+            if command is not None and command.type == CommandType.LOADING_MODE:
+                loading = True
+            if frame == last and replies < 2 and not loading:
+                result.append((RETRY, frame, command))
+            else:
+                result.append((TX, frame, command))
+            if command is not None and command.type == CommandType.SAVE_PROGRAM:
+                loading = False
+            last = frame
+            replies = 0
+    return result
+
+
+class ReplayPort:
+    """Подменяет SerialPort: отвечает хосту так, как отвечало устройство.
+
+    Каждый ``write`` сверяется с очередным кадром, отправленным в записи,
+    а ``deliver_rx`` отдаёт в ``app.process_packets`` всё, что устройство
+    прислало до следующей отправки. Как и настоящий порт, write ничего не
+    доставляет сам: ``post(callback)`` откладывает доставку (например,
+    ``QTimer.singleShot(0, ...)``), а без него deliver_rx зовёт владелец.
+    На повторе из записи доставка останавливается: хост должен сам
+    повторить команду, дождавшись своего таймаута. ``expire`` позволяет не
+    ждать -- вызывается вместо таймаута. Расхождения копятся в ``mismatches``.
+    """
+
+    def __init__(self, app, events, codec=DEFAULT_CODEC, post=None, expire=None):
+        self.app = app
+        self.post = post
+        self.expire = expire
+        self.codec = codec
+        self.bytes_per_second = None
+        self.baud_rate = 9600
+        self.mismatches = []
+        self.script = script(events, codec)
+        self.pos = 0
+        self.__rx = bytearray()
+
+    def is_open(self):
+        return True
+
+    def close(self):
+        pass
+
+    @property
+    def exhausted(self):
+        return self.pos >= len(self.script)
+
+    def deliver_rx(self):
+        """Отдаёт принятое от устройства до ближайшей отправки хоста."""
+        while self.pos < len(self.script):
+            direction, data, _ = self.script[self.pos]
+            if direction == RX:
+                self.pos += 1
+                self.__rx += data
+                frames = split_frames(self.__rx, self.codec)
+                if frames:
+                    self.app.process_packets(frames)
+            elif direction == RETRY and self.expire is not None:
+                pos = self.pos
+                self.expire()
+                if self.pos == pos:
+                    break  # хост повторять не стал
+            else:
+                break
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        recorded = None
+        if self.pos < len(self.script):
+            recorded = self.script[self.pos][1]
+            self.pos += 1
+        if recorded != data:
+            self.mismatches.append((data, recorded))
+        if self.post is not None:
+            self.post(self.deliver_rx)
+
+
+def upload_window(events, codec=DEFAULT_CODEC):
+    """Окно загрузки, с которым работал хост: сколько кадров он слал, не дождавшись ответа.
+
+    Окном идут загрузка алгоритма и прошивка калибровки.
+    """
+    window = 1
+    run = None
+    for direction, _, command in script(events, codec):
+        if direction == RX:
+            if run is not None:
+                window = max(window, run)
+            run = None
+        elif run is not None:
+            run += 1
+        elif command is not None and command.type in (CommandType.LOADING_MODE, CommandType.CALIBRATE):
+            run = 1
+    return window
+
+
+def host_dialogs(events, codec=DEFAULT_CODEC):
+    """Восстанавливает по отправленным кадрам, какие диалоги запускал хост.
+
+    Выдаёт ('algorithm', (before, loop, after, loop_times)),
+    ('calibration', (known, calibration)) или ('command', Command).
+    Прошивка калибровки шлёт только изменившиеся моторы, поэтому known --
+    калибровка, которую хост считал прошитой (None -- неизвестна): с ней
+    send_calibration отправит те же моторы. Углы неотправленных моторов в
+    записи не видны, на их месте одинаковые заглушки.
+    """
+    commands = [command for direction, _, command in script(events, codec)
+                if direction == TX and command is not None]
+
+    i = 0
+    while i < len(commands):
+        command = commands[i]
+        if command.type == CommandType.LOADING_MODE:
+            j = i + 1
+            while j < len(commands) and commands[j].type in (
+                    CommandType.SET_FLAP, CommandType.SET_FILTER, CommandType.WAIT):
+                j += 1
+            if j < len(commands) and commands[j].type == CommandType.SAVE_PROGRAM:
+                steps = commands[i + 1:j]
+                begin, end, loop_times = commands[j].arg
+                yield 'algorithm', (steps[:begin - 1], steps[begin - 1:end], steps[end:], loop_times)
+                i = j + 1
+                continue
+        if command.type == CommandType.CALIBRATE:
+            j = i
+            sent = {}
+            while j < len(commands) and commands[j].type == CommandType.CALIBRATE:
+                calib_data = commands[j].arg
+                motor = int(calib_data.motorID.value)
+                if motor in sent or (sent and motor < max(sent)):
+                    break  # моторы идут по порядку и по разу, значит, это не один диалог
+                sent[motor] = [calib_data.openedAngle, calib_data.closedAngle]
+                j += 1
+            if j < len(commands) and commands[j].type == CommandType.SAVE_CALIBRATION:
+                placeholder = [0, 0]
+                calibration = [sent.get(i, placeholder) for i in range(len(MotorID))]
+                known = None
+                if len(sent) < len(MotorID):
+                    known = [None if i in sent else placeholder for i in range(len(MotorID))]
+                yield 'calibration', (known, calibration)
+                i = j + 1
+                continue
+        yield 'command', command
+        i += 1
+
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+
+    from session import ProtocolSession, SessionListener
+
+    parser = argparse.ArgumentParser(description='Replay a POFS traffic capture')
+    parser.add_argument('capture')
+    parser.add_argument('--session', type=int, default=None, help='replay only this session')
+    parser.add_argument('--dump', action='store_true', help='print the transcript instead of replaying')
+    parser.add_argument('--repeat', type=int, default=1, help='replay N times for benchmarking')
+    args = parser.parse_args()
+
+    events, codecs = read_capture(args.capture)
+    sessions = sorted(codecs) if args.session is None else [args.session]
+
+    if args.dump:
+        for event in events:
+            if event.session in sessions:
+                arrow = '->' if event.direction == TX else '<-'
+                print(f'[{event.session}] {event.time:10.6f} {arrow} {event.data!r}')
+        raise SystemExit
+
+    class Transcript(SessionListener):
+        """Заменяет App: собирает сообщения и передаёт кадры сессии."""
+
+        def __init__(self):
+            self.messages = []
+            self.session = None
+
+        def on_message(self, msg, timeout=2000):
+            self.messages.append(msg)
+
+        def process_packets(self, frames):
+            self.session.feed_many(frames)
+
+    # Кадры сессии здесь только мешают и сбивают замер.
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    for number in sessions:
+        session_events = [e for e in events if e.session == number]
+        codec = codecs[number]
+        dialogs = list(host_dialogs(session_events, codec))
+        window = upload_window(session_events, codec)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            listener = Transcript()
+            port = ReplayPort(listener, session_events, codec)
+            target = listener.session = ProtocolSession(port.write, codec, listener=listener)
+            port.expire = target.expire_deadline
+            target.upload_window = window
+            for kind, payload in dialogs:
+                if kind == 'algorithm':
+                    target.send_algorithm(*payload)
+                elif kind == 'calibration':
+                    target.calibration, calibration = payload
+                    target.send_calibration(calibration)
+                elif payload.type == CommandType.EMERGENCY and target.device_is_executing:
+                    target.send_reset()
+                else:
+                    target.send_command(payload)
+                port.deliver_rx()
+                if target.busy:
+                    # Устройство тогда так и не ответило: хост сдался по таймауту.
+                    target.expire_deadline()
+                    port.deliver_rx()
+        elapsed = (time.perf_counter() - started) / args.repeat
+        print(f'session {number} ({codec.name}): {len(session_events)} events, '
+              f'{len(dialogs)} dialogs, window {window}, replayed in {elapsed * 1000:.2f} ms')
+        for msg in listener.messages:
+            print(f'  {msg}')
+        for sent, recorded in port.mismatches:
+            print(f'  host sent {sent!r}, capture has {recorded!r}')
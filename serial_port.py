@@ -1,7 +1,30 @@
+import time
+from collections import deque, namedtuple
 from enum import IntEnum
 
 from PyQt5.QtSerialPort import QSerialPort, QSerialPortInfo
-from PyQt5.QtCore import QIODevice
+from PyQt5.QtCore import QIODevice, QTimer, QThread, pyqtSignal
+
+from protocol import Command, CommandType, ResponseType, DEFAULT_CODEC, split_frames
+
+
+DEFAULT_BAUD_RATE = 9600
+SUPPORTED_BAUD_RATES = (9600, 19200, 38400, 57600, 115200)
+# Сколько байт держать в очереди QSerialPort; остальное ждёт у нас.
+# Аварийный стоп встаёт за этой очередью, так что её размер -- это и
+# худшая задержка стопа: 256 байт на 9600 бод -- около четверти секунды.
+DEFAULT_HIGH_WATER = 256
+# Сколько линия должна молчать после пустой строки перед пробным запросом, мс.
+PROBE_FLUSH_WAIT = 50
+# Как часто перечитывать список портов, мс.
+PORT_POLL_INTERVAL = 500
+
+# Больше QTimer не примет (C int, мс): около 24.8 суток. Более дальний срок
+# таймер отмеряет частями -- on_timeout перезаводит его на остаток.
+MAX_TIMER_INTERVAL = 2 ** 31 - 1
+
+# vid и pid -- None, если драйвер их не сообщает.
+PortInfo = namedtuple('PortInfo', 'name serial_number vid pid description')
 
 
 class SerialPort:
@@ -15,56 +38,286 @@ class SerialPort:
         WRITING_ERROR = 3
         NO_PACKET = 4
 
-    def __init__(self, app):
+    def __init__(self, app, baud_rate=DEFAULT_BAUD_RATE):
         self.app = app
         self.port = QSerialPort()
-        self.port.setBaudRate(9600)
+        self.port.setBaudRate(baud_rate)
         self.port.readyRead.connect(self.__on_byte_recv_callback)
+        self.port.bytesWritten.connect(self.__on_bytes_written)
+        self.__probing = False
+        self.__rx = bytearray()
+        # Кадры, ждущие места в очереди порта. Режутся только по границам
+        # кадров, чтобы при аварийном стопе их можно было выбросить целиком.
+        self.__pending = deque()
+        self.high_water = DEFAULT_HIGH_WATER
+        # Вызывается, когда всё записанное ушло в линию.
+        self.on_drained = None
+        self.codec = DEFAULT_CODEC
+        # Измеренная пропускная способность линии (байт/с), если известна.
+        self.bytes_per_second = None
+        # TrafficRecorder, если переписку с устройством надо записывать.
+        self.recorder = None
+        # Вызывается, когда открытый порт пропал (выдернули кабель).
+        self.on_lost = None
+        self.port.errorOccurred.connect(self.__on_error)
+
+    @property
+    def baud_rate(self):
+        return self.port.baudRate()
 
-    def open(self, port_name):
+    def set_baud_rate(self, baud_rate):
+        return self.port.setBaudRate(baud_rate)
+
+    def open(self, port_name, baud_rate=None, probe=False):
+        """Открывает порт.
+
+        При ``probe=True`` перебирает скорости от большей к меньшей и
+        останавливается на первой, на которой устройство отвечает.
+        """
         self.port.setPortName(port_name)
-        return self.port.open(QIODevice.ReadWrite)
+        if baud_rate is not None:
+            self.set_baud_rate(baud_rate)
+        self.bytes_per_second = None
+        if not self.port.open(QIODevice.ReadWrite):
+            return False
+        if probe:
+            self.probe_baud_rate()
+        return True
+
+    def probe_baud_rate(self, baud_rates=SUPPORTED_BAUD_RATES, timeout_ms=300):
+        self.__probing = True
+        try:
+            for baud_rate in sorted(baud_rates, reverse=True):
+                self.set_baud_rate(baud_rate)
+                throughput = self.__probe_round_trip(timeout_ms)
+                if throughput is not None:
+                    self.bytes_per_second = throughput
+                    return baud_rate
+            self.set_baud_rate(DEFAULT_BAUD_RATE)
+            return DEFAULT_BAUD_RATE
+        finally:
+            self.__probing = False
+
+    def __probe_round_trip(self, timeout_ms):
+        """Гоняет PRINT_CALIBRATION и возвращает байт/с или None."""
+        self.port.clear()
+        self.__rx.clear()
+        flush = self.codec.LINE_FLUSH
+        if flush:
+            # Мусор, принятый устройством на прошлой скорости, ждёт конца строки и
+            # испортил бы запрос. Пустая строка его выталкивает; ответ на неё (если
+            # он есть) не нужен -- читаем, пока линия не замолчит, -- и в запись
+            # переписки она не попадает.
+            deadline = time.perf_counter() + timeout_ms / 1000
+            if self.port.write(flush) == -1 or not self.port.waitForBytesWritten(timeout_ms):
+                return None
+            while self.port.waitForReadyRead(PROBE_FLUSH_WAIT):
+                self.port.readAll()
+                if time.perf_counter() > deadline:
+                    return None  # устройство не умолкает -- скорость не та
+        request = self.codec.encode_command(Command(CommandType.PRINT_CALIBRATION))
+        started = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.record_tx(request)
+        if self.port.write(request) == -1 or not self.port.waitForBytesWritten(timeout_ms):
+            return None
+
+        received = 0
+        got = set()
+        while got != {ResponseType.PARSING_OK, ResponseType.CALIB_DATA}:
+            if time.perf_counter() - started > timeout_ms / 1000:
+                return None
+            if not self.port.waitForReadyRead(timeout_ms):
+                return None
+            self.__receive()
+            for frame in split_frames(self.__rx, self.codec):
+                received += len(frame)
+                try:
+                    got.add(self.codec.decode_response(frame).type)
+                except ValueError:
+                    # Мусор на неподходящей скорости.
+                    return None
+
+        elapsed = time.perf_counter() - started
+        return (len(request) + received) / elapsed
 
     def is_open(self):
         return self.port.isOpen()
 
     def close(self):
         self.port.close()
+        self.__rx.clear()
+        self.__pending.clear()
 
-    def __packet_ready(self):
-        return self.port.canReadLine()
+    def __receive(self):
+        data = self.port.readAll().data()
+        if self.recorder is not None:
+            self.recorder.record_rx(data)
+        self.__rx += data
 
     def __on_byte_recv_callback(self):
-        if self.__packet_ready():
-            self.app.process_packet()
-
-    def read(self):
-        status = SerialPort.ErrorStatus.NO_PACKET
-        reply = '\n'
+        if self.__probing:
+            return
+        self.__receive()
+        frames = split_frames(self.__rx, self.codec)
+        if frames:
+            self.app.process_packets(frames)
 
-        if self.__packet_ready():
-            raw_reply = self.port.readLine()
+    def write(self, data):
+        if isinstance(data, str):
             try:
-                reply = str(raw_reply, 'ascii')
-            except UnicodeDecodeError:
-                reply = '\n'
-                status = SerialPort.ErrorStatus.DECODING_ERROR
-            else:
-                status = SerialPort.ErrorStatus.OK
+                data = data.encode('ascii')
+            except UnicodeEncodeError:
+                return SerialPort.ErrorStatus.ENCODING_ERROR
+        return self.write_many((data,))
 
-        return status, reply
+    def write_many(self, frames):
+        """Пишет пачку готовых кадров одним куском, в том же порядке."""
+        self.__pending.extend(frames)
+        return self.__flush_pending()
 
-    def write(self, data: str):
-        status = SerialPort.ErrorStatus.OK
-        try:
-            data = data.encode('ascii')
-        except UnicodeEncodeError:
-            status = SerialPort.ErrorStatus.ENCODING_ERROR
-        else:
-            if self.port.write(data) == -1:
-                status = SerialPort.ErrorStatus.WRITING_ERROR
+    def write_urgent(self, data):
+        """Пишет кадр вне очереди: всё, что ещё ждёт у нас, выбрасывается.
+
+        Байты, уже отданные QSerialPort, не трогаются -- среди них может
+        быть начало кадра, и обрезанный кадр испортил бы этот.
+        """
+        self.__pending.clear()
+        status = self.__write_now(data)
+        self.port.flush()
         return status
 
-    @staticmethod
-    def get_available_ports():
-        return [p.portName() for p in QSerialPortInfo().availablePorts()]
+    @property
+    def backlog(self):
+        """Сколько байт ещё не ушло в линию."""
+        return self.port.bytesToWrite() + sum(map(len, self.__pending))
+
+    def __flush_pending(self):
+        queued = self.port.bytesToWrite()
+        room = self.high_water - queued
+        batch = []
+        while self.__pending and (len(self.__pending[0]) <= room or not batch and not queued):
+            frame = self.__pending.popleft()
+            room -= len(frame)
+            batch.append(frame)
+        return self.__write_now(b''.join(batch))
+
+    def __write_now(self, data):
+        if not data:
+            return SerialPort.ErrorStatus.OK
+        if self.port.write(data) == -1:
+            return SerialPort.ErrorStatus.WRITING_ERROR
+        if self.recorder is not None:
+            self.recorder.record_tx(data)
+        return SerialPort.ErrorStatus.OK
+
+    def __on_error(self, error):
+        if error == QSerialPort.ResourceError and self.port.isOpen():
+            self.close()
+            if self.on_lost is not None:
+                self.on_lost()
+
+    def __on_bytes_written(self, _count):
+        # Очередь порта освобождается -- доливаем из своей до high_water.
+        if self.__pending:
+            self.__flush_pending()
+        if not self.__pending and self.port.bytesToWrite() == 0 and self.on_drained is not None:
+            self.on_drained()
+
+
+def list_ports():
+    return [
+        PortInfo(
+            p.portName(),
+            p.serialNumber(),
+            p.vendorIdentifier() if p.hasVendorIdentifier() else None,
+            p.productIdentifier() if p.hasProductIdentifier() else None,
+            p.description(),
+        )
+        for p in QSerialPortInfo.availablePorts()
+    ]
+
+
+def device_key(info):
+    """По чему узнать устройство, на каком бы порту оно ни появилось."""
+    if info.serial_number:
+        return f'sn:{info.serial_number}'
+    if info.vid is not None:
+        return f'{info.vid:04x}:{info.pid:04x}'
+    return info.name
+
+
+def is_unique_key(key):
+    """Ключ по серийному номеру: такой только у одного устройства.
+
+    VID:PID общий у всех плат одной модели, имя порта -- у всего, что в
+    него воткнули.
+    """
+    return key is not None and key.startswith('sn:')
+
+
+class PortMonitor(QThread):
+    """Следит за портами в фоновом потоке.
+
+    Список перечитывается раз в ``interval`` мс, не занимая поток GUI;
+    ``ports_changed`` приходит (в поток владельца), только когда список
+    изменился, а последний список всегда лежит в ``ports``.
+    """
+
+    ports_changed = pyqtSignal(list)
+
+    def __init__(self, interval=PORT_POLL_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.interval = interval
+        self.ports = []
+        # Подключаемся первыми, чтобы остальные получатели уже видели новый ports.
+        self.ports_changed.connect(self.__update)
+
+    def __update(self, ports):
+        self.ports = ports
+
+    def matches(self, key):
+        return [info for info in self.ports if device_key(info) == key]
+
+    def find(self, key, port_name=None):
+        """Порт устройства с ключом key; None, если его нет или не понять, какой.
+
+        Ключ без серийного номера бывает у нескольких устройств: тогда годится
+        только прежний порт port_name или единственный подходящий.
+        """
+        candidates = self.matches(key)
+        if not candidates:
+            return None
+        if is_unique_key(key) or len(candidates) == 1:
+            return candidates[0]
+        return next((info for info in candidates if info.name == port_name), None)
+
+    def run(self):
+        last = None
+        while not self.isInterruptionRequested():
+            ports = list_ports()
+            if ports != last:
+                last = ports
+                self.ports_changed.emit(ports)
+            self.msleep(self.interval)
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+
+class ResponseTimer:
+    """Однократный QTimer для сроков ответа ProtocolSession."""
+
+    def __init__(self):
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+
+    def connect(self, callback):
+        self.timer.timeout.connect(callback)
+
+    def arm(self, delay):
+        if delay is None:
+            self.timer.stop()
+        else:
+            self.timer.start(min(max(int(delay * 1000), 0), MAX_TIMER_INTERVAL))
@@ -0,0 +1,269 @@
+"""Порт и протокольная сессия в отдельном потоке.
+
+GUI не трогает ни SerialPort, ни ProtocolSession: его запросы уходят в
+поток воркера через очередь событий Qt (сигнал с queued-соединением), а
+события сессии возвращаются сигналами же. Перерисовки, модальные
+QFileDialog и прочая нагрузка на поток GUI не задерживают ни разбор
+ответов, ни окно загрузки, ни сроки ответа.
+
+Все публичные методы ``SessionWorker`` можно звать из любого потока: они
+только ставят работу в очередь воркера.
+"""
+
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+
+from serial_port import SerialPort, ResponseTimer
+from session import ProtocolSession, SessionListener, DEFAULT_UPLOAD_WINDOW
+from metrics import SessionMetrics, render, write_rendered, METRICS_FILENAME
+from recorder import TrafficRecorder
+from timeline import format_duration, SERVO_SETTLE_TIME
+from protocol import *
+
+
+log = logging.getLogger(__name__)
+
+# Чем открыт порт; bytes_per_second -- None, если скорость не замерялась.
+PortStatus = namedtuple('PortStatus', 'port_name ok baud_rate bytes_per_second')
+
+# Сколько ещё ждать сверх времени передачи недописанного, прежде чем
+# закрыть порт без него, с.
+DRAIN_MARGIN = 0.5
+# Файл метрик переписывается не чаще, мс.
+METRICS_WRITE_INTERVAL = 2000
+
+
+class SessionWorker(QObject, SessionListener):
+    message = pyqtSignal(str, int)
+    executing = pyqtSignal(bool)
+    calibration_read = pyqtSignal(object)
+    # Калибровка, которая известна в устройстве (или None), после каждого
+    # диалога.
+    calibration_known = pyqtSignal(object)
+    dialog_finished = pyqtSignal(bool)
+    emergency_stopped = pyqtSignal(float)
+    port_opened = pyqtSignal(object)  # PortStatus
+    # Порт пропал: скорость, на которой работали, и был ли загружен алгоритм.
+    port_lost = pyqtSignal(int, bool)
+    summary = pyqtSignal(str)
+
+    __invoke = pyqtSignal(object)
+
+    def __init__(self, high_water=None, settle_time=SERVO_SETTLE_TIME, metrics_file=METRICS_FILENAME,
+                 upload_window=DEFAULT_UPLOAD_WINDOW):
+        super().__init__()
+        self.high_water = high_water
+        self.settle_time = settle_time
+        self.upload_window = upload_window
+        self.metrics_file = metrics_file
+        self.serial = None
+        self.session = None
+        self.response_timer = None
+        self.metrics_timer = None
+        # Поток воркера -- с наивысшим приоритетом, и ждать диска ему незачем.
+        self.__metrics_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pofs-metrics')
+        self._thread = QThread()
+        self.moveToThread(self._thread)
+        self._thread.started.connect(self.__setup)
+        self.__invoke.connect(self.__run)
+
+    def start(self):
+        self._thread.start(QThread.TimeCriticalPriority)
+
+    def stop(self):
+        self._post(self.__teardown)
+        self._thread.wait()
+
+    def _post(self, fn, *args):
+        """Выполнит fn(*args) в потоке воркера."""
+        self.__invoke.emit(lambda: fn(*args))
+
+    def __run(self, fn):
+        fn()
+
+    # --- поток воркера ---
+
+    def __setup(self):
+        # QSerialPort и QTimer принадлежат потоку, в котором созданы.
+        self.serial = SerialPort(self)
+        if self.high_water is not None:
+            self.serial.high_water = self.high_water
+        self.serial.on_lost = self.__on_lost
+        self.response_timer = ResponseTimer()
+        self.session = ProtocolSession(self.serial.write, listener=self, arm_timer=self.response_timer.arm,
+                                       write_many=self.serial.write_many, write_urgent=self.serial.write_urgent)
+        self.response_timer.connect(self.session.on_timeout)
+        self.session.settle_time = self.settle_time
+        self.session.upload_window = self.upload_window
+        self.session.metrics = SessionMetrics()
+        self.metrics_timer = QTimer()
+        self.metrics_timer.setSingleShot(True)
+        self.metrics_timer.setInterval(METRICS_WRITE_INTERVAL)
+        self.metrics_timer.timeout.connect(self.__write_metrics)
+
+    def __teardown(self):
+        self.response_timer.arm(None)
+        self.__when_drained(self.__teardown_now)
+
+    def __teardown_now(self):
+        self.serial.close()
+        self.__stop_capture()
+        if self.metrics_timer.isActive():
+            self.metrics_timer.stop()
+            self.__write_metrics()
+        self.__metrics_writer.shutdown()
+        self._thread.quit()
+
+    def __write_metrics(self):
+        # Снимок -- здесь, где метрики меняются; на диск -- в другом потоке.
+        self.__metrics_writer.submit(write_rendered, render([self.session.metrics]), self.metrics_file)
+
+    def __when_drained(self, fn):
+        """Вызывает fn, когда всё записанное уйдёт в линию.
+
+        QSerialPort.close() выбрасывает недописанное, а там может быть
+        аварийный стоп, нажатый за миг до отключения.
+        """
+        serial = self.serial
+        if not serial.is_open() or not serial.backlog:
+            fn()
+            return
+
+        def drained():
+            if serial.on_drained is not drained:
+                return  # уже вызвано
+            serial.on_drained = None
+            fn()
+
+        serial.on_drained = drained
+        # Линия может и не освободиться (например, держит аппаратный flow control).
+        delay = serial.backlog * 10 / serial.baud_rate + DRAIN_MARGIN
+        QTimer.singleShot(int(delay * 1000), drained)
+
+    def __stop_capture(self):
+        if self.serial.recorder is not None:
+            self.serial.recorder.close()
+            self.serial.recorder = None
+
+    def __open(self, port_name, baud_rate, probe, codec, calibration, capture_file):
+        if self.serial.on_drained is not None:
+            # Прежний порт ещё дописывает перед закрытием -- закрываем сейчас.
+            self.serial.on_drained()
+        self.serial.close()
+        self.serial.codec = codec
+        self.session.codec = codec
+        # После переподключения неизвестно, то же ли это устройство.
+        self.session.invalidate_program()
+        self.__stop_capture()
+        if capture_file:
+            try:
+                self.serial.recorder = TrafficRecorder(capture_file, codec)
+            except OSError as e:
+                log.warning('Capture not started: %s', e)
+        if not self.serial.open(port_name, baud_rate, probe=probe):
+            self.__stop_capture()
+            self.port_opened.emit(PortStatus(port_name, False, 0, None))
+            return
+        if self.session.metrics.port != port_name:
+            self.session.metrics = SessionMetrics(port_name)
+        self.session.baud_rate = self.serial.baud_rate
+        self.session.calibration = None
+        if calibration is not None:
+            self.session.confirm_calibration(calibration)
+        self.port_opened.emit(PortStatus(port_name, True, self.serial.baud_rate, self.serial.bytes_per_second))
+
+    def __close(self):
+        self.__when_drained(self.__close_now)
+
+    def __close_now(self):
+        self.serial.close()
+        self.__stop_capture()
+        self.session.connection_lost()
+        self.session.invalidate_program()
+        self.session.calibration = None
+
+    def __on_lost(self):
+        program_loaded = self.session.last_algorithm_cmd is not None
+        self.session.connection_lost()
+        self.__stop_capture()
+        self.port_lost.emit(self.serial.baud_rate, program_loaded)
+
+    def __drop(self):
+        if self.serial.is_open():
+            self.serial.close()
+            self.__on_lost()
+
+    def __send_command(self, cmd):
+        if not self.serial.is_open():
+            self.message.emit('Порт открой сперва', 2000)
+            return
+        if self.session.send_command(cmd) and cmd.type == CommandType.EXECUTE_PROGRAM:
+            duration = format_duration(self.session.program_duration)
+            self.message.emit(f'Выполнение займёт около {duration}', 5000)
+
+    def __send(self, send, *args):
+        if not self.serial.is_open():
+            self.message.emit('Порт открой сперва', 2000)
+            return
+        send(*args)
+
+    def __clear_metrics(self):
+        self.session.metrics = SessionMetrics(self.session.metrics.port)
+        self.summary.emit(self.session.metrics.summary())
+
+    def process_packets(self, frames):
+        self.session.feed_many(frames)
+
+    def on_message(self, msg, timeout=2000):
+        self.message.emit(msg, timeout)
+
+    def on_executing(self, executing):
+        self.executing.emit(executing)
+
+    def on_calibration(self, calibration):
+        self.calibration_read.emit(calibration)
+
+    def on_dialog_finished(self, ok):
+        self.calibration_known.emit(self.session.calibration)
+        if not self.metrics_timer.isActive():
+            self.metrics_timer.start()
+        self.dialog_finished.emit(ok)
+
+    def on_emergency_stopped(self, latency):
+        self.emergency_stopped.emit(latency)
+
+    # --- запросы из GUI ---
+
+    def open_port(self, port_name, baud_rate=None, probe=False, codec=DEFAULT_CODEC, calibration=None,
+                  capture_file=None):
+        """Результат придёт сигналом port_opened."""
+        self._post(self.__open, port_name, baud_rate, probe, codec, calibration, capture_file)
+
+    def close_port(self):
+        self._post(self.__close)
+
+    def drop_port(self):
+        """Порт исчез из системы: закрыть и сообщить port_lost, как при ошибке."""
+        self._post(self.__drop)
+
+    def send_command(self, cmd):
+        self._post(self.__send_command, cmd)
+
+    def send_reset(self, started=None):
+        self._post(lambda: self.__send(self.session.send_reset, started))
+
+    def send_calibration(self, calibration):
+        self._post(lambda: self.__send(self.session.send_calibration, calibration))
+
+    def send_algorithm(self, before, loop, after, loop_times):
+        self._post(lambda: self.__send(self.session.send_algorithm, before, loop, after, loop_times))
+
+    def request_summary(self):
+        """Сводка метрик придёт сигналом summary."""
+        self._post(lambda: self.summary.emit(self.session.metrics.summary()))
+
+    def clear_metrics(self):
+        self._post(self.__clear_metrics)
@@ -0,0 +1,643 @@
+import hashlib
+import logging
+import time
+from collections import deque
+
+from protocol import *
+from timeline import Timeline, SERVO_SETTLE_TIME, format_duration
+
+
+log = logging.getLogger(__name__)
+
+# Запас на обработку команды контроллером и задержки ОС, с.
+RESPONSE_MARGIN = 0.5
+# Запас на уход часов контроллера, доля длительности программы: на
+# многочасовой программе полсекунды -- ничто.
+EXECUTION_MARGIN = 0.05
+# Сколько байт ответа закладывать в срок доставки (влезает и CALIB_DATA).
+RESPONSE_SIZE_HINT = 48
+MAX_RETRIES = 2
+# Окно загрузки по умолчанию -- stop-and-wait. Окно N означает до N кадров,
+# которые лежат в приёмном буфере UART контроллера, пока он разбирает
+# предыдущий; всё, что в буфер не влезло, теряется. В ядре Arduino этот
+# буфер -- 64 байта, а кадр шага в ASCII не длиннее 13 байт (W,4294967295),
+# то есть 4 кадра влезают, но размер буфера в нашей прошивке не проверен.
+# Поэтому окно больше 1 -- только явно: "upload_window" в настройках
+# приложения или --window у pofs.
+DEFAULT_UPLOAD_WINDOW = 1
+# Команды, повтор которых не меняет итогового состояния устройства. Только
+# вне загрузки: в режиме загрузки любая команда дописывает шаг программы.
+IDEMPOTENT_COMMANDS = frozenset((
+    CommandType.SET_FLAP,
+    CommandType.SET_FILTER,
+    CommandType.CALIBRATE,
+    CommandType.PRINT_CALIBRATION,
+    # Второй стоп остановленному устройству ничего не сделает.
+    CommandType.EMERGENCY,
+))
+# Команды, которые уходят только после ответов на все предыдущие: в EEPROM
+# пишем, лишь убедившись, что все моторы приняли свои углы.
+BARRIER_COMMANDS = frozenset((
+    CommandType.SAVE_CALIBRATION,
+))
+
+
+class SessionListener:
+    """Получатель событий сессии. По умолчанию всё игнорирует."""
+
+    def on_message(self, msg, timeout=2000):
+        pass
+
+    def on_executing(self, executing):
+        pass
+
+    def on_calibration(self, calibration):
+        pass
+
+    def on_dialog_finished(self, ok):
+        pass
+
+    def on_retry(self, cmd, attempt):
+        pass
+
+    def on_emergency_stopped(self, latency):
+        pass
+
+
+class ProtocolSession:
+    """Состояние диалога с одним устройством.
+
+    Ничего не знает ни о Qt, ни о конкретном порте: кадры уходят через
+    ``write``, входящие кадры подаются в ``feed``, а всё, что стоит
+    показать пользователю, отправляется в ``listener``.
+
+    Для ответа, которого ждёт сессия, считается срок. Таймер заводит
+    владелец сессии: ``arm_timer(delay)`` просит вызвать ``on_timeout``
+    через delay секунд (None -- отменить).
+    """
+
+    def __init__(self, write, codec=DEFAULT_CODEC, listener=None, arm_timer=None, write_many=None,
+                 write_urgent=None):
+        self.write = write
+        # Запись пачки кадров одним вызовом; без неё кадры пишутся по одному.
+        self.write_many = write_many
+        # Запись вне очереди, выбрасывающая ждущие отправки кадры.
+        self.write_urgent = write_urgent
+        self.__emergency_started = None
+        self.__batch = None
+        self.arm_timer = arm_timer
+        self.codec = codec
+        self.listener = listener if listener is not None else SessionListener()
+        self._command_queue = deque()
+        self._response_queue = deque()
+        self.__device_is_executing = False
+        self._expectations = []
+        # Отправленные команды, чьи ответы ещё не получены; первая из них
+        # соответствует _expectations.
+        self._sent = deque()
+        self._sent_at = deque()  # когда ушла каждая из _sent, time.monotonic()
+        self.__head_expectations = []
+        self.__deadline = None
+        self.__retries = 0
+        self.baud_rate = 9600
+        self.max_retries = MAX_RETRIES
+        self.settle_time = SERVO_SETTLE_TIME
+        self.timeline = None
+        self.program_duration = 0.0
+        self.failed = False
+        self.last_algorithm_cmd = None
+        # Хеш программы, которая точно лежит в устройстве; None -- неизвестно.
+        self.program_hash = None
+        self.__pending_hash = None
+        # Калибровка, которая точно лежит и в RAM, и в EEPROM устройства: пары
+        # [открыто, закрыто] по моторам; None -- неизвестно.
+        self.calibration = None
+        self.__pending_calibration = None
+        # Калибровка из кэша, которую ещё должен подтвердить CALIB_DATA.
+        self.__unconfirmed_calibration = None
+        # Сколько команд алгоритма может одновременно ждать подтверждения.
+        # 1 -- классический stop-and-wait.
+        self.upload_window = DEFAULT_UPLOAD_WINDOW
+        self.__upload_started = None
+        self.__window = 1
+        # Команды диалога выполняются сразу (а не записываются в программу).
+        self.__realtime = True
+        self.__dialog_ok = True
+        self.__upload_bytes = 0
+        self.last_upload_time = None
+        # SessionMetrics или None, если наблюдать не нужно.
+        self.metrics = None
+
+    @property
+    def device_is_executing(self):
+        return self.__device_is_executing
+
+    @device_is_executing.setter
+    def device_is_executing(self, executing):
+        self.__device_is_executing = executing
+        self.listener.on_executing(executing)
+
+    @property
+    def busy(self):
+        return bool(self._expectations or self._response_queue)
+
+    def send_command(self, cmd):
+        if cmd.type == CommandType.EMERGENCY:
+            return self.send_emergency()
+        if not self.device_is_executing:
+            self._expectations = self.generate_expected_response(cmd)
+            if cmd.type == CommandType.EXECUTE_PROGRAM:
+                if self.last_algorithm_cmd is None:
+                    self.listener.on_message('Перед выполнением алгоритм надо загрузить', 3000)
+                    self._expectations.clear()
+                    return False
+                self._expectations[0] = Response(ResponseType.EXEC_FINISH, self.last_algorithm_cmd)
+                self.device_is_executing = True
+            if cmd.type in (CommandType.RESET, CommandType.LOADING_MODE):
+                self.invalidate_program()
+            if cmd.type in (CommandType.CALIBRATE, CommandType.RESET):
+                # Углы в RAM теперь не те, что в EEPROM (или неизвестно какие),
+                # а SAVE_CALIBRATION пишет в EEPROM именно RAM.
+                self.calibration = None
+                self.__unconfirmed_calibration = None
+            self.__emergency_started = None
+            self.__realtime = True
+            self.__dialog_ok = True
+            self.failed = False
+            self._sent = deque((cmd,))
+            self._sent_at = deque((time.monotonic(),))
+            self._write_command(cmd)
+            self._head_changed()
+            return True
+        else:
+            self.listener.on_message('В данный момент выполняется какой-то алгоритм', 3000)
+            return False
+
+    def send_reset(self, started=None):
+        """Сброс; если устройство чем-то занято -- аварийный стоп."""
+        if self.device_is_executing or self.busy or self._command_queue:
+            return self.send_emergency(started)
+        else:
+            return self.send_command(Command(CommandType.RESET))
+
+    def send_emergency(self, started=None):
+        """Аварийный стоп вне всякой очереди.
+
+        Отменяет текущий диалог со всеми неотправленными командами и
+        ожиданиями, пишет стоп в обход очереди порта и до подтверждения
+        стопа молча пропускает ответы на отменённые команды. started --
+        момент нажатия (time.perf_counter()), от него считается задержка,
+        о которой сообщает ``on_emergency_stopped``.
+        """
+        self._send_stop(started)
+        self.device_is_executing = False
+        return True
+
+    def _send_stop(self, started=None):
+        self.__emergency_started = started if started is not None else time.perf_counter()
+        if self.__batch:
+            self.__batch.clear()
+        if self.__upload_started is not None:
+            self.__upload_started = None
+            self.last_algorithm_cmd = None
+        self.invalidate_program()
+        self.__pending_calibration = None
+        self.__unconfirmed_calibration = None
+        self._command_queue.clear()
+        self._response_queue.clear()
+
+        cmd = Command(CommandType.EMERGENCY)
+        self._expectations = self.generate_expected_response(cmd)
+        self.__realtime = True
+        self.__dialog_ok = True
+        self.failed = False
+        self._sent = deque((cmd,))
+        self._sent_at = deque((time.monotonic(),))
+        data = self.codec.encode_command(cmd)
+        if self.write_urgent is not None:
+            self.write_urgent(data)
+        else:
+            self.write(data)
+        if self.metrics is not None:
+            self.metrics.frame_sent(len(data))
+        log.debug('Sending (urgent): %r', str(cmd))
+        self._head_changed()
+
+    def send_calibration(self, calibration):
+        """Прошивает калибровку: список пар [открыто, закрыто] по моторам.
+
+        Если калибровка устройства известна (``self.calibration``), уходят
+        только моторы с изменившимися углами -- окном, не дожидаясь ответов
+        по одному, -- а если не изменилось ничего, EEPROM не трогается.
+        """
+        if self.device_is_executing:
+            self.listener.on_message('В данный момент выполняется какой-то алгоритм', 3000)
+            return False
+
+        calibration = [list(row) for row in calibration]
+        known = self.calibration
+        if known is not None and len(known) != len(calibration):
+            known = None
+        if calibration == known:
+            self.listener.on_message('Эта калибровка уже в устройстве, EEPROM не трогаем', 3000)
+            self.listener.on_dialog_finished(True)
+            return True
+
+        commands = [
+            Command(CommandType.CALIBRATE,
+                CalibrationData(
+                    motorID=MotorID(str(i)),
+                    openedAngle=calibration[i][0],
+                    closedAngle=calibration[i][1]
+                )
+            )
+            for i in range(len(calibration))
+            if known is None or known[i] != calibration[i]
+        ]
+        commands.append(Command(CommandType.SAVE_CALIBRATION))
+        # Пока диалог не закончен, в RAM и EEPROM может быть что угодно.
+        self.calibration = None
+        self.__pending_calibration = calibration
+        self._start_dialog(commands, realtime=True, window=self.upload_window)
+        return True
+
+    def confirm_calibration(self, calibration):
+        """Сверяет калибровку из кэша с устройством.
+
+        Кэш мог остаться от другого устройства или устареть, так что
+        ``self.calibration`` станет calibration, только если PRINT_CALIBRATION
+        вернёт те же углы; иначе калибровка останется неизвестной.
+        """
+        self.calibration = None
+        if not self.send_command(Command(CommandType.PRINT_CALIBRATION)):
+            return False
+        self.__unconfirmed_calibration = [list(row) for row in calibration]
+        return True
+
+    def send_algorithm(self, before, loop, after, loop_times):
+        """Загружает алгоритм в устройство.
+
+        Не дожидаясь подтверждений, в полёте может находиться до
+        ``upload_window`` команд; ответы сверяются с ожиданиями по порядку.
+        """
+        if self.device_is_executing:
+            self.listener.on_message('В данный момент выполняется какой-то алгоритм', 3000)
+            return False
+
+        commands = [
+            Command(CommandType.LOADING_MODE),
+            *before,
+            *loop,
+            *after,
+            Command(CommandType.SAVE_PROGRAM,
+                LoopData(
+                    beginMark = len(before) + 1,
+                    endMark = len(before) + len(loop),
+                    numRepetitions = loop_times if len(loop) != 0 else 0
+                )
+            )
+        ]
+        program_hash = self.hash_program(commands)
+        if program_hash == self.program_hash:
+            self.listener.on_message('Этот алгоритм уже в устройстве, можно сразу запускать', 3000)
+            self.listener.on_dialog_finished(True)
+            return True
+
+        self.invalidate_program()
+        self.__pending_hash = program_hash
+        self.last_algorithm_cmd = commands[-2]
+        self.timeline = Timeline(before, loop, after, loop_times, self.settle_time)
+        self.program_duration = self.timeline.total_duration
+        self.__upload_bytes = sum(len(self.codec.encode_command(cmd)) for cmd in commands)
+        self.__upload_started = time.perf_counter()
+        self._start_dialog(commands, realtime=False, window=self.upload_window)
+        return True
+
+    def hash_program(self, commands):
+        digest = hashlib.sha1(self.codec.name.encode('ascii'))
+        for command in commands:
+            digest.update(self.codec.encode_command(command))
+        return digest.hexdigest()
+
+    def invalidate_program(self):
+        """Забывает, что лежит в устройстве: следующая загрузка пойдёт целиком."""
+        self.program_hash = None
+        self.__pending_hash = None
+
+    def generate_expected_response(self, command, realtime=True):
+        expectations = []
+        if realtime and command.type != CommandType.PRINT_CALIBRATION:
+            expectations.append(Response(ResponseType.EXEC_FINISH, command))
+        expectations.append(Response(ResponseType.PARSING_OK, None))
+        return expectations
+
+    def response_timeout(self, cmd, expected):
+        """Срок ожидания ответа expected на команду cmd, с."""
+        nbytes = len(self.codec.encode_command(cmd)) + RESPONSE_SIZE_HINT
+        timeout = nbytes * 10 / self.baud_rate + RESPONSE_MARGIN
+        if expected.type == ResponseType.EXEC_FINISH:
+            if cmd.type == CommandType.EXECUTE_PROGRAM:
+                timeout += self.program_duration * (1 + EXECUTION_MARGIN)
+            elif cmd.type == CommandType.WAIT:
+                timeout += cmd.arg / 1000
+            elif cmd.type in (CommandType.SET_FLAP, CommandType.SET_FILTER, CommandType.CALIBRATE):
+                timeout += self.settle_time
+        return timeout
+
+    def _head_changed(self):
+        self.__head_expectations = list(self._expectations)
+        self.__retries = 0
+        self._rearm()
+
+    def _rearm(self):
+        if self._expectations and self._sent:
+            delay = self.response_timeout(self._sent[0], self._expectations[-1])
+            self.__deadline = time.monotonic() + delay
+        else:
+            self.__deadline = delay = None
+        if self.arm_timer is not None:
+            self.arm_timer(delay)
+
+    def on_timeout(self):
+        """Срок ответа вышел: повторяем идемпотентную команду или сдаёмся.
+
+        При загрузке не повторяем ничего: повтор дописал бы в программу
+        лишний шаг, а потерянный ответ мог быть и на уже записанный.
+        """
+        if self.__deadline is None:
+            return
+        remaining = self.__deadline - time.monotonic()
+        if remaining > 0.001:
+            # Таймер от устаревшего срока.
+            if self.arm_timer is not None:
+                self.arm_timer(remaining)
+            return
+
+        cmd = self._sent[0]
+        if (self.__realtime and cmd.type in IDEMPOTENT_COMMANDS and self.__retries < self.max_retries
+                and self._commands_in_flight() == 1):
+            self.__retries += 1
+            log.warning('Timeout, retry %d/%d: %r', self.__retries, self.max_retries, str(cmd))
+            self.listener.on_retry(cmd, self.__retries)
+            if self.metrics is not None:
+                self.metrics.retried(cmd.type)
+            self._expectations = list(self.__head_expectations)
+            self._sent_at[0] = time.monotonic()
+            self._write_command(cmd)
+            self._rearm()
+            return
+
+        if cmd.type == CommandType.EXECUTE_PROGRAM:
+            # Программа идёт дольше расчётного, а устройство, может быть, всё
+            # ещё её выполняет: считать его свободным нельзя. Стоп переведёт
+            # его в известное состояние, подтверждение стопа снимет флаг.
+            log.warning('Program overran its deadline, stopping')
+            self.listener.on_message('Программа не закончилась в срок, останавливаем', 5000)
+            if self.metrics is not None:
+                self.metrics.timeouts += 1
+            self._send_stop()
+            self.__dialog_ok = False
+            self.failed = True
+            return
+
+        self.listener.on_message(f'Устройство не отвечает: {repr(str(cmd))}', 5000)
+        if self.metrics is not None:
+            self.metrics.timeouts += 1
+        self.__emergency_started = None
+        self.failed = True
+        self.device_is_executing = False
+        if not self.__realtime:
+            # Что успело записаться в программу, неизвестно.
+            self.invalidate_program()
+        self._abort_dialog()
+
+    def connection_lost(self):
+        """Порт пропал: ответов на отправленное уже не будет."""
+        self.__emergency_started = None
+        self.device_is_executing = False
+        if self.busy or self._command_queue:
+            self.failed = True
+            self._abort_dialog()
+
+    def expire_deadline(self):
+        """Считает срок ответа истёкшим прямо сейчас, не дожидаясь таймера."""
+        if self.__deadline is not None:
+            self.__deadline = time.monotonic()
+            self.on_timeout()
+
+    def _start_dialog(self, commands, realtime, window):
+        self._command_queue.clear()
+        self._response_queue.clear()
+        self._sent.clear()
+        self._sent_at.clear()
+        for command in commands:
+            self._command_queue.append(command)
+            self._response_queue.append(self.generate_expected_response(command, realtime))
+
+        self.__emergency_started = None
+        self.__window = window
+        self.__realtime = realtime
+        self.__dialog_ok = True
+        self.failed = False
+        self._expectations = self._response_queue.popleft()
+        batching = self._begin_batch()
+        try:
+            self._pump_commands(window)
+        finally:
+            if batching:
+                self._end_batch()
+        self._head_changed()
+
+    def _begin_batch(self):
+        """Дальше кадры копятся и уходят одним куском в _end_batch."""
+        if self.__batch is not None:
+            return False
+        self.__batch = []
+        return True
+
+    def _end_batch(self):
+        frames, self.__batch = self.__batch, None
+        if not frames:
+            return
+        if len(frames) == 1 or self.write_many is None:
+            for frame in frames:
+                self.write(frame)
+        else:
+            self.write_many(frames)
+
+    def _write_command(self, cmd):
+        data = self.codec.encode_command(cmd)
+        if self.__batch is not None:
+            self.__batch.append(data)
+        else:
+            self.write(data)
+        if self.metrics is not None:
+            self.metrics.frame_sent(len(data))
+        log.debug('Sending: %r', str(cmd))
+
+    def _commands_in_flight(self):
+        """Число отправленных команд, ответы на которые ещё не получены."""
+        pending = len(self._response_queue) + (1 if self._expectations else 0)
+        return pending - len(self._command_queue)
+
+    def _pump_commands(self, window=1):
+        while self._command_queue and self._commands_in_flight() < window:
+            if self._command_queue[0].type in BARRIER_COMMANDS and self._commands_in_flight():
+                break
+            next_cmd = self._command_queue.popleft()
+            self._sent.append(next_cmd)
+            self._sent_at.append(time.monotonic())
+            self._write_command(next_cmd)
+
+    def _finish_dialog(self):
+        if self.__upload_started is not None:
+            elapsed = time.perf_counter() - self.__upload_started
+            self.__upload_started = None
+            self.last_upload_time = elapsed
+            log.info('Upload finished in %.3f s (window %d)', elapsed, self.upload_window)
+            duration = format_duration(self.program_duration)
+            self.listener.on_message(f'Алгоритм загружен за {elapsed:.2f} с, выполняться будет {duration}', 5000)
+            if self.metrics is not None:
+                self.metrics.upload_finished(elapsed, self.__upload_bytes)
+            if self.__dialog_ok:
+                self.program_hash = self.__pending_hash
+            self.__pending_hash = None
+        if self.__pending_calibration is not None:
+            if self.__dialog_ok:
+                self.calibration = self.__pending_calibration
+            self.__pending_calibration = None
+        self.listener.on_dialog_finished(self.__dialog_ok)
+
+    def _abort_dialog(self):
+        # Ответы на уже отправленные команды не сойдутся с ожиданиями,
+        # так что продолжать загрузку бессмысленно.
+        if self.__upload_started is not None:
+            self.__upload_started = None
+            self.last_algorithm_cmd = None
+            self.invalidate_program()
+        self.__pending_calibration = None
+        self.__unconfirmed_calibration = None
+        self._command_queue.clear()
+        self._response_queue.clear()
+        self._expectations = []
+        self._sent.clear()
+        self._sent_at.clear()
+        self._rearm()
+        self.listener.on_dialog_finished(False)
+
+    def feed_many(self, frames):
+        """Обрабатывает пачку кадров, пришедших за одно пробуждение.
+
+        Команды, которые окно загрузки выпускает в ответ на эти кадры,
+        уходят в порт одной записью.
+        """
+        batching = self._begin_batch()
+        try:
+            for frame in frames:
+                self.feed(frame)
+        finally:
+            if batching:
+                self._end_batch()
+
+    def _feed_emergency(self, response):
+        # До подтверждения стопа приходят ответы на отменённые команды
+        # (и, возможно, ошибки разбора обрезанного кадра) -- их не ждали.
+        if response.type != ResponseType.EXEC_FINISH or response.data.type != CommandType.EMERGENCY:
+            return
+        latency = time.perf_counter() - self.__emergency_started
+        self.__emergency_started = None
+        log.info('Emergency stop acknowledged in %.1f ms', latency * 1000)
+        if self.metrics is not None:
+            self.metrics.command_acknowledged(CommandType.EMERGENCY, latency)
+        self._expectations = []
+        self._sent.clear()
+        self._sent_at.clear()
+        self._rearm()
+        self.device_is_executing = False
+        self.listener.on_emergency_stopped(latency)
+        self._finish_dialog()
+
+    def feed(self, frame):
+        """Обрабатывает один входящий кадр."""
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.frame_received(len(frame))
+        try:
+            log.debug('Received: %r', frame)
+            response = self.codec.decode_response(frame)
+        except UnicodeDecodeError:
+            if metrics is not None:
+                metrics.parse_errors += 1
+            self.listener.on_message('Контроллер что-то бормочет')
+            return
+        except ValueError as e:
+            if metrics is not None:
+                metrics.parse_errors += 1
+            self.listener.on_message(f'Ошибка парсинга {repr(str(e))}', 1500)
+            return
+
+        if self.__emergency_started is not None:
+            self._feed_emergency(response)
+            return
+
+        if response.type == ResponseType.PARSING_OK or response.type == ResponseType.EXEC_FINISH:
+            if len(self._expectations) == 0:
+                if metrics is not None:
+                    metrics.desyncs += 1
+                self.listener.on_message('Рассинхронизация: нежданный ответ')
+                return
+
+            expected = self._expectations.pop()
+            if response != expected and response in self._expectations:
+                # Предыдущий ответ потерялся, но этот его подразумевает.
+                while expected != response:
+                    expected = self._expectations.pop()
+            if response != expected:
+                self.__dialog_ok = False
+                if metrics is not None:
+                    metrics.desyncs += 1
+                self.listener.on_message(f'Рассинхронизация: {response} -- {expected}')
+            elif metrics is not None and response.type == ResponseType.PARSING_OK and self._sent_at and not self.__retries:
+                # По повторённым командам время не меряем: неясно, на какую из передач ответ.
+                metrics.command_acknowledged(self._sent[0].type, time.monotonic() - self._sent_at[0])
+
+            if len(self._expectations) == 0:
+                if self._sent:
+                    self._sent.popleft()
+                    self._sent_at.popleft()
+                if self._response_queue:
+                    self._expectations = self._response_queue.popleft()
+                    self._pump_commands(self.__window)
+                    if self._commands_in_flight() == 0:
+                        self.__dialog_ok = False
+                        if metrics is not None:
+                            metrics.desyncs += 1
+                        self.listener.on_message('Рассинхронизация: нечем продолжить диалог')
+                    self._head_changed()
+                else:
+                    self._rearm()
+                    self.device_is_executing = False
+                    self._finish_dialog()
+            else:
+                self._rearm()
+
+        elif response.type == ResponseType.PARSING_ERR:
+            if metrics is not None:
+                metrics.device_parse_errors += 1
+            self.listener.on_message('Контроллер подавился')
+            self.device_is_executing = False
+            self._abort_dialog()
+        elif response.type == ResponseType.DISPATCH_ERR:
+            if metrics is not None:
+                metrics.dispatch_errors += 1
+            self.listener.on_message('Контроллер растерялся')
+            self.device_is_executing = False
+            self._abort_dialog()
+        elif response.type == ResponseType.CALIB_DATA:
+            # Это углы в RAM: об EEPROM они ничего не говорят.
+            calibration = [[c.openedAngle, c.closedAngle] for c in response.data]
+            if self.__unconfirmed_calibration is not None:
+                if calibration == self.__unconfirmed_calibration:
+                    self.calibration = self.__unconfirmed_calibration
+                self.__unconfirmed_calibration = None
+            self.listener.on_calibration(calibration)
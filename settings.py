@@ -0,0 +1,39 @@
+import json
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+SETTINGS_FILENAME = os.path.join(os.path.expanduser('~'), '.pofs_app.json')
+
+
+class Settings:
+    """Настройки приложения, которые переживают перезапуск."""
+
+    def __init__(self, filename=SETTINGS_FILENAME):
+        self.filename = filename
+        self._data = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self._data = data if type(data) == dict else {}
+
+    def save(self):
+        try:
+            with open(self.filename, 'w') as f:
+                f.write(json.dumps(self._data, indent=4))
+        except OSError as e:
+            log.warning('Settings not saved: %s', e)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        self._data[key] = value
+        self.save()
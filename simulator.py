@@ -0,0 +1,365 @@
+"""Программный двойник прошивки POFS на псевдотерминале.
+
+Запуск::
+
+    python simulator.py --baud 9600 --latency 5 --virtual
+
+печатает имя pty (например, /dev/pts/7), к которому можно подключиться
+из App так же, как к настоящему устройству.
+"""
+
+import heapq
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+from protocol import *
+
+
+class RealClock:
+    def now(self):
+        return time.monotonic()
+
+
+class VirtualClock:
+    """Часы, которые идут только тогда, когда симулятору больше нечего делать.
+
+    Часовой WAIT в таком режиме проходит мгновенно, а ``now()`` при этом
+    показывает честное «устройственное» время.
+    """
+
+    def __init__(self):
+        self._now = 0.0
+
+    def now(self):
+        return self._now
+
+    def advance_to(self, when):
+        self._now = max(self._now, when)
+
+
+DEFAULT_CALIBRATION = [[0, 180]] * len(MotorID)
+
+
+class DeviceModel:
+    """Поведение прошивки без привязки к вводу-выводу.
+
+    Входящие байты подаются в ``receive``, исходящие кадры уходят в
+    ``send`` с учётом задержки линии и её пропускной способности. Время
+    берётся из ``clock``; ``run_due`` выполняет наступившие события.
+    """
+
+    IDLE = 'idle'
+    LOADING = 'loading'
+    EXECUTING = 'executing'
+
+    def __init__(self, send, clock=None, codec=DEFAULT_CODEC, latency=0.0, baud_rate=None,
+                 settle_time=0.0, drop_rate=0.0, corrupt_rate=0.0, parse_error_rate=0.0, seed=None):
+        self.send = send
+        self.clock = clock if clock is not None else RealClock()
+        self.codec = codec
+        self.latency = latency
+        self.baud_rate = baud_rate
+        self.settle_time = settle_time
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.parse_error_rate = parse_error_rate
+        self.random = random.Random(seed)
+
+        self.mode = DeviceModel.IDLE
+        self.program = []
+        self.loop_data = None
+        self.flap = FlapStatus.CLOSED
+        self.filter = FilterState.NONE
+        self.calibration = [list(row) for row in DEFAULT_CALIBRATION]
+        self.eeprom_calibration = [list(row) for row in DEFAULT_CALIBRATION]
+        self.eeprom_writes = 0
+        self.executed_steps = 0
+
+        self.__timers = []
+        self.__seq = 0
+        self.__rx = bytearray()
+        self.__rx_free_at = 0.0
+        self.__tx_free_at = 0.0
+        self.__execution = None
+
+    # --- планировщик ---
+
+    def schedule(self, when, callback):
+        heapq.heappush(self.__timers, (when, self.__seq, callback))
+        self.__seq += 1
+
+    def next_deadline(self):
+        return self.__timers[0][0] if self.__timers else None
+
+    def run_due(self):
+        while self.__timers and self.__timers[0][0] <= self.clock.now():
+            _, _, callback = heapq.heappop(self.__timers)
+            callback()
+
+    def _transfer_time(self, nbytes):
+        if not self.baud_rate:
+            return 0.0
+        return nbytes * 10 / self.baud_rate  # 8N1
+
+    # --- линия ---
+
+    def receive(self, data):
+        """Байты от хоста; обрабатываются, когда «дойдут» по линии."""
+        arrival = max(self.clock.now(), self.__rx_free_at) + self._transfer_time(len(data))
+        self.__rx_free_at = arrival
+        self.schedule(arrival, lambda: self.__on_bytes(data))
+
+    def __on_bytes(self, data):
+        self.__rx += data
+        for frame in split_frames(self.__rx, self.codec):
+            self.handle_frame(frame)
+
+    def reply(self, response):
+        frame = self.codec.encode_response(response)
+        if self.random.random() < self.drop_rate:
+            return
+        if self.random.random() < self.corrupt_rate:
+            frame = bytearray(frame)
+            frame[self.random.randrange(len(frame))] ^= 0x55
+            frame = bytes(frame)
+        start = max(self.clock.now() + self.latency, self.__tx_free_at)
+        self.__tx_free_at = start + self._transfer_time(len(frame))
+        self.schedule(self.__tx_free_at, lambda: self.send(frame))
+
+    def _ok(self):
+        self.reply(Response(ResponseType.PARSING_OK, None))
+
+    def _finished(self, command):
+        self.reply(Response(ResponseType.EXEC_FINISH, command))
+
+    # --- команды ---
+
+    def handle_frame(self, frame):
+        try:
+            command = self.codec.decode_command(frame)
+        except ValueError:
+            self.reply(Response(ResponseType.PARSING_ERR, None))
+            return
+        if self.random.random() < self.parse_error_rate:
+            self.reply(Response(ResponseType.PARSING_ERR, None))
+            return
+
+        if self.mode == DeviceModel.EXECUTING:
+            if command.type == CommandType.EMERGENCY:
+                self.__execution = None
+                self.mode = DeviceModel.IDLE
+                self._ok()
+                self._finished(command)
+            else:
+                self.reply(Response(ResponseType.DISPATCH_ERR, None))
+        elif self.mode == DeviceModel.LOADING:
+            self._handle_loading(command)
+        else:
+            self._handle_idle(command)
+
+    def _handle_loading(self, command):
+        if command.type in (CommandType.SET_FLAP, CommandType.SET_FILTER, CommandType.WAIT):
+            self.program.append(command)
+            self._ok()
+        elif command.type == CommandType.SAVE_PROGRAM:
+            loop_data = command.arg
+            if not (1 <= loop_data.beginMark <= loop_data.endMark + 1 and loop_data.endMark <= len(self.program)):
+                self.mode = DeviceModel.IDLE
+                self.program = []
+                self.reply(Response(ResponseType.DISPATCH_ERR, None))
+                return
+            self.loop_data = loop_data
+            self.mode = DeviceModel.IDLE
+            self._ok()
+        elif command.type in (CommandType.EMERGENCY, CommandType.RESET):
+            self.mode = DeviceModel.IDLE
+            self.program = []
+            self._ok()
+            self._finished(command)
+        else:
+            self.reply(Response(ResponseType.DISPATCH_ERR, None))
+
+    def _handle_idle(self, command):
+        now = self.clock.now()
+        cmdtype = command.type
+
+        if cmdtype == CommandType.SET_FLAP or cmdtype == CommandType.SET_FILTER or cmdtype == CommandType.WAIT:
+            self._ok()
+            self.schedule(now + self._step_duration(command), lambda: self.__realtime_done(command))
+        elif cmdtype == CommandType.LOADING_MODE:
+            self.mode = DeviceModel.LOADING
+            self.program = []
+            self.loop_data = None
+            self._ok()
+        elif cmdtype == CommandType.EXECUTE_PROGRAM:
+            if not self.program or self.loop_data is None:
+                self.reply(Response(ResponseType.DISPATCH_ERR, None))
+                return
+            self._ok()
+            self.mode = DeviceModel.EXECUTING
+            self.__execution = self._program_steps()
+            self.__next_step(self.__execution)
+        elif cmdtype == CommandType.RESET:
+            self.flap = FlapStatus.CLOSED
+            self.filter = FilterState.NONE
+            self._ok()
+            self._finished(command)
+        elif cmdtype == CommandType.CALIBRATE:
+            calib_data = command.arg
+            self.calibration[int(calib_data.motorID.value)] = [calib_data.openedAngle, calib_data.closedAngle]
+            self._ok()
+            self._finished(command)
+        elif cmdtype == CommandType.SAVE_CALIBRATION:
+            self.eeprom_calibration = [list(row) for row in self.calibration]
+            self.eeprom_writes += 1
+            self._ok()
+            self._finished(command)
+        elif cmdtype == CommandType.PRINT_CALIBRATION:
+            self._ok()
+            self.reply(Response(ResponseType.CALIB_DATA, [
+                CalibrationData(MotorID(str(i)), row[0], row[1]) for i, row in enumerate(self.calibration)
+            ]))
+        elif cmdtype == CommandType.EMERGENCY:
+            self._ok()
+            self._finished(command)
+        else:
+            self.reply(Response(ResponseType.DISPATCH_ERR, None))
+
+    def _step_duration(self, command):
+        if command.type == CommandType.WAIT:
+            return command.arg / 1000
+        return self.settle_time
+
+    def _apply(self, command):
+        if command.type == CommandType.SET_FLAP:
+            self.flap = command.arg
+        elif command.type == CommandType.SET_FILTER:
+            self.filter = command.arg
+
+    def __realtime_done(self, command):
+        self._apply(command)
+        self._finished(command)
+
+    def _program_steps(self):
+        # Шаги нумеруются с 1, цикл -- шаги beginMark..endMark включительно.
+        begin, end, repetitions = self.loop_data
+        yield from self.program[:begin - 1]
+        for _ in range(repetitions):
+            yield from self.program[begin - 1:end]
+        yield from self.program[end:]
+
+    def __next_step(self, execution):
+        if execution is not self.__execution:
+            return  # программу прервали
+        command = next(execution, None)
+        if command is None:
+            self.__execution = None
+            self.mode = DeviceModel.IDLE
+            self._finished(self.program[-1])
+            return
+        self._apply(command)
+        self.executed_steps += 1
+        self.schedule(self.clock.now() + self._step_duration(command), lambda: self.__next_step(execution))
+
+
+class PtySimulator:
+    """DeviceModel, подключённый к псевдотерминалу и работающий в своём потоке."""
+
+    def __init__(self, virtual_clock=False, **options):
+        self.clock = VirtualClock() if virtual_clock else RealClock()
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.device = DeviceModel(self.__send, self.clock, **options)
+        self.__thread = None
+        self.__running = False
+
+    def __send(self, frame):
+        os.write(self.master, frame)
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='pofs-simulator', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.master is not None:
+            os.close(self.master)
+            os.close(self.slave)
+            self.master = self.slave = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __run(self):
+        virtual = isinstance(self.clock, VirtualClock)
+        while self.__running:
+            deadline = self.device.next_deadline()
+            if deadline is None:
+                timeout = 0.05
+            elif virtual:
+                timeout = 0
+            else:
+                timeout = min(max(deadline - self.clock.now(), 0), 0.05)
+
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    data = b''
+                if data:
+                    self.device.receive(data)
+            elif virtual and deadline is not None:
+                # Хосту сказать нечего -- перематываем время к ближайшему событию.
+                self.clock.advance_to(deadline)
+            self.device.run_due()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='POFS firmware simulator')
+    parser.add_argument('--codec', choices=sorted(CODECS), default=DEFAULT_CODEC.name)
+    parser.add_argument('--baud', type=int, default=None, help='throttle the link to this baud rate')
+    parser.add_argument('--latency', type=float, default=0.0, help='reply latency, ms')
+    parser.add_argument('--settle', type=float, default=0.0, help='servo settle time, ms')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability to drop a reply')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='probability to corrupt a reply')
+    parser.add_argument('--parse-errors', type=float, default=0.0, help='probability to answer PARSING_ERR')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--virtual', action='store_true', help='run WAITs on a virtual clock')
+    args = parser.parse_args()
+
+    simulator = PtySimulator(
+        virtual_clock=args.virtual,
+        codec=CODECS[args.codec],
+        latency=args.latency / 1000,
+        baud_rate=args.baud,
+        settle_time=args.settle / 1000,
+        drop_rate=args.drop,
+        corrupt_rate=args.corrupt,
+        parse_error_rate=args.parse_errors,
+        seed=args.seed,
+    )
+    print(simulator.port_name, flush=True)
+    with simulator:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,106 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import DEFAULT_CODEC
+from session import ProtocolSession, SessionListener
+from simulator import DeviceModel, VirtualClock, PtySimulator
+
+
+class Recorder(SessionListener):
+    def __init__(self):
+        self.messages = []
+        self.finished = []
+        self.retries = []
+        self.calibrations = []
+        self.emergency_latencies = []
+
+    def on_message(self, msg, timeout=2000):
+        self.messages.append(msg)
+
+    def on_calibration(self, calibration):
+        self.calibrations.append(calibration)
+
+    def on_dialog_finished(self, ok):
+        self.finished.append(ok)
+
+    def on_retry(self, cmd, attempt):
+        self.retries.append((cmd, attempt))
+
+    def on_emergency_stopped(self, latency):
+        self.emergency_latencies.append(latency)
+
+
+class Link:
+    """ProtocolSession и DeviceModel на виртуальных часах, без порта.
+
+    ``drop(frame)`` решает, потерять ли кадр от устройства. Когда ни
+    устройству, ни хосту нечего делать, а сессия ждёт ответа, её срок
+    считается истёкшим -- как если бы сработал таймер.
+    """
+
+    def __init__(self, codec=DEFAULT_CODEC, window=1, drop=None, **options):
+        self.clock = VirtualClock()
+        self.drop = drop
+        self.sent = []
+        self.__rx = []
+        self.device = DeviceModel(self.__from_device, self.clock, codec, **options)
+        self.listener = Recorder()
+        self.session = ProtocolSession(self.__to_device, codec, listener=self.listener)
+        self.session.upload_window = window
+        self.session.settle_time = self.device.settle_time
+
+    def __to_device(self, frame):
+        self.sent.append(frame)
+        self.device.receive(frame)
+
+    def __from_device(self, frame):
+        if self.drop is None or not self.drop(frame):
+            self.__rx.append(frame)
+
+    def step(self):
+        """Один шаг обмена; False, если делать больше нечего."""
+        self.device.run_due()
+        if self.__rx:
+            frames, self.__rx = self.__rx, []
+            self.session.feed_many(frames)
+            return True
+        deadline = self.device.next_deadline()
+        if deadline is not None:
+            self.clock.advance_to(deadline)
+            return True
+        if self.session.busy:
+            self.session.expire_deadline()
+            return True
+        return False
+
+    def run(self, until=None, limit=100_000):
+        for _ in range(limit):
+            if until is not None and until():
+                return
+            if not self.step():
+                return
+        raise AssertionError('exchange did not settle')
+
+
+@pytest.fixture
+def make_link():
+    return Link
+
+
+@pytest.fixture
+def make_pty_device():
+    """Запускает симуляторы на псевдотерминалах; остановит их сам тест-раннер."""
+    simulators = []
+
+    def make(**options):
+        simulator = PtySimulator(**options).start()
+        simulators.append(simulator)
+        return simulator
+
+    yield make
+    for simulator in simulators:
+        simulator.stop()
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from protocol import *
+from algorithm_file import (AlgorithmFileError, write_algorithm, read_algorithm, write_json_algorithm,
+                            read_json_algorithm, load_algorithm, json_to_pofs, pofs_to_json)
+
+
+BEFORE = [Command(CommandType.SET_FILTER, FilterState.FS2), Command(CommandType.WAIT, 1500)]
+LOOP = [Command(CommandType.SET_FLAP, FlapStatus.OPENED), Command(CommandType.WAIT, 0xFFFFFFFF),
+        Command(CommandType.SET_FLAP, FlapStatus.CLOSED)]
+AFTER = [Command(CommandType.SET_FILTER, FilterState.NONE)]
+
+
+def test_pofs_round_trip(tmp_path):
+    filename = str(tmp_path / 'a.pofs')
+    write_algorithm(filename, BEFORE, LOOP, AFTER, 7)
+    before, loop, after, loop_times = read_algorithm(filename)
+    assert (before.commands(), loop.commands(), after.commands(), loop_times) == (BEFORE, LOOP, AFTER, 7)
+    assert load_algorithm(filename) == (BEFORE, LOOP, AFTER, 7)
+
+
+def test_json_round_trip(tmp_path):
+    filename = str(tmp_path / 'a.json')
+    write_json_algorithm(filename, BEFORE, LOOP, AFTER, 7)
+    assert read_json_algorithm(filename) == (BEFORE, LOOP, AFTER, 7)
+    assert load_algorithm(filename) == (BEFORE, LOOP, AFTER, 7)
+
+
+def test_conversion_both_ways(tmp_path):
+    json_filename = str(tmp_path / 'a.json')
+    pofs_filename = str(tmp_path / 'b.pofs')
+    back_filename = str(tmp_path / 'c.json')
+    write_json_algorithm(json_filename, BEFORE, LOOP, AFTER, 2)
+    json_to_pofs(json_filename, pofs_filename)
+    pofs_to_json(pofs_filename, back_filename)
+    with open(json_filename) as a, open(back_filename) as b:
+        assert json.load(a) == json.load(b)
+
+
+def test_empty_sections(tmp_path):
+    filename = str(tmp_path / 'a.pofs')
+    write_algorithm(filename, [], [], [], 0)
+    assert load_algorithm(filename) == ([], [], [], 0)
+
+
+@pytest.mark.parametrize('loop_times', [-1, 2 ** 32])
+def test_loop_times_out_of_range_is_not_written(tmp_path, loop_times):
+    with pytest.raises(AlgorithmFileError):
+        write_algorithm(str(tmp_path / 'a.pofs'), BEFORE, LOOP, AFTER, loop_times)
+
+
+def test_loop_times_out_of_range_is_not_loaded(tmp_path):
+    filename = tmp_path / 'a.json'
+    filename.write_text(json.dumps({'before': [], 'loop': [], 'after': [], 'loop_times': 2 ** 32}))
+    with pytest.raises(AlgorithmFileError):
+        load_algorithm(str(filename))
+
+
+@pytest.mark.parametrize('damage', [
+    lambda data: b'',
+    lambda data: b'XXXX' + data[4:],
+    lambda data: data[:10],
+    lambda data: data[:-1] + bytes([data[-1] ^ 0xFF]),
+])
+def test_damaged_pofs_is_rejected(tmp_path, damage):
+    filename = str(tmp_path / 'a.pofs')
+    write_algorithm(filename, BEFORE, LOOP, AFTER, 7)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open(filename, 'wb') as f:
+        f.write(damage(data))
+    with pytest.raises(AlgorithmFileError):
+        load_algorithm(filename)
+
+
+@pytest.mark.parametrize('content', [
+    'not json',
+    '[]',
+    '{"before": ["G,1\\n"], "loop": [], "after": []}',
+    '{"before": ["E\\n"], "loop": [], "after": [], "loop_times": 0}',
+])
+def test_bad_json_is_rejected(tmp_path, content):
+    filename = tmp_path / 'a.json'
+    filename.write_text(content)
+    with pytest.raises(AlgorithmFileError):
+        load_algorithm(str(filename))
@@ -0,0 +1,43 @@
+import asyncio
+
+from protocol import *
+from async_session import AsyncSession, open_serial
+
+
+OPEN = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+CLOSE = Command(CommandType.SET_FLAP, FlapStatus.CLOSED)
+
+
+def test_upload_and_execute(make_pty_device):
+    simulator = make_pty_device(virtual_clock=True)
+
+    async def main():
+        session = AsyncSession(open_serial(simulator.port_name))
+        try:
+            assert await session.upload([OPEN, Command(CommandType.WAIT, 60_000)], [], [CLOSE], 0)
+            assert await session.execute()
+            return await session.read_calibration()
+        finally:
+            session.close()
+
+    assert asyncio.run(main()) == simulator.device.calibration
+    assert simulator.device.executed_steps == 3
+    assert simulator.device.flap == FlapStatus.CLOSED
+
+
+def test_lost_port_ends_dialog(make_pty_device):
+    simulator = make_pty_device()
+
+    async def main():
+        session = AsyncSession(open_serial(simulator.port_name))
+        waiting = asyncio.ensure_future(session.send(Command(CommandType.WAIT, 60_000)))
+        await asyncio.sleep(0.1)
+        simulator.stop()
+        ok = await asyncio.wait_for(waiting, 5)
+        assert not session.session.busy
+        assert 'Соединение потеряно' in session.messages
+        # Писать в закрытый порт -- не ошибка, а отказ.
+        session.session.write(b'R\n')
+        return ok, await asyncio.wait_for(session.send(OPEN), 1)
+
+    assert asyncio.run(main()) == (False, False)
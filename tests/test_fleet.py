@@ -0,0 +1,56 @@
+import asyncio
+
+from protocol import *
+from fleet import Fleet
+
+
+OPEN = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+CLOSE = Command(CommandType.SET_FLAP, FlapStatus.CLOSED)
+ALGORITHM = ([OPEN, Command(CommandType.WAIT, 1000)], [Command(CommandType.SET_FILTER, FilterState.FS2)], [CLOSE], 5)
+
+
+def test_algorithm_reaches_every_device(make_pty_device):
+    simulators = [make_pty_device(virtual_clock=True) for _ in range(3)]
+
+    async def main():
+        fleet = Fleet()
+        assert fleet.open([s.port_name for s in simulators]) == []
+        try:
+            results = await fleet.broadcast_algorithm(*ALGORITHM)
+        finally:
+            fleet.close()
+        return fleet, results
+
+    fleet, results = asyncio.run(main())
+    assert [r.ok for r in results] == [True, True, True]
+    assert fleet.ok
+    assert fleet.summary().startswith('3/3 OK')
+    for simulator in simulators:
+        assert simulator.device.program == [*ALGORITHM[0], *ALGORITHM[1], *ALGORITHM[2]]
+
+
+def test_silent_device_fails_alone(make_pty_device):
+    good = make_pty_device(virtual_clock=True)
+    silent = make_pty_device(drop_rate=1.0)
+
+    async def main():
+        fleet = Fleet()
+        fleet.open([good.port_name, silent.port_name])
+        try:
+            await fleet.broadcast_algorithm(*ALGORITHM)
+        finally:
+            fleet.close()
+        return fleet
+
+    fleet = asyncio.run(main())
+    assert not fleet.ok
+    assert [r.ok for r in fleet.results] == [True, False]
+    summary = fleet.summary()
+    assert summary.startswith('1/2 OK')
+    assert f'{silent.port_name}: FAIL' in summary
+
+
+def test_unopened_ports_are_reported():
+    fleet = Fleet()
+    assert fleet.open(['/nonexistent/port']) == ['/nonexistent/port']
+    assert fleet.devices == []
@@ -0,0 +1,62 @@
+import pytest
+
+from protocol import *
+from metrics import Histogram, SessionMetrics, render, write_metrics
+
+
+OPEN = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+
+
+def test_histogram_quantile_is_bucket_bound():
+    histogram = Histogram((0.1, 1.0, 10.0))
+    for value in (0.05, 0.05, 0.5, 5.0):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.mean == pytest.approx(5.6 / 4)
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.95) == 10.0
+    assert list(histogram.cumulative())[-1] == (float('inf'), 4)
+
+
+def test_session_counts_retries_and_round_trips(make_link):
+    replies = []
+
+    def drop_first_two(frame):
+        replies.append(frame)
+        return len(replies) <= 2
+
+    link = make_link(drop=drop_first_two)
+    metrics = link.session.metrics = SessionMetrics('/dev/ttyTEST')
+    link.session.send_command(OPEN)
+    link.run()
+
+    assert metrics.retries == {CommandType.SET_FLAP: 1}
+    assert metrics.frames_sent == 2
+    assert metrics.frames_received == 2  # первые два ответа потеряны
+    # Время ответа на повторённую команду не меряется.
+    assert CommandType.SET_FLAP not in metrics.round_trip
+
+
+def test_upload_is_measured(make_link):
+    link = make_link()
+    metrics = link.session.metrics = SessionMetrics('/dev/ttyTEST')
+    link.session.send_algorithm([OPEN, Command(CommandType.WAIT, 10)], [], [], 0)
+    link.run()
+    assert metrics.upload.count == 1
+    assert metrics.uploaded_bytes > 0
+    assert metrics.round_trip[CommandType.WAIT].count == 1
+
+
+def test_written_file_is_prometheus_text(tmp_path):
+    metrics = SessionMetrics('/dev/ttyTEST')
+    metrics.frame_sent(4)
+    metrics.command_acknowledged(CommandType.WAIT, 0.02)
+    metrics.timeouts = 3
+    filename = tmp_path / 'pofs.prom'
+    write_metrics([metrics], str(filename))
+
+    text = filename.read_text()
+    assert text == render([metrics])
+    assert 'pofs_timeouts_total{port="/dev/ttyTEST"} 3' in text
+    assert 'pofs_round_trip_seconds_count{port="/dev/ttyTEST",command="WAIT"} 1' in text
+    assert not (tmp_path / 'pofs.prom.tmp').exists()
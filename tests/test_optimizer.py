@@ -0,0 +1,82 @@
+import pytest
+
+from protocol import *
+from optimizer import optimize_algorithm, upload_size
+
+
+OPEN = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+CLOSE = Command(CommandType.SET_FLAP, FlapStatus.CLOSED)
+FILTER1 = Command(CommandType.SET_FILTER, FilterState.FS1)
+FILTER2 = Command(CommandType.SET_FILTER, FilterState.FS2)
+
+
+def wait(ms):
+    return Command(CommandType.WAIT, ms)
+
+
+ALGORITHMS = [
+    ([OPEN, wait(100), wait(200), CLOSE, OPEN], [], [], 0),
+    ([FILTER1], [OPEN, wait(0), wait(50), OPEN, CLOSE, wait(50)], [CLOSE, FILTER1, wait(10)], 4),
+    ([OPEN], [wait(1000)], [CLOSE], 30),
+    ([FILTER2, FILTER1, wait(5)], [FILTER1, wait(5), FILTER2, wait(5)], [FILTER2], 1),
+    ([CLOSE], [OPEN, wait(5)], [OPEN, wait(5)], 0),
+]
+
+
+def state_changes(make_link, algorithm, settle_time):
+    """Когда и во что менялось состояние установки при выполнении на симуляторе."""
+    link = make_link(settle_time=settle_time)
+    states = {}
+    apply = link.device._apply
+
+    def record(command):
+        apply(command)
+        # Несколько шагов в один момент -- это одно изменение.
+        states[link.clock.now() - started] = (link.device.flap, link.device.filter)
+
+    link.device._apply = record
+    link.session.send_algorithm(*algorithm)
+    link.run()
+    started = link.clock.now()
+    states[0.0] = (link.device.flap, link.device.filter)
+    link.session.send_command(Command(CommandType.EXECUTE_PROGRAM))
+    link.run()
+    assert link.listener.finished == [True, True]
+
+    changes = []
+    for when, state in sorted(states.items()):
+        if not changes or changes[-1][1] != state:
+            changes.append((when, state))
+    return changes, link.clock.now() - started
+
+
+@pytest.mark.parametrize('settle_time', [0.0, 0.25, 1.0])
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_optimized_program_behaves_the_same(make_link, algorithm, settle_time):
+    before, loop, after, loop_times, report = optimize_algorithm(*algorithm, settle_time=settle_time)
+    expected, expected_duration = state_changes(make_link, algorithm, settle_time)
+    actual, actual_duration = state_changes(make_link, (before, loop, after, loop_times), settle_time)
+    assert [state for _, state in actual] == [state for _, state in expected]
+    assert [when for when, _ in actual] == pytest.approx([when for when, _ in expected])
+    assert actual_duration == pytest.approx(expected_duration)
+    assert report.bytes_after == upload_size(before, loop, after, loop_times if loop else 0)
+    assert report.bytes_after <= report.bytes_before
+
+
+def test_waits_are_merged_and_overridden_steps_dropped():
+    before, loop, after, loop_times, report = optimize_algorithm(
+        [OPEN, CLOSE, wait(100), wait(0), wait(200)], [], [], 0, settle_time=0)
+    assert (before, loop, after) == ([CLOSE, wait(300)], [], [])
+    assert report.steps_saved == 3
+
+
+def test_redundant_step_keeps_its_settle_time():
+    before, loop, after, loop_times, report = optimize_algorithm(
+        [OPEN, CLOSE, wait(100), CLOSE, wait(200)], [], [], 0, settle_time=0.5)
+    assert (before, loop, after) == ([OPEN, CLOSE, wait(800)], [], [])
+    assert report.steps_saved == 2
+
+
+def test_single_wait_loop_becomes_one_wait():
+    before, loop, after, loop_times, _ = optimize_algorithm([OPEN], [wait(1000)], [CLOSE], 30)
+    assert (before, loop, after) == ([OPEN, wait(30_000), CLOSE], [], [])
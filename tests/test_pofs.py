@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import pofs
+from protocol import FlapStatus, MotorID
+
+
+ALGORITHM = {'before': ['G,1\n', 'W,100\n'], 'loop': ['F,2\n'], 'after': ['G,0\n'], 'loop_times': 3}
+
+
+def write_algorithm(tmp_path):
+    filename = tmp_path / 'a.json'
+    filename.write_text(json.dumps(ALGORITHM))
+    return str(filename)
+
+
+def test_run_on_several_ports(make_pty_device, tmp_path, capsys):
+    simulators = [make_pty_device(virtual_clock=True) for _ in range(2)]
+    argv = ['run', write_algorithm(tmp_path), '--execute']
+    for simulator in simulators:
+        argv += ['--port', simulator.port_name]
+
+    assert pofs.main(argv) == pofs.EXIT_OK
+    out = capsys.readouterr().out
+    assert '2/2 OK' in out
+    for simulator in simulators:
+        assert f'{simulator.port_name}: execute: OK' in out
+        assert simulator.device.executed_steps == 6
+
+
+def test_unwritable_capture_is_a_usage_error(make_pty_device, tmp_path):
+    simulator = make_pty_device(virtual_clock=True)
+    capture = str(tmp_path / 'missing' / 'traffic.pofscap')
+    assert pofs.main(['reset', '--port', simulator.port_name, '--capture', capture]) == pofs.EXIT_USAGE
+
+
+def test_run_program_on_one_port(make_pty_device, tmp_path, capsys):
+    simulator = make_pty_device(virtual_clock=True, settle_time=0.5)
+    program = tmp_path / 'a.prog'
+    program.write_text('flap open\nrepeat 5 {\n  filter 1\n  wait 2s\n  filter none\n}\nflap close\n')
+
+    assert pofs.main(['run', str(program), '--port', simulator.port_name, '--execute']) == pofs.EXIT_OK
+    out = capsys.readouterr().out
+    assert 'upload: OK' in out
+    assert 'execute: OK' in out
+    assert simulator.device.executed_steps == 2 + 5 * 3
+    assert simulator.device.flap == FlapStatus.CLOSED
+
+
+def test_calibrate_and_read_back(make_pty_device, tmp_path, capsys):
+    simulator = make_pty_device(virtual_clock=True)
+    calibration = [[5 * i, 180 - 5 * i] for i in range(len(MotorID))]
+    filename = tmp_path / 'calibration.json'
+    filename.write_text(json.dumps(calibration))
+
+    assert pofs.main(['calibrate', str(filename), '--port', simulator.port_name]) == pofs.EXIT_OK
+    assert simulator.device.eeprom_calibration == calibration
+    capsys.readouterr()
+    assert pofs.main(['read-calibration', '--port', simulator.port_name]) == pofs.EXIT_OK
+    assert json.loads(capsys.readouterr().out.splitlines()[0]) == calibration
+
+
+@pytest.mark.parametrize('content', ['not json', '[[0, 180]]', json.dumps([[0, 200]] * len(MotorID))])
+def test_bad_calibration_file_is_a_usage_error(make_pty_device, tmp_path, content):
+    simulator = make_pty_device(virtual_clock=True)
+    filename = tmp_path / 'calibration.json'
+    filename.write_text(content)
+    assert pofs.main(['calibrate', str(filename), '--port', simulator.port_name]) == pofs.EXIT_USAGE
+    assert simulator.device.eeprom_writes == 0
+
+
+def test_missing_algorithm_is_a_usage_error(make_pty_device, tmp_path):
+    simulator = make_pty_device(virtual_clock=True)
+    missing = str(tmp_path / 'missing.json')
+    assert pofs.main(['run', missing, '--port', simulator.port_name]) == pofs.EXIT_USAGE
+
+
+def test_silent_device_fails(make_pty_device):
+    simulator = make_pty_device(drop_rate=1.0)
+    assert pofs.main(['reset', '--port', simulator.port_name]) == pofs.EXIT_FAILED
+
+
+def test_missing_port(tmp_path):
+    assert pofs.main(['reset', '--port', str(tmp_path / 'ttyNONE')]) == pofs.EXIT_PORT
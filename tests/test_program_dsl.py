@@ -0,0 +1,83 @@
+import pytest
+
+from protocol import *
+from algorithm_file import load_algorithm, AlgorithmFileError
+from optimizer import upload_size
+from program_dsl import ProgramError, compile_program, parse_program, _unroll
+
+
+PROGRAM = '''
+# экспозиция
+filter 1
+repeat 3 {
+    flap open
+    wait 1.5s
+    flap close
+    repeat 100 {
+        wait 250ms
+        flap open
+    }
+}
+repeat 1 {
+    wait 10
+    repeat 500 {      # эта серия выгоднее всего
+        flap open
+        wait 20ms
+        flap close
+    }
+}
+filter none
+'''
+
+
+def test_best_loop_is_kept_on_device():
+    compiled = compile_program(PROGRAM, optimize=False)
+    assert (compiled.loop_line, compiled.loop_times) == (15, 500)
+    assert compiled.loop == [Command(CommandType.SET_FLAP, FlapStatus.OPENED), Command(CommandType.WAIT, 20),
+                             Command(CommandType.SET_FLAP, FlapStatus.CLOSED)]
+    assert compiled.upload_size == upload_size(*compiled[:4])
+    assert compiled.upload_size < compiled.unrolled_size
+
+
+@pytest.mark.parametrize('codec', CODECS.values(), ids=CODECS)
+def test_compiled_program_runs_the_same_steps(codec):
+    compiled = compile_program(PROGRAM, codec, optimize=False)
+    steps = compiled.before + compiled.loop * compiled.loop_times + compiled.after
+    assert steps == _unroll(parse_program(PROGRAM), [])
+
+
+def test_repeat_inside_repeat_is_never_the_loop():
+    compiled = compile_program('repeat 2 {\n wait 1\n repeat 50 {\n flap open\n flap close\n }\n}\n',
+                               optimize=False)
+    assert (compiled.loop_line, compiled.loop_times) == (1, 2)
+
+
+def test_without_repeats_there_is_no_loop():
+    compiled = compile_program('flap open\nwait 2m\nflap close\n')
+    assert compiled.loop == [] and compiled.loop_line is None
+    assert Command(CommandType.WAIT, 120_000) in compiled.before
+
+
+@pytest.mark.parametrize('text, line', [
+    ('flap open\nflap ajar\n', 2),
+    ('wait 5h\n', 1),
+    ('repeat 2 {\nwait 1\n', 1),
+    ('wait 1\n}\n', 2),
+    ('repeat twice {\n}\n', 1),
+    ('wait 1\nrepeat 4294967296 {\nflap open\n}\n', 2),
+])
+def test_errors_point_at_the_line(text, line):
+    with pytest.raises(ProgramError) as error:
+        compile_program(text)
+    assert error.value.line == line
+
+
+def test_prog_files_load_like_algorithms(tmp_path):
+    filename = tmp_path / 'a.prog'
+    filename.write_text(PROGRAM, encoding='utf-8')
+    before, loop, after, loop_times = load_algorithm(str(filename))
+    assert before + loop * loop_times + after == _unroll(parse_program(PROGRAM), [])
+
+    filename.write_text('repeat 2 {\n', encoding='utf-8')
+    with pytest.raises(AlgorithmFileError):
+        load_algorithm(str(filename))
@@ -0,0 +1,79 @@
+import pytest
+
+from protocol import *
+
+
+COMMANDS = [
+    Command(CommandType.SET_FLAP, FlapStatus.OPENED),
+    Command(CommandType.SET_FILTER, FilterState.FS4),
+    Command(CommandType.WAIT, 0),
+    Command(CommandType.WAIT, 0xFFFFFFFF),
+    Command(CommandType.LOADING_MODE),
+    Command(CommandType.SAVE_PROGRAM, LoopData(2, 5, 1000)),
+    Command(CommandType.EXECUTE_PROGRAM),
+    Command(CommandType.RESET),
+    Command(CommandType.CALIBRATE, CalibrationData(MotorID.S3, 0, 180)),
+    Command(CommandType.SAVE_CALIBRATION),
+    Command(CommandType.PRINT_CALIBRATION),
+    Command(CommandType.EMERGENCY),
+]
+
+RESPONSES = [
+    Response(ResponseType.PARSING_OK, None),
+    Response(ResponseType.PARSING_ERR, None),
+    Response(ResponseType.DISPATCH_ERR, None),
+    Response(ResponseType.EXEC_FINISH, Command(CommandType.WAIT, 250)),
+    Response(ResponseType.CALIB_DATA, [CalibrationData(m, 10, 170) for m in MotorID]),
+]
+
+
+@pytest.mark.parametrize('codec', CODECS.values(), ids=CODECS)
+@pytest.mark.parametrize('command', COMMANDS, ids=str)
+def test_command_round_trip(codec, command):
+    frame = codec.encode_command(command)
+    assert codec.find_frame(frame) == len(frame)
+    assert codec.decode_command(frame) == command
+
+
+@pytest.mark.parametrize('codec', CODECS.values(), ids=CODECS)
+@pytest.mark.parametrize('response', RESPONSES, ids=lambda r: r.type.name)
+def test_response_round_trip(codec, response):
+    frame = codec.encode_response(response)
+    assert codec.decode_response(frame) == response
+
+
+@pytest.mark.parametrize('codec', CODECS.values(), ids=CODECS)
+def test_split_frames_keeps_partial_tail(codec):
+    frames = [codec.encode_command(command) for command in COMMANDS]
+    data = b''.join(frames)
+    buffer = bytearray(data[:-1])
+    assert split_frames(buffer, codec) == frames[:-1]
+    buffer += data[-1:]
+    assert split_frames(buffer, codec) == frames[-1:]
+    assert not buffer
+
+
+@pytest.mark.parametrize('length', [0, 3, 20, 0xF0])
+def test_binary_stream_resyncs_after_corrupted_length(length):
+    bad = bytearray(BINARY_CODEC.encode_command(COMMANDS[5]))
+    bad[0] = length
+    good = [BINARY_CODEC.encode_command(command) for command in COMMANDS]
+    buffer = bytearray(bad + b''.join(good))
+    assert split_frames(buffer, BINARY_CODEC) == good
+    assert not buffer
+
+
+def test_binary_stream_resyncs_after_corrupted_payload():
+    bad = bytearray(BINARY_CODEC.encode_response(RESPONSES[3]))
+    bad[2] ^= 0x40
+    good = [BINARY_CODEC.encode_response(response) for response in RESPONSES]
+    buffer = bytearray(bad + b''.join(good))
+    assert split_frames(buffer, BINARY_CODEC) == good
+
+
+def test_commands_are_immutable_values():
+    assert Command(CommandType.SET_FLAP, FlapStatus.OPENED) is Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+    assert Command(CommandType.WAIT, 10) == Command(CommandType.WAIT, 10)
+    assert hash(Command(CommandType.WAIT, 10)) == hash(Command(CommandType.WAIT, 10))
+    with pytest.raises(AttributeError):
+        Command(CommandType.WAIT, 10).arg = 20
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from protocol import *
+from async_session import AsyncSession, open_serial
+from recorder import (TrafficRecorder, CaptureFormatError, ReplayPort, read_capture, host_dialogs, upload_window,
+                      TX, RX)
+from session import ProtocolSession
+
+from conftest import Recorder
+
+
+OPEN = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+CLOSE = Command(CommandType.SET_FLAP, FlapStatus.CLOSED)
+ALGORITHM = ([OPEN, Command(CommandType.WAIT, 100)], [Command(CommandType.SET_FILTER, FilterState.FS3)], [CLOSE], 4)
+CALIBRATION = [[10 * i, 180 - 10 * i] for i in range(len(MotorID))]
+
+
+class Replayer(Recorder):
+    """Заменяет App для ReplayPort: передаёт кадры сессии."""
+
+    session = None
+
+    def process_packets(self, frames):
+        self.session.feed_many(frames)
+
+
+def capture(simulator, filename, codec, window):
+    async def main():
+        transport = open_serial(simulator.port_name, codec=codec)
+        transport.recorder = TrafficRecorder(filename, codec)
+        session = AsyncSession(transport)
+        session.upload_window = window
+        try:
+            assert await session.upload(*ALGORITHM)
+            assert await session.calibrate(CALIBRATION)
+            assert await session.send(OPEN)
+        finally:
+            session.close()
+            transport.recorder.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('codec', [ASCII_CODEC, BINARY_CODEC])
+def test_capture_replays_without_mismatches(make_pty_device, tmp_path, codec):
+    simulator = make_pty_device(virtual_clock=True, codec=codec)
+    filename = str(tmp_path / 'traffic.pofscap')
+    capture(simulator, filename, codec, window=4)
+
+    events, codecs = read_capture(filename)
+    assert codecs == {0: codec}
+    assert {event.direction for event in events} == {TX, RX}
+    assert upload_window(events, codec) == 4
+    dialogs = list(host_dialogs(events, codec))
+    assert [kind for kind, _ in dialogs] == ['algorithm', 'calibration', 'command']
+    assert dialogs[0][1] == ALGORITHM
+
+    listener = Replayer()
+    port = ReplayPort(listener, events, codec)
+    session = listener.session = ProtocolSession(port.write, codec, listener=listener)
+    port.expire = session.expire_deadline
+    session.upload_window = upload_window(events, codec)
+    for kind, payload in dialogs:
+        if kind == 'algorithm':
+            session.send_algorithm(*payload)
+        elif kind == 'calibration':
+            session.calibration, calibration = payload
+            session.send_calibration(calibration)
+        else:
+            session.send_command(payload)
+        port.deliver_rx()
+
+    assert port.mismatches == []
+    assert port.exhausted
+    assert listener.finished == [True, True, True]
+
+
+def test_each_recorder_opens_a_new_session(tmp_path):
+    filename = str(tmp_path / 'traffic.pofscap')
+    for codec in (ASCII_CODEC, BINARY_CODEC):
+        recorder = TrafficRecorder(filename, codec)
+        recorder.record_tx(codec.encode_command(OPEN))
+        recorder.record_rx(codec.encode_response(Response(ResponseType.PARSING_OK, None)))
+        recorder.close()
+
+    events, codecs = read_capture(filename)
+    assert codecs == {0: ASCII_CODEC, 1: BINARY_CODEC}
+    assert [(e.session, e.direction) for e in events] == [(0, TX), (0, RX), (1, TX), (1, RX)]
+
+
+def test_truncated_tail_is_ignored(tmp_path):
+    filename = tmp_path / 'traffic.pofscap'
+    recorder = TrafficRecorder(str(filename), ASCII_CODEC)
+    recorder.record_tx(b'G,1\n')
+    recorder.record_rx(b'o\n')
+    recorder.close()
+    filename.write_bytes(filename.read_bytes()[:-1])
+
+    events, _ = read_capture(str(filename))
+    assert [e.data for e in events] == [b'G,1\n']
+
+
+def test_foreign_file_is_rejected(tmp_path):
+    filename = tmp_path / 'traffic.pofscap'
+    filename.write_bytes(b'not a capture')
+    with pytest.raises(CaptureFormatError):
+        read_capture(str(filename))
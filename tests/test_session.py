@@ -0,0 +1,265 @@
+import pytest
+
+from protocol import *
+
+
+OPEN = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+CLOSE = Command(CommandType.SET_FLAP, FlapStatus.CLOSED)
+FILTER1 = Command(CommandType.SET_FILTER, FilterState.FS1)
+
+
+def wait(ms):
+    return Command(CommandType.WAIT, ms)
+
+
+def calibrate(motor, opened, closed):
+    return Command(CommandType.CALIBRATE, CalibrationData(MotorID(str(motor)), opened, closed))
+
+
+def sent_commands(link, codec=DEFAULT_CODEC):
+    return [codec.decode_command(frame) for frame in link.sent]
+
+
+ALGORITHM = ([OPEN, wait(100)], [FILTER1, wait(50)], [CLOSE], 3)
+
+
+@pytest.mark.parametrize('codec', [ASCII_CODEC, BINARY_CODEC])
+@pytest.mark.parametrize('window', [1, 4])
+def test_upload_stores_program(make_link, codec, window):
+    link = make_link(codec, window=window)
+    before, loop, after, loop_times = ALGORITHM
+    assert link.session.send_algorithm(before, loop, after, loop_times)
+    link.run()
+
+    assert link.listener.finished == [True]
+    assert link.device.program == [*before, *loop, *after]
+    assert link.device.loop_data == LoopData(3, 4, 3)
+    assert link.session.program_hash is not None
+
+
+def test_window_shortens_upload(make_link):
+    steps = [wait(i) for i in range(1, 40)]
+    elapsed = {}
+    for window in (1, 8):
+        link = make_link(window=window, latency=0.01)
+        link.session.send_algorithm(steps, [], [], 0)
+        link.run()
+        assert link.listener.finished == [True]
+        assert link.device.program == steps
+        elapsed[window] = link.clock.now()
+    assert elapsed[8] < elapsed[1] / 4
+
+
+def test_same_program_is_not_uploaded_twice(make_link):
+    link = make_link()
+    link.session.send_algorithm(*ALGORITHM)
+    link.run()
+    frames = len(link.sent)
+    link.session.send_algorithm(*ALGORITHM)
+    link.run()
+    assert link.listener.finished == [True, True]
+    assert len(link.sent) == frames
+
+
+def test_realtime_command_is_retried_after_lost_reply(make_link):
+    replies = []
+
+    def drop_both_replies(frame):
+        replies.append(frame)
+        return len(replies) <= 2
+
+    link = make_link(drop=drop_both_replies)
+    link.session.send_command(OPEN)
+    link.run()
+
+    assert [attempt for _, attempt in link.listener.retries] == [1]
+    assert link.listener.finished == [True]
+    assert link.device.flap == FlapStatus.OPENED
+
+
+def test_lost_reply_during_upload_aborts_instead_of_retrying(make_link):
+    replies = []
+
+    def drop_second(frame):
+        replies.append(frame)
+        return len(replies) == 2
+
+    link = make_link(drop=drop_second)
+    link.session.send_algorithm(*ALGORITHM)
+    link.run()
+
+    assert link.listener.retries == []
+    assert link.listener.finished == [False]
+    assert link.session.program_hash is None
+    # Ни один шаг не ушёл дважды.
+    assert sent_commands(link).count(OPEN) == 1
+
+
+def test_dead_device_gives_up_after_retries(make_link):
+    link = make_link(drop=lambda frame: True)
+    link.session.send_command(OPEN)
+    link.run()
+
+    assert len(link.listener.retries) == link.session.max_retries
+    assert link.listener.finished == [False]
+    assert link.session.failed
+
+
+def test_emergency_stops_execution(make_link):
+    link = make_link()
+    link.session.send_algorithm([OPEN, wait(60_000)], [], [CLOSE], 0)
+    link.run()
+    link.session.send_command(Command(CommandType.EXECUTE_PROGRAM))
+    link.run(until=lambda: link.device.executed_steps == 2)
+    assert link.session.device_is_executing
+
+    link.session.send_emergency()
+    link.run()
+
+    assert link.device.mode == link.device.IDLE
+    assert link.device.executed_steps == 2
+    assert not link.session.device_is_executing
+    assert len(link.listener.emergency_latencies) == 1
+    assert link.listener.finished[-1] is True
+
+
+def test_overdue_program_is_stopped_not_assumed_idle(make_link):
+    def drop_program_finish(frame):
+        response = DEFAULT_CODEC.decode_response(frame)
+        return response.type == ResponseType.EXEC_FINISH and response.data.type != CommandType.EMERGENCY
+
+    link = make_link(drop=drop_program_finish)
+    link.session.send_algorithm([OPEN, wait(100)], [], [CLOSE], 0)
+    link.run()
+    link.sent.clear()
+    link.session.send_command(Command(CommandType.EXECUTE_PROGRAM))
+    link.run(until=lambda: len(link.sent) > 1)
+
+    # Стоп ушёл, но пока он не подтверждён, устройство считается занятым.
+    assert sent_commands(link)[-1] == Command(CommandType.EMERGENCY)
+    assert link.session.device_is_executing
+
+    link.run()
+    assert not link.session.device_is_executing
+    assert link.session.failed
+    assert link.listener.finished[-1] is False
+
+
+def test_execution_deadline_grows_with_program(make_link):
+    link = make_link()
+    execute = Command(CommandType.EXECUTE_PROGRAM)
+    finish = Response(ResponseType.EXEC_FINISH, CLOSE)
+    link.session.program_duration = 10.0
+    short = link.session.response_timeout(execute, finish)
+    link.session.program_duration = 10_000.0
+    long = link.session.response_timeout(execute, finish)
+    assert long - 10_000.0 > 100 * (short - 10.0)
+
+
+def test_emergency_cancels_upload(make_link):
+    link = make_link(window=4)
+    link.session.send_algorithm([wait(i) for i in range(1, 100)], [], [], 0)
+    link.run(until=lambda: len(link.sent) > 10)
+
+    link.session.send_emergency()
+    link.run()
+
+    assert link.listener.finished == [True]
+    assert link.device.mode == link.device.IDLE
+    assert link.session.program_hash is None
+    assert link.session.last_algorithm_cmd is None
+    assert len(link.sent) < 100
+
+
+def test_calibration_sends_only_changed_motors(make_link):
+    link = make_link(window=4)
+    calibration = [[10 * i, 180 - 10 * i] for i in range(len(MotorID))]
+    link.session.send_calibration(calibration)
+    link.run()
+    assert len(link.sent) == len(MotorID) + 1
+    assert link.device.eeprom_calibration == calibration
+
+    link.sent.clear()
+    calibration[3] = [45, 135]
+    link.session.send_calibration(calibration)
+    link.run()
+    assert sent_commands(link) == [calibrate(3, 45, 135), Command(CommandType.SAVE_CALIBRATION)]
+    assert link.device.eeprom_calibration == calibration
+    assert link.device.eeprom_writes == 2
+
+    link.sent.clear()
+    link.session.send_calibration(calibration)
+    link.run()
+    assert link.sent == []
+    assert link.device.eeprom_writes == 2
+    assert link.listener.finished == [True, True, True]
+
+
+def test_realtime_calibrate_forgets_known_calibration(make_link):
+    link = make_link()
+    calibration = [[0, 180]] * len(MotorID)
+    link.session.calibration = [list(row) for row in calibration]
+
+    link.session.send_command(calibrate(0, 10, 170))
+    link.run()
+    assert link.session.calibration is None
+
+    link.sent.clear()
+    link.session.send_calibration(calibration)
+    link.run()
+    assert len(link.sent) == len(MotorID) + 1
+    assert link.device.calibration == calibration
+    assert link.device.eeprom_calibration == calibration
+
+
+def test_print_calibration_reports_device_angles(make_link):
+    link = make_link()
+    link.session.send_command(Command(CommandType.PRINT_CALIBRATION))
+    link.run()
+    assert link.listener.calibrations == [link.device.calibration]
+    # Углы из RAM не означают, что они же в EEPROM.
+    assert link.session.calibration is None
+
+
+def test_cached_calibration_is_trusted_only_when_device_confirms(make_link):
+    link = make_link()
+    cached = [list(row) for row in link.device.calibration]
+    link.session.confirm_calibration(cached)
+    link.run()
+    assert link.session.calibration == cached
+
+    link = make_link()
+    stale = [[5, 175]] * len(MotorID)
+    link.session.confirm_calibration(stale)
+    link.run()
+    assert link.session.calibration is None
+
+    # Раз калибровка неизвестна, прошивка уйдёт целиком.
+    link.sent.clear()
+    link.session.send_calibration(stale)
+    link.run()
+    assert len(link.sent) == len(MotorID) + 1
+    assert link.device.eeprom_calibration == stale
+
+
+@pytest.mark.parametrize('settle_time', [0.0, 0.5])
+def test_program_duration_matches_execution(make_link, settle_time):
+    link = make_link(settle_time=settle_time)
+    link.session.send_algorithm(*ALGORITHM)
+    link.run()
+    started = link.clock.now()
+    link.session.send_command(Command(CommandType.EXECUTE_PROGRAM))
+    link.run()
+
+    assert link.listener.finished == [True, True]
+    # Пять SET (OPEN, FILTER1 x3, CLOSE) и WAIT 100 + 3 x 50 мс.
+    assert link.session.program_duration == pytest.approx(5 * settle_time + 0.25)
+    assert link.clock.now() - started == pytest.approx(link.session.program_duration)
+
+
+def test_set_deadline_waits_for_the_servo(make_link):
+    link = make_link(settle_time=2.0)
+    executed = Response(ResponseType.EXEC_FINISH, OPEN)
+    parsed = Response(ResponseType.PARSING_OK, None)
+    extra = link.session.response_timeout(OPEN, executed) - link.session.response_timeout(OPEN, parsed)
+    assert extra == pytest.approx(2.0)
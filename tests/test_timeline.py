@@ -0,0 +1,52 @@
+import pytest
+
+from protocol import *
+from timeline import Timeline, BEFORE, LOOP, AFTER, format_duration
+
+
+OPEN = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
+CLOSE = Command(CommandType.SET_FLAP, FlapStatus.CLOSED)
+FILTER1 = Command(CommandType.SET_FILTER, FilterState.FS1)
+FILTER2 = Command(CommandType.SET_FILTER, FilterState.FS2)
+
+
+def wait(ms):
+    return Command(CommandType.WAIT, ms)
+
+
+@pytest.mark.parametrize('settle_time', [0.0, 0.25, 1.0])
+def test_duration_counts_settle_time_of_every_set(settle_time):
+    timeline = Timeline([OPEN, wait(1000)], [FILTER1, wait(500), FILTER2], [CLOSE], 10, settle_time)
+    sets = 1 + 2 * 10 + 1
+    assert timeline.total_duration == pytest.approx(1.0 + 0.5 * 10 + sets * settle_time)
+
+
+def test_empty_loop_is_not_repeated():
+    timeline = Timeline([wait(100)], [], [wait(200)], 1000, settle_time=0.0)
+    assert timeline.total_duration == pytest.approx(0.3)
+
+
+def test_state_follows_loop_repetitions():
+    timeline = Timeline([OPEN], [FILTER1, wait(1000), FILTER2, wait(1000)], [CLOSE], 3, settle_time=0.5)
+    # OPEN 0..0.5; повтор цикла -- 3 с: FILTER1 0.5, ждём, FILTER2, ждём.
+    assert timeline.step_start(LOOP, 2, repetition=1) == pytest.approx(0.5 + 3.0 + 1.5)
+    point = timeline.at(0.5 + 3.0 + 1.6)
+    assert (point.section, point.repetition, point.command) == (LOOP, 1, FILTER2)
+    assert timeline.state_at(0.5 + 3.0 + 1.6) == (FlapStatus.OPENED, FilterState.FS2)
+    # Второй повтор начинается с FILTER2, оставшегося от первого.
+    assert timeline.state_at(0.5 + 3.0 + 0.1) == (FlapStatus.OPENED, FilterState.FS1)
+    assert timeline.at(timeline.total_duration - 0.1).section == AFTER
+    assert timeline.state_at(timeline.total_duration) == (FlapStatus.CLOSED, FilterState.FS2)
+
+
+def test_nothing_runs_outside_the_program():
+    timeline = Timeline([OPEN, wait(100)], [], [], 0, settle_time=0.0, initial_state=(FlapStatus.CLOSED, None))
+    assert timeline.at(-0.1) is None
+    assert timeline.at(timeline.total_duration) is None
+    assert timeline.state_at(-0.1) == (FlapStatus.CLOSED, None)
+    assert timeline.at(0).section == BEFORE
+
+
+def test_format_duration():
+    assert format_duration(0) == '0:00:00'
+    assert format_duration(3 * 3600 + 61.6) == '3:01:02'
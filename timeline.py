@@ -0,0 +1,123 @@
+"""Оценка времени выполнения алгоритма без разворачивания цикла.
+
+Для каждой секции (before, loop, after) один раз строятся массивы начал
+шагов накопленной суммой длительностей и массивы «последнего
+установленного состояния». Запросы о полной длительности и о состоянии
+в момент t отвечаются за O(1) и O(log n) соответственно, сколько бы раз
+ни повторялся цикл.
+"""
+
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+
+from protocol import CommandType
+
+
+# Время, за которое серва гарантированно доезжает, с.
+SERVO_SETTLE_TIME = 1.0
+
+BEFORE = 'before'
+LOOP = 'loop'
+AFTER = 'after'
+
+# Что происходит в момент t: секция, номер повтора цикла, номер шага в
+# секции, сам шаг и состояние (заслонка, фильтр) после него.
+TimelinePoint = namedtuple('TimelinePoint', 'section repetition index command flap filter')
+
+
+def _last_set(values):
+    """Префиксный массив: последнее не-None значение среди values[:i]."""
+    result = [None]
+    for value in values:
+        result.append(result[-1] if value is None else value)
+    return result
+
+
+class _Section:
+    def __init__(self, commands, settle_time):
+        self.commands = commands
+        # Время внутри -- в миллисекундах: целые WAIT складываются без погрешности.
+        durations = [cmd.arg if cmd.type == CommandType.WAIT else settle_time for cmd in commands]
+        self.starts = list(accumulate(durations, initial=0))
+        self.duration = self.starts[-1]
+        self.flaps = _last_set(cmd.arg if cmd.type == CommandType.SET_FLAP else None for cmd in commands)
+        self.filters = _last_set(cmd.arg if cmd.type == CommandType.SET_FILTER else None for cmd in commands)
+
+    def exit_state(self, entry):
+        return (self.flaps[-1] if self.flaps[-1] is not None else entry[0],
+                self.filters[-1] if self.filters[-1] is not None else entry[1])
+
+    def point(self, name, repetition, t, entry):
+        # Шаг, начавшийся последним к моменту t; нулевые шаги с одинаковым
+        # началом считаются выполненными все сразу.
+        index = min(bisect_right(self.starts, t), len(self.commands)) - 1
+        flap = self.flaps[index + 1]
+        filter_ = self.filters[index + 1]
+        return TimelinePoint(
+            name, repetition, index, self.commands[index],
+            flap if flap is not None else entry[0],
+            filter_ if filter_ is not None else entry[1],
+        )
+
+
+class Timeline:
+    def __init__(self, before, loop, after, loop_times, settle_time=SERVO_SETTLE_TIME, initial_state=(None, None)):
+        settle_ms = settle_time * 1000
+        if settle_ms == int(settle_ms):
+            settle_ms = int(settle_ms)
+        self.before = _Section(before, settle_ms)
+        self.loop = _Section(loop, settle_ms)
+        self.after = _Section(after, settle_ms)
+        self.loop_times = loop_times if loop else 0
+        self.initial_state = tuple(initial_state)
+
+        self.loop_start = self.before.duration
+        self.after_start = self.loop_start + self.loop.duration * self.loop_times
+        self.total_ms = self.after_start + self.after.duration
+        self.total_duration = self.total_ms / 1000
+
+        self._loop_entry = self.before.exit_state(self.initial_state)
+        # Начиная со второго повтора цикл стартует из своего же выходного состояния.
+        self._loop_reentry = self.loop.exit_state(self._loop_entry)
+        self._after_entry = self._loop_reentry if self.loop_times else self._loop_entry
+
+    def step_start(self, section, index, repetition=0):
+        """Момент начала шага index секции section, с."""
+        if section == BEFORE:
+            start = self.before.starts[index]
+        elif section == LOOP:
+            start = self.loop_start + self.loop.duration * repetition + self.loop.starts[index]
+        else:
+            start = self.after_start + self.after.starts[index]
+        return start / 1000
+
+    def at(self, t):
+        """Что выполняется в момент t (с) от запуска; None до начала и после конца."""
+        t *= 1000
+        if t < 0 or t >= self.total_ms:
+            return None
+        if t < self.loop_start:
+            return self.before.point(BEFORE, 0, t, self.initial_state)
+        if t < self.after_start:
+            offset = t - self.loop_start
+            repetition = min(int(offset // self.loop.duration), self.loop_times - 1)
+            entry = self._loop_entry if repetition == 0 else self._loop_reentry
+            return self.loop.point(LOOP, repetition, offset - repetition * self.loop.duration, entry)
+        return self.after.point(AFTER, 0, t - self.after_start, self._after_entry)
+
+    def state_at(self, t):
+        """(заслонка, фильтр) в момент t; None -- неизвестно."""
+        if t < 0:
+            return self.initial_state
+        if t >= self.total_duration:
+            return self._after_entry if not self.after.commands else self.after.exit_state(self._after_entry)
+        point = self.at(t)
+        return point.flap, point.filter
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
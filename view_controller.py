@@ -1,23 +1,103 @@
-from PyQt5 import uic
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QThread, pyqtSignal
 from PyQt5.QtWidgets import QMainWindow, QDialog, QFileDialog
 from PyQt5.QtGui import QPixmap
 
 from protocol import (Command, CommandType, FlapStatus,
                       FilterState, MotorID, CalibrationData)
+from command_store import CommandStore
+from algorithm_file import iter_sections, AlgorithmFileError
+from forms import load_form
+
+
+class CommandListModel(QAbstractListModel):
+    """Секция алгоритма. Хранит команды, а не строки: текст строки
+    собирается, только когда вид её рисует."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = CommandStore()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.store)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return MainWindow._cmd_to_readable(self.store[index.row()])
+        return None
+
+    def commands(self):
+        return self.store.commands()
+
+    def set_commands(self, commands):
+        self.set_store(CommandStore(commands))
+
+    def set_store(self, store):
+        self.beginResetModel()
+        self.store = store
+        self.endResetModel()
+
+    def insert_commands(self, row, commands):
+        commands = list(commands)
+        if not commands:
+            return
+        self.beginInsertRows(QModelIndex(), row, row + len(commands) - 1)
+        self.store.insert(row, commands)
+        self.endInsertRows()
+
+    def append_command(self, cmd):
+        row = len(self.store)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.store.append(cmd)
+        self.endInsertRows()
+
+    def remove_commands(self, row, count=1):
+        count = min(count, len(self.store) - row)
+        if row < 0 or count <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row + count - 1)
+        self.store.remove(row, count)
+        self.endRemoveRows()
+
+    def clear(self):
+        self.set_commands(())
+
+
+class AlgorithmLoader(QThread):
+    """Читает .pofs в фоновом потоке и отдаёт секции по мере готовности."""
+
+    section_loaded = pyqtSignal(str, object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, filename, parent=None):
+        super().__init__(parent)
+        self.filename = filename
+
+    def run(self):
+        try:
+            for name, value in iter_sections(self.filename):
+                self.section_loaded.emit(name, value)
+        except (OSError, AlgorithmFileError) as e:
+            self.failed.emit(str(e))
 
 
 class MainWindow(QMainWindow):
 
     def __init__(self, app):
         super().__init__()
-        uic.loadUi('assets/mainwindow.ui', self)
+        load_form('mainwindow', self)
         self.app = app
+        for view in (self.listPreProcessing, self.listLoop, self.listPostProcessing):
+            view.setModel(CommandListModel(view))
         self.connect_signals()
         self.counter = 0
+        self.__loader = None
+        self.__loaded_sections = {}
 
     def connect_signals(self):
         self.btnConnect.clicked.connect(self.__btnConnect_clicked)
         self.btnRefreshPorts.clicked.connect(self.__btnRefreshPorts_clicked)
+        self.cbbSerialPort.currentTextChanged.connect(
+            self.__cbbSerialPort_changed)
         self.btnFlapOpen.clicked.connect(self.__btnFlapOpen_clicked)
         self.btnFlapClose.clicked.connect(self.__btnFlapClose_clicked)
         self.btnFilterNone.clicked.connect(self.__btnFilterNone_clicked)
@@ -46,6 +126,7 @@ class MainWindow(QMainWindow):
         self.actAbout.triggered.connect(self.__actAbout_triggered)
         self.actCalibrateServos.triggered.connect(
             self.__actCalibrateServos_triggered)
+        self.actMetrics.triggered.connect(self.__actMetrics_triggered)
 
     def show_msg(self, msg, timeout=2000):
         self.statusBar().showMessage(msg, timeout)
@@ -54,12 +135,35 @@ class MainWindow(QMainWindow):
         self.btnAlgorithmExecute.setStyleSheet('background-color: green' if executing else '')
 
     def set_available_ports_list(self, port_names):
+        selected = self.cbbSerialPort.currentText()
         self.cbbSerialPort.clear()
         self.cbbSerialPort.addItems(port_names)
+        if selected in port_names:
+            self.cbbSerialPort.setCurrentText(selected)
+
+    def show_connected(self, connected):
+        self.btnConnect.setText("Отключить" if connected else "Подключить")
 
     def get_selected_port_name(self):
         return self.cbbSerialPort.currentText()
 
+    def set_available_baud_rates(self, baud_rates, default):
+        """'Авто' (подбор скорости) есть в списке, но выбрана скорость default."""
+        self.cbbBaudRate.clear()
+        self.cbbBaudRate.addItem('Авто')
+        self.cbbBaudRate.addItems([str(b) for b in baud_rates])
+        self.set_selected_baud_rate(default)
+
+    def get_selected_baud_rate(self):
+        """Выбранная скорость или None, если её надо подобрать."""
+        text = self.cbbBaudRate.currentText()
+        return int(text) if text.isnumeric() else None
+
+    def set_selected_baud_rate(self, baud_rate):
+        idx = self.cbbBaudRate.findText(str(baud_rate) if baud_rate else 'Авто')
+        if idx != -1:
+            self.cbbBaudRate.setCurrentIndex(idx)
+
     def get_wait_time(self):
         wait_time = self.lnWait.text()
         return int(wait_time)
@@ -76,6 +180,13 @@ class MainWindow(QMainWindow):
     def set_loop_times(self, loop_times):
         self.spbLoopTimes.setValue(loop_times)
 
+    def loop_times_fit(self, loop_times):
+        """Влезает ли loop_times в поле; QSpinBox молча обрезал бы лишнее."""
+        if loop_times <= self.spbLoopTimes.maximum():
+            return True
+        self.show_msg(f'Цикл повторяется {loop_times} раз, а окно умеет не больше {self.spbLoopTimes.maximum()}', 5000)
+        return False
+
     def _get_selected_list(self):
         if self.rbBeforeLoop.isChecked():
             return self.listPreProcessing
@@ -87,18 +198,11 @@ class MainWindow(QMainWindow):
 
     @staticmethod
     def _get_section_commands(selected_list):
-        commands = []
-        for i in range(selected_list.count()):
-            txt = selected_list.item(i).text()
-            command = MainWindow._cmd_from_readable(txt)
-            commands.append(command)
-        return commands
+        return selected_list.model().commands()
     
     @staticmethod
     def _set_section_commands(selected_list, commands):
-        selected_list.clear()
-        for cmd in commands:
-            MainWindow.record_command(cmd, selected_list)
+        selected_list.model().set_commands(commands)
             
     def get_algorithm(self):
         before = self._get_section_commands(self.listPreProcessing)
@@ -106,6 +210,12 @@ class MainWindow(QMainWindow):
         after = self._get_section_commands(self.listPostProcessing)
         return before, loop, after
     
+    def get_algorithm_stores(self):
+        """Секции как есть, без распаковки в Command."""
+        return (self.listPreProcessing.model().store,
+                self.listLoop.model().store,
+                self.listPostProcessing.model().store)
+
     def set_algorithm(self, before, loop, after):
         self._set_section_commands(self.listPreProcessing, before)
         self._set_section_commands(self.listLoop, loop)
@@ -118,27 +228,16 @@ class MainWindow(QMainWindow):
         if cmd.type == CommandType.SET_FILTER:
             return f'Фильтр {cmd.arg.value if cmd.arg.value != "0" else "НЕТ"}'
         if cmd.type == CommandType.WAIT:
-            return f'Ждать {cmd.arg // 1000} сек'
+            return f'Ждать {cmd.arg / 1000:g} сек'
         raise Exception('До седова дойти не должно было. #1')
 
-    @staticmethod
-    def _cmd_from_readable(string):
-        parts = string.split(' ')[:2]
-        if parts[0] == 'Махалка':
-            return Command(CommandType.SET_FLAP, FlapStatus.OPENED if parts[1] == 'ОТКР' else FlapStatus.CLOSED)
-        if parts[0] == 'Фильтр':
-            return Command(CommandType.SET_FILTER, FilterState(parts[1] if parts[1] != 'НЕТ' else '0'))
-        if parts[0] == 'Ждать':
-            return Command(CommandType.WAIT, int(parts[1]) * 1000)
-        raise Exception('До седова дойти не должно было. #2')
-
     @staticmethod
     def record_command(cmd, selected_list):
-        row = selected_list.currentRow() + 1
         if selected_list is not None:
-            cmd = MainWindow._cmd_to_readable(cmd)
-            selected_list.insertItem(row, cmd)
-            selected_list.setCurrentRow(row)
+            model = selected_list.model()
+            row = selected_list.currentIndex().row() + 1
+            model.insert_commands(row, (cmd,))
+            selected_list.setCurrentIndex(model.index(row))
 
     def post_command(self, cmd, realtime=True, recording=True):
         if self.rbModeRealtime.isChecked():
@@ -155,17 +254,20 @@ class MainWindow(QMainWindow):
 
     def __btnConnect_clicked(self):
         # Если соединение уже открыто, закрываем его, иначе открываем.
-        if self.app.connection_established():
+        # Пока ждём возвращения выдернутого устройства, кнопка тоже отключает.
+        if self.app.connection_established() or self.app.reconnecting:
             self.app.serial_disconnect()
-            self.btnConnect.setText("Подключить")
+            self.show_connected(False)
         else:
             self.app.serial_connect()
-            if self.app.connection_established():
-                self.btnConnect.setText("Отключить")
+            self.show_connected(self.app.connection_established())
 
     def __btnRefreshPorts_clicked(self):
         self.app.update_available_ports()
 
+    def __cbbSerialPort_changed(self, port_name):
+        self.app.port_selected(port_name)
+
     def __btnFlapOpen_clicked(self):
         cmd = Command(CommandType.SET_FLAP, FlapStatus.OPENED)
         self.post_command(cmd)
@@ -223,15 +325,26 @@ class MainWindow(QMainWindow):
             self.show_msg('Слать нечего, алгоритм пустой')
 
     def __btnAlgorithmClear_clicked(self):
-        self.listPreProcessing.clear()
-        self.listLoop.clear()
-        self.listPostProcessing.clear()
+        self.listPreProcessing.model().clear()
+        self.listLoop.model().clear()
+        self.listPostProcessing.model().clear()
 
     def __btnDeleteCmd_clicked(self):
         selected_list = self._get_selected_list()
         if selected_list is not None:
-            row = selected_list.currentRow()
-            selected_list.takeItem(row)
+            rows = sorted({index.row() for index in selected_list.selectedIndexes()}, reverse=True)
+            if not rows:
+                rows = [selected_list.currentIndex().row()]
+            # Подряд идущие строки удаляются одним куском.
+            model = selected_list.model()
+            start = end = rows[0]
+            for row in rows[1:] + [None]:
+                if row is not None and row == start - 1:
+                    start = row
+                    continue
+                model.remove_commands(start, end - start + 1)
+                if row is not None:
+                    start = end = row
 
     def __rbModeRealtime_clicked(self):
         pass
@@ -240,34 +353,75 @@ class MainWindow(QMainWindow):
         pass
 
     def __actAlgorithmOpen_triggered(self):
-        filename, _ = QFileDialog.getOpenFileName(self, "Загрузить алгоритм", filter='JSON Files (*.json)')
+        filename, _ = QFileDialog.getOpenFileName(
+            self, "Загрузить алгоритм",
+            filter='Алгоритмы (*.pofs *.json *.prog);;POFS Files (*.pofs);;JSON Files (*.json);;'
+                   'Программы с повторами (*.prog)')
         if not filename:
             return
-        
+
+        if filename.endswith('.pofs'):
+            self.__load_algorithm_in_background(filename)
+            return
+
         algorithm = self.app.load_algorithm(filename)
         if algorithm is not None:
             before = algorithm['before']
             loop = algorithm['loop']
             after = algorithm['after']
             loop_times = algorithm['loop_times']
+            if not self.loop_times_fit(loop_times):
+                return
             self.set_algorithm(before, loop, after)
             self.set_loop_times(loop_times)
 
+    def __load_algorithm_in_background(self, filename):
+        if self.__loader is not None and self.__loader.isRunning():
+            self.show_msg('Предыдущий алгоритм ещё загружается')
+            return
+        self.__loaded_sections = {}
+        self.__loader = AlgorithmLoader(filename, self)
+        self.__loader.section_loaded.connect(self.__loader_section_loaded)
+        self.__loader.failed.connect(self.__loader_failed)
+        self.show_msg('Загружаю алгоритм...', 0)
+        self.__loader.start()
+
+    def __loader_section_loaded(self, name, value):
+        # Контрольная сумма проверяется перед последней секцией, так что до
+        # неё файл может оказаться битым: показываем только целый алгоритм.
+        sections = self.__loaded_sections
+        sections[name] = value
+        if name != 'after':
+            return
+        self.__loaded_sections = {}
+        if not self.loop_times_fit(sections['loop_times']):
+            return
+        self.set_loop_times(sections['loop_times'])
+        lists = {'before': self.listPreProcessing, 'loop': self.listLoop, 'after': self.listPostProcessing}
+        for section, view in lists.items():
+            view.model().set_store(sections[section])
+        self.show_msg('Алгоритм загружен')
+
+    def __loader_failed(self, error):
+        # Ничего из файла ещё не показано: алгоритм в окне остаётся прежним.
+        self.__loaded_sections = {}
+        self.show_msg(f'Плохой файл: {error}', 3000)
+
     def __actAlgorithmSave_triggered(self):
-        before, loop, after = self.get_algorithm()
-        loop_times = self.get_loop_times()
+        before, loop, after = self.get_algorithm_stores()
         algorithm = {
-            'before': [str(cmd) for cmd in before],
-            'loop': [str(cmd) for cmd in loop],
-            'after': [str(cmd) for cmd in after],
-            'loop_times': loop_times
+            'before': before,
+            'loop': loop,
+            'after': after,
+            'loop_times': self.get_loop_times()
         }
 
-        filename, _ = QFileDialog.getSaveFileName(self, "Сохранить алгоритм", filter='JSON Files (*.json)')
+        filename, _ = QFileDialog.getSaveFileName(
+            self, "Сохранить алгоритм", filter='JSON Files (*.json);;POFS Files (*.pofs)')
         if not filename:
             return
         
-        if not filename.endswith('.json'):
+        if not filename.endswith('.json') and not filename.endswith('.pofs'):
             filename += '.json'
         self.app.save_algorithm(algorithm, filename)
 
@@ -277,12 +431,15 @@ class MainWindow(QMainWindow):
     def __actCalibrateServos_triggered(self):
         self.app.show_servo_calibration()
 
+    def __actMetrics_triggered(self):
+        self.app.show_metrics()
+
 
 class ServoCalibrationDialog(QDialog):
 
     def __init__(self, app):
         super().__init__()
-        uic.loadUi('assets/servocalibration.ui', self)
+        load_form('servocalibration', self)
         self.app = app
         self.connect_signals()
 
@@ -334,11 +491,33 @@ class ServoCalibrationDialog(QDialog):
         self.app.send_calibration(raw_calibration)
 
 
+class MetricsDialog(QDialog):
+
+    def __init__(self, app):
+        super().__init__()
+        load_form('metrics', self)
+        self.app = app
+        self.connect_signals()
+
+    def connect_signals(self):
+        self.btnRefresh.clicked.connect(self.__btnRefresh_clicked)
+        self.btnClear.clicked.connect(self.__btnClear_clicked)
+
+    def set_summary(self, text):
+        self.txtSummary.setPlainText(text)
+
+    def __btnRefresh_clicked(self):
+        self.app.show_metrics()
+
+    def __btnClear_clicked(self):
+        self.app.clear_metrics()
+
+
 class AboutDialog(QDialog):
 
     def __init__(self, app):
         super().__init__()
-        uic.loadUi('assets/about.ui', self)
+        load_form('about', self)
         self.app = app
         pm = QPixmap('assets/Dx07_12.png').scaled(100, 40)
         self.lblLogo.setPixmap(pm)